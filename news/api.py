@@ -0,0 +1,227 @@
+"""
+Версионированное API только для чтения (JSON) для мобильных клиентов и ботов
+Ответы собираются через values(), без создания экземпляров моделей, и снабжаются сильным ETag и Cache-Control
+Параметр fields=a,b,c позволяет выбрать только нужные поля, например получить карточки ленты без тяжелого content
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.views.decorators.http import require_GET
+
+from news.models import (ArchivedComment, ArchivedNewsPost, GameModel,
+                         GameNewsPost, PostUserComment)
+
+# Поля, доступные клиенту: строка - поле модели, выражение - вычисляемое поле (имя не должно совпадать с полем модели)
+POST_FIELDS = {
+    'id': 'id',
+    'game_id': 'game_id',
+    'game_name': F('game__name'),
+    'title': 'title',
+    'author': 'author',
+    'date': 'date',
+    'source_url': 'source_url',
+    'post_image': 'post_image',
+    'likes': 'likes',
+    'dislikes': 'dislikes',
+    'rating_total': 'rating_total',
+    'content': 'content',
+}
+GAME_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'steam_appid': 'steam_appid',
+    'image': 'image',
+    'description': 'description',
+    'metacritic': 'metacritic',
+    'full_description': 'full_description',
+}
+COMMENT_FIELDS = {
+    'id': 'id',
+    'post_id': 'post_id',
+    'username': F('user__username'),
+    'message': 'message',
+    'created_timestamp': 'created_timestamp',
+    'likes': 'likes',
+    'dislikes': 'dislikes',
+    'rating_total': 'rating_total',
+}
+# Поля, хранящие путь к файлу, в ответе отдаются ссылкой
+MEDIA_FIELDS = ('post_image', 'image')
+
+# Размер страницы по умолчанию и максимальный
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+# Наибольшее число в курсоре (bigint в postgres)
+MAX_CURSOR_VALUE = 2 ** 63 - 1
+
+# Время кэширования ответов клиентом/прокси, в секундах
+LIST_MAX_AGE = 30
+DETAIL_MAX_AGE = 300
+
+
+class ApiError(Exception):
+    pass
+
+
+def select_fields(request, allowed):
+    """
+    Возвращает (поля, вычисляемые поля) для values() по параметру fields, без параметра - все доступные
+    """
+    names = request.GET.get('fields')
+    names = names.split(',') if names else list(allowed)
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise ApiError(f'Неизвестные поля: {", ".join(unknown)}')
+    fields = [allowed[name] for name in names if isinstance(allowed[name], str)]
+    expressions = {name: allowed[name] for name in names if not isinstance(allowed[name], str)}
+    return fields, expressions
+
+
+def get_limit(request):
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError('limit должен быть числом')
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def parse_cursor(request, parts):
+    """
+    Числа курсора "a.b", ровно parts штук, без параметра - None
+    Курсор приходит от клиента, поэтому всё, кроме неотрицательных чисел в пределах bigint, - ошибка 400
+    """
+    cursor = request.GET.get('cursor')
+    if not cursor:
+        return None
+    values = cursor.split('.')
+    if len(values) != parts or not all(value.isascii() and value.isdigit() for value in values):
+        raise ApiError('Некорректный cursor')
+    values = [int(value) for value in values]
+    if max(values) > MAX_CURSOR_VALUE:
+        raise ApiError('Некорректный cursor')
+    return values
+
+
+def serialize_rows(rows):
+    # Пути к файлам превращаем в ссылки, пустой путь - None
+    for row in rows:
+        for field in MEDIA_FIELDS:
+            if field in row:
+                row[field] = f'{settings.MEDIA_URL}{row[field]}' if row[field] else None
+    return rows
+
+
+def api_response(request, data, max_age):
+    """
+    Компактный JSON с сильным ETag (хэш тела ответа) и Cache-Control
+    Если у клиента та же версия (If-None-Match), отвечаем 304 без тела
+    """
+    body = json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':')).encode()
+    etag = f'"{hashlib.md5(body).hexdigest()}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=max_age)
+    return response
+
+
+def api_view(view):
+    # Только GET, ошибки параметров превращаются в 400 с сообщением
+    @require_GET
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except ApiError as error:
+            return JsonResponse({'error': str(error)}, status=400, json_dumps_params={'ensure_ascii': False})
+    return wrapper
+
+
+def first_row(queryset):
+    row = queryset.first()
+    return serialize_rows([row])[0] if row is not None else None
+
+
+def not_found():
+    return JsonResponse({'error': 'Не найдено'}, status=404, json_dumps_params={'ensure_ascii': False})
+
+
+def id_cursor_page(request, queryset, fields, expressions):
+    """
+    Курсорная пагинация по возрастанию id, курсор - id последней записи страницы
+    В отличие от OFFSET, стоимость запроса не растёт с номером страницы
+    """
+    limit = get_limit(request)
+    cursor = parse_cursor(request, 1)
+    if cursor:
+        queryset = queryset.filter(id__gt=cursor[0])
+    # Для курсора нужен id, даже если клиент его не запросил, лишняя запись показывает, есть ли следующая страница
+    rows = list(queryset.order_by('id').values(*fields, cursor_id=F('id'), **expressions)[:limit + 1])
+    next_cursor = str(rows[limit - 1]['cursor_id']) if len(rows) > limit else None
+    rows = rows[:limit]
+    for row in rows:
+        del row['cursor_id']
+    return {'results': serialize_rows(rows), 'next': next_cursor}
+
+
+# Лента новостей с курсорной пагинацией по (date, id), курсор - "date.id" последнего поста страницы
+@api_view
+def feed(request):
+    fields, expressions = select_fields(request, POST_FIELDS)
+    limit = get_limit(request)
+    queryset = GameNewsPost.objects.order_by('-date', '-id')
+    cursor = parse_cursor(request, 2)
+    if cursor:
+        date, post_id = cursor
+        queryset = queryset.filter(Q(date__lt=date) | Q(date=date, id__lt=post_id))
+    rows = list(queryset.values(*fields, cursor_date=F('date'), cursor_id=F('id'), **expressions)[:limit + 1])
+    next_cursor = f'{rows[limit - 1]["cursor_date"]}.{rows[limit - 1]["cursor_id"]}' if len(rows) > limit else None
+    rows = rows[:limit]
+    for row in rows:
+        del row['cursor_date'], row['cursor_id']
+    return api_response(request, {'results': serialize_rows(rows), 'next': next_cursor}, LIST_MAX_AGE)
+
+
+@api_view
+def games(request):
+    fields, expressions = select_fields(request, GAME_FIELDS)
+    data = id_cursor_page(request, GameModel.objects.all(), fields, expressions)
+    return api_response(request, data, LIST_MAX_AGE)
+
+
+@api_view
+def game_detail(request, pk: int):
+    fields, expressions = select_fields(request, GAME_FIELDS)
+    row = first_row(GameModel.objects.filter(id=pk).values(*fields, **expressions))
+    if row is None:
+        return not_found()
+    return api_response(request, row, DETAIL_MAX_AGE)
+
+
+@api_view
+def post_detail(request, pk: int):
+    fields, expressions = select_fields(request, POST_FIELDS)
+    row = first_row(GameNewsPost.objects.filter(id=pk).values(*fields, **expressions))
+    # Старые посты переносятся в архив с тем же id и теми же полями
+    if row is None:
+        row = first_row(ArchivedNewsPost.objects.filter(id=pk).values(*fields, **expressions))
+    if row is None:
+        return not_found()
+    return api_response(request, row, DETAIL_MAX_AGE)
+
+
+# Комментарии к посту в порядке написания
+@api_view
+def post_comments(request, pk: int):
+    fields, expressions = select_fields(request, COMMENT_FIELDS)
+    comments = PostUserComment.objects.filter(post_id=pk)
+    if not comments.exists():
+        comments = ArchivedComment.objects.filter(post_id=pk)
+    data = id_cursor_page(request, comments, fields, expressions)
+    return api_response(request, data, LIST_MAX_AGE)
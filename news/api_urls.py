@@ -0,0 +1,13 @@
+from django.urls import path
+
+from news import api
+
+app_name = 'api'
+
+urlpatterns = [
+    path('feed', api.feed, name='feed'),
+    path('games', api.games, name='games'),
+    path('games/<int:pk>', api.game_detail, name='game_detail'),
+    path('posts/<int:pk>', api.post_detail, name='post_detail'),
+    path('posts/<int:pk>/comments', api.post_comments, name='post_comments'),
+]
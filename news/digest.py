@@ -0,0 +1,114 @@
+"""
+Дайджест новых постов для подписчиков
+Для каждого пользователя хранится id последнего поста, учтённого в его дайджесте (User.digest_post_id),
+в дайджест попадают посты его игр с большим id и свежей датой steam (не старше DIGEST_LOOKBACK_DAYS)
+Расчёт идёт множествами, а не циклом запросов по пользователям и играм:
+    - новые посты всех игр загружаются одним запросом (только id, игра и заголовок) и группируются по играм
+    - пользователи читаются пачками по id, для пачки одним запросом загружаются подписки
+    - блок письма для игры рендерится один раз на набор постов и переиспользуется для всех подписчиков
+Письма пачки ставятся в очередь (users.tasks.enqueue_emails) в одной транзакции со сдвигом digest_post_id,
+поэтому повторный запуск после падения не отправит дайджест дважды
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+
+from news.models import GameNewsPost, Subscription
+from users.models import OutgoingEmail, User
+from users.tasks import enqueue_emails
+
+# Посты старше этого (по дате steam) в дайджест не попадают, даже если добавлены недавно (новая игра в библиотеке)
+DIGEST_LOOKBACK_DAYS = 7
+# Сколько постов игры показывается в письме, об остальных пишется только их количество
+DIGEST_POSTS_PER_GAME = 5
+# Сколько пользователей обрабатывается за одну транзакцию
+DIGEST_CHUNK_SIZE = 1000
+
+
+def new_posts_by_game(max_id):
+    # {id игры: (название, посты от новых к старым)}, посты - словари с id и title
+    since = int((timezone.now() - timedelta(days=DIGEST_LOOKBACK_DAYS)).timestamp())
+    posts = {}
+    queryset = (GameNewsPost.objects.filter(id__lte=max_id, date__gte=since)
+                .order_by('game_id', '-id').values('id', 'title', 'game_id', 'game__name'))
+    for post in queryset.iterator(chunk_size=5000):
+        posts.setdefault(post['game_id'], (post['game__name'], []))[1].append(post)
+    return posts
+
+
+class GameBlocks:
+    """
+    Отрендеренные блоки писем: у пользователя новые посты игры - это всегда начало её списка (от новых к старым),
+    поэтому блок определяется игрой и количеством новых постов и рендерится один раз за запуск
+    """
+
+    def __init__(self, posts):
+        self.posts = posts
+        self.blocks = {}
+
+    def get(self, game_id, last_post_id):
+        game_name, posts = self.posts[game_id]
+        count = 0
+        while count < len(posts) and posts[count]['id'] > last_post_id:
+            count += 1
+        if not count:
+            return None
+        if (game_id, count) not in self.blocks:
+            self.blocks[(game_id, count)] = render_to_string('news/digest/game.txt', {
+                'game_name': game_name,
+                'posts': [{'title': post['title'],
+                           'url': settings.FULL_DOMAIN_NAME + reverse('news:post_detail', kwargs={'pk': post['id']})}
+                          for post in posts[:min(count, DIGEST_POSTS_PER_GAME)]],
+                'more': max(count - DIGEST_POSTS_PER_GAME, 0),
+            })
+        return self.blocks[(game_id, count)]
+
+
+def send_chunk(users, blocks, max_id):
+    # Подписки всей пачки одним запросом по индексу (user, game)
+    games = {}
+    for user_id, game_id in (Subscription.objects.filter(user_id__in=[user['id'] for user in users])
+                             .order_by('user_id', 'game_id').values_list('user_id', 'game_id')):
+        games.setdefault(user_id, []).append(game_id)
+    emails = []
+    for user in users:
+        user_blocks = [block for block in (blocks.get(game_id, user['digest_post_id'])
+                                           for game_id in games.get(user['id'], ()) if game_id in blocks.posts)
+                       if block]
+        if user_blocks:
+            emails.append(OutgoingEmail(
+                recipient=user['email'],
+                subject='Новые посты ваших игр на rpg_agg',
+                body=render_to_string('news/digest/email.txt', {'username': user['username'], 'blocks': user_blocks}),
+            ))
+    with transaction.atomic():
+        if emails:
+            enqueue_emails(emails)
+        User.objects.filter(id__in=[user['id'] for user in users]).update(digest_post_id=max_id)
+    return len(emails)
+
+
+def send_digest(chunk_size=DIGEST_CHUNK_SIZE):
+    """
+    Поставить в очередь дайджесты всем подписчикам с новыми постами, возвращает количество писем
+    Память не зависит от числа пользователей: в ней только свежие посты, блоки писем и одна пачка пользователей
+    """
+    # Посты, добавленные во время рассылки, попадут в следующий дайджест
+    max_id = GameNewsPost.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    blocks = GameBlocks(new_posts_by_game(max_id))
+    if not blocks.posts:
+        return 0
+    sent = 0
+    last_id = 0
+    while True:
+        users = list(User.objects.filter(id__gt=last_id, is_active=True, check_email=True,
+                                         digest_post_id__lt=max_id)
+                     .order_by('id').values('id', 'username', 'email', 'digest_post_id')[:chunk_size])
+        if not users:
+            return sent
+        sent += send_chunk(users, blocks, max_id)
+        last_id = users[-1]['id']
@@ -0,0 +1,347 @@
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import tempfile
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+from unittest import mock
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from news import tasks
+from news.models import (HOT_POSTS_PER_GAME, GameModel, GameNewsPost,
+                         PostUserComment, Subscription)
+from users.models import User
+
+# Теги steam bbcode для синтетических постов сообщества
+BBCODE_SNIPPETS = (
+    '[h1]{words}[/h1]', '[b]{words}[/b]', '[i]{words}[/i]', '[u]{words}[/u]', '[s]{words}[/s]',
+    '[center]{words}[/center]', '[quote]{words}[/quote]', '[code]{words}[/code]',
+    '[list][*]{words}[*]{words}[/list]', '[url=https://store.steampowered.com/]{words}[/url]',
+    '[img]{{STEAM_CLAN_IMAGE}}/1/{word}.png[/img]', '[previewyoutube={word};full][/previewyoutube]',
+    ' https://steamcommunity.com/{word} ',
+)
+WORDS = ('patch', 'quest', 'dragon', 'sword', 'update', 'balance', 'fix', 'dungeon', 'mage', 'release', 'steam')
+# Размеры синтетических изображений для save_image (ширина, высота)
+IMAGE_SIZES = ((640, 360), (1280, 720), (1920, 1080), (989, 427), (3840, 2160))
+# Адрес изображения корпуса по его номеру, остальные адреса соответствуют изображениям по хэшу
+CORPUS_URL = 'https://cdn.example/corpus/'
+
+
+class FakeResponse:
+    def __init__(self, data=b'', payload=None):
+        self.data = data
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class FakeSteam:
+    """
+    Замена прокси из news.tasks: новости игр из записанных (или синтетических) ответов GetNewsForApp,
+    изображения - из корпуса (адрес изображения всегда соответствует одному и тому же файлу корпуса), без сети
+    """
+
+    def __init__(self, news, images):
+        self.news = news
+        self.images = images
+
+    def request(self, method, url, **kwargs):
+        if 'GetNewsForApp' in url:
+            appid = int(url.split('appid=')[1].split('&')[0])
+            return FakeResponse(payload=self.news[appid])
+        if url.startswith(CORPUS_URL):
+            return FakeResponse(data=self.images[int(url[len(CORPUS_URL):])])
+        return FakeResponse(data=self.images[zlib.crc32(url.encode()) % len(self.images)])
+
+
+class FakeRedisPipeline:
+    def __init__(self):
+        self.results = []
+
+    def hmget(self, key, *fields):
+        self.results.append([None] * len(fields))
+        return self
+
+    def execute(self):
+        return self.results
+
+
+class FakeRedis:
+    """
+    Redis без сервера для news.votes и news.stream: буфер голосов пуст, публикация новых постов никуда не уходит
+    """
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline()
+
+    def get(self, key):
+        return None
+
+    def publish(self, channel, message):
+        return 0
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def timings(values):
+    # Сводка замеров в миллисекундах
+    return {
+        'median_ms': round(statistics.median(values) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'min_ms': round(min(values) * 1000, 3),
+    }
+
+
+class Command(BaseCommand):
+    """
+    Воспроизводимые замеры горячих путей без сети: steam и redis заменены подделками, кэш - локальный,
+    изображения пишутся во временную папку, а все данные создаются внутри транзакции, которая откатывается
+    Запускать на локальной базе, результаты сохраняются в JSON, --compare сравнивает их с прошлым запуском
+    """
+    help = 'Замеряет рендеринг bbcode, news_post_update, save_image и представления, результаты - в JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='100,1000,10000',
+                            help='Количества постов в базе для замеров представлений, через запятую')
+        parser.add_argument('--repeat', type=int, default=20, help='Сколько раз повторять каждый замер')
+        parser.add_argument('--seed', type=int, default=1, help='Зерно генератора синтетических данных')
+        parser.add_argument('--payloads', help='Папка с записанными ответами GetNewsForApp (<appid>.json)')
+        parser.add_argument('--images', help='Папка с изображениями для save_image вместо синтетических')
+        parser.add_argument('--output', help='Файл для результатов, по умолчанию benchmark-<время>.json')
+        parser.add_argument('--compare', help='Файл результатов прошлого запуска для поиска регрессий')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Во сколько (доля) медиана может вырасти без отметки регрессии')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.repeat = options['repeat']
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        news = self.load_payloads(options['payloads'])
+        images = self.load_images(options['images'])
+
+        results = {}
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=Path(media_root),
+                                  CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}), \
+                mock.patch.object(tasks, 'proxy', FakeSteam(news, images)), \
+                mock.patch('news.votes.client', FakeRedis()), \
+                mock.patch('news.stream.publisher', FakeRedis()):
+            os.makedirs(os.path.join(media_root, 'posts_images'))
+            results['bbcode'] = self.bench_bbcode(news)
+            results['save_image'] = self.bench_save_image(images, media_root)
+            results['news_post_update'] = self.bench_news_post_update(news)
+            for size in sizes:
+                results[f'views@{size}'] = self.bench_views(size)
+
+        report = {
+            'meta': {
+                'started_at': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'seed': options['seed'],
+                'repeat': self.repeat,
+                'payloads': options['payloads'] or 'synthetic',
+                'images': options['images'] or 'synthetic',
+            },
+            'results': results,
+        }
+        output = options['output'] or f'benchmark-{datetime.now():%Y%m%d-%H%M%S}.json'
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+        self.stdout.write(self.style.SUCCESS(f'Результаты сохранены в {output}'))
+
+        if options['compare']:
+            with open(options['compare']) as file:
+                regressions = self.compare(json.load(file)['results'], results, options['threshold'])
+            if regressions:
+                raise CommandError('Регрессии:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('Регрессий нет'))
+
+    def words(self, count):
+        return ' '.join(self.random.choice(WORDS) for _ in range(count))
+
+    def bbcode_content(self, blocks):
+        return '\n'.join(self.random.choice(BBCODE_SNIPPETS).format(words=self.words(8), word=self.random.choice(WORDS))
+                         for _ in range(blocks))
+
+    def load_payloads(self, folder):
+        # {appid: ответ GetNewsForApp}, синтетические - 20 игр по 20 новостей, половина от сообщества steam
+        if folder:
+            return {int(name.split('.')[0]): json.load(open(os.path.join(folder, name)))
+                    for name in sorted(os.listdir(folder)) if name.endswith('.json')}
+        news = {}
+        for appid in range(1, 21):
+            items = []
+            for number in range(20):
+                community = number % 2 == 0
+                image = f'<img src="https://cdn.example/{appid}/{number}.jpg">'
+                content = (self.bbcode_content(40) if community else
+                           f'<p>{self.words(30)}</p>{image}<p>{self.words(60)}</p>')
+                items.append({
+                    'gid': f'{appid}{number:04}', 'title': self.words(6),
+                    'url': f'https://store.example/{appid}/{number}',
+                    'author': 'bench', 'contents': content, 'date': 1700000000 + number * 3600,
+                    'feedname': 'steam_community_announcements' if community else 'pc_gamer',
+                })
+            news[appid] = {'appnews': {'appid': appid, 'newsitems': items}}
+        return news
+
+    def load_images(self, folder):
+        # Список байтов изображений, синтетические - градиент с шумом каждого размера в JPEG и PNG
+        if folder:
+            return [open(os.path.join(folder, name), 'rb').read() for name in sorted(os.listdir(folder))]
+        images = []
+        for width, height in IMAGE_SIZES:
+            noise = Image.effect_noise((width // 4, height // 4), 32).resize((width, height))
+            gradient = Image.linear_gradient('L').resize((width, height))
+            image = Image.merge('RGB', (noise, gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+            for image_format in ('JPEG', 'PNG'):
+                buffer = io.BytesIO()
+                image.save(buffer, image_format)
+                images.append(buffer.getvalue())
+        return images
+
+    def bench_bbcode(self, news):
+        contents = [item['contents'] for payload in news.values() for item in payload['appnews']['newsitems']
+                    if item['feedname'] == 'steam_community_announcements']
+        if not contents:
+            return {}
+        size = sum(len(content) for content in contents)
+        durations = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            for content in contents:
+                tasks.second_rendering_bbcode_in_html(tasks.first_rendering_bbcode_in_html(content))
+            durations.append(time.perf_counter() - start)
+        best = min(durations)
+        self.stdout.write(f'bbcode: {len(contents) / best:.0f} постов/с')
+        return {'posts': len(contents), 'chars': size, 'posts_per_second': round(len(contents) / best, 1),
+                'mb_per_second': round(size / best / 2 ** 20, 3), **timings(durations)}
+
+    def bench_save_image(self, images, media_root):
+        durations = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            for number in range(len(images)):
+                tasks.save_image(path=os.path.join(media_root, f'bench_{number}.jpg'),
+                                 image_url=f'{CORPUS_URL}{number}')
+            durations.append((time.perf_counter() - start) / len(images))
+        self.stdout.write(f'save_image: {statistics.median(durations) * 1000:.1f} мс на изображение')
+        return {'images': len(images), 'bytes': sum(len(data) for data in images), **timings(durations)}
+
+    def bench_news_post_update(self, news):
+        # Первый проход создаёт все посты, второй - типичный запуск по расписанию, когда новых постов нет
+        result = {}
+        with transaction.atomic():
+            games = [GameModel.objects.create(name=f'bench {appid}', image='games_images/bench.jpg',
+                                              description='bench', steam_appid=appid) for appid in news]
+            for run in ('new_posts', 'no_changes'):
+                durations, queries = [], []
+                for game in games:
+                    with CaptureQueriesContext(connection) as context:
+                        start = time.perf_counter()
+                        tasks.news_post_update(game)
+                        durations.append(time.perf_counter() - start)
+                    queries.append(len(context))
+                result[run] = {'games': len(games), 'queries_per_game': round(statistics.mean(queries), 1),
+                               **timings(durations)}
+                self.stdout.write(f'news_post_update ({run}): {statistics.median(durations) * 1000:.1f} мс на игру')
+            transaction.set_rollback(True)
+        return result
+
+    def populate(self, size):
+        # Игры по HOT_POSTS_PER_GAME постов, пользователь с подписками и пост с комментариями
+        games = GameModel.objects.bulk_create([
+            GameModel(name=f'bench game {number}', image='games_images/bench.jpg', description=self.words(20),
+                      steam_appid=10 ** 6 + number, post_count=HOT_POSTS_PER_GAME)
+            for number in range(max(1, size // HOT_POSTS_PER_GAME))
+        ])
+        posts = GameNewsPost.objects.bulk_create([
+            GameNewsPost(game=games[number % len(games)], gid=f'bench{number}', title=self.words(6), author='bench',
+                         date=1700000000 + number, source_url='https://store.example/', content=self.words(200),
+                         created_timestamp=timezone.now(), comment_count=0)
+            for number in range(size)
+        ], batch_size=1000)
+        password = make_password(None)
+        users = User.objects.bulk_create([
+            User(username=f'bench_user_{number}', email=f'bench{number}@example.com', password=password,
+                 check_email=True, avatar='users_images/bench.jpg')
+            for number in range(20)
+        ])
+        Subscription.objects.bulk_create([Subscription(user=users[0], game=game) for game in games[:50]])
+        PostUserComment.objects.bulk_create([
+            PostUserComment(user=users[number % len(users)], post=posts[-1], message=self.words(30),
+                            finish_timestamp=timezone.now())
+            for number in range(50)
+        ])
+        GameNewsPost.objects.filter(id=posts[-1].id).update(comment_count=50)
+        return users[0], games[0], posts[-1]
+
+    def bench_views(self, size):
+        result = {}
+        with transaction.atomic():
+            user, game, post = self.populate(size)
+            client = Client()
+            client.force_login(user)
+            urls = {
+                'feed': reverse('news:feed'),
+                'subs_feed': reverse('news:subs_feed'),
+                'library': reverse('news:library'),
+                'game_detail': reverse('news:game_detail', kwargs={'pk': game.id}),
+                'post_detail': reverse('news:post_detail', kwargs={'pk': post.id}),
+            }
+            for name, url in urls.items():
+                cache.clear()
+                durations, queries = [], []
+                for _ in range(self.repeat):
+                    with CaptureQueriesContext(connection) as context:
+                        start = time.perf_counter()
+                        response = client.get(url)
+                        durations.append(time.perf_counter() - start)
+                    if response.status_code != 200:
+                        raise CommandError(f'{name}: ответ {response.status_code}')
+                    queries.append(len(context))
+                # Первый запрос - с холодным кэшем, остальные - с тёплым
+                result[name] = {'queries_cold': queries[0], 'queries_warm': queries[-1], **timings(durations)}
+                self.stdout.write(f'{name}@{size}: {result[name]["median_ms"]} мс, {queries[-1]} запросов')
+            transaction.set_rollback(True)
+        return result
+
+    @staticmethod
+    def compare(baseline, results, threshold):
+        # Регрессия - рост медианы больше чем на threshold или рост числа запросов к базе
+        regressions = []
+
+        def walk(old, new, path):
+            for key, value in new.items():
+                if key not in old:
+                    continue
+                if isinstance(value, dict):
+                    walk(old[key], value, f'{path}{key}.')
+                elif key == 'median_ms' and value > old[key] * (1 + threshold):
+                    regressions.append(f'{path}{key}: {old[key]} -> {value}')
+                elif key.startswith('queries') and value > old[key]:
+                    regressions.append(f'{path}{key}: {old[key]} -> {value}')
+
+        walk(baseline, results, '')
+        return regressions
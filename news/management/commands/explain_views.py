@@ -0,0 +1,76 @@
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+
+from news.models import GameModel, GameNewsPost
+from news.views import (GameModelDetailView, MyCommentListView,
+                        MySubscribesListView, NewsFeedOnlySubsView,
+                        NewsFeedView, NewsHotFeedView, NewsPostDetailView,
+                        OurLibraryListView)
+from users.models import User
+
+
+class Command(BaseCommand):
+    """
+    Проверка планов запросов: для каждого спискового представления строится его основной queryset
+    (ровно так, как его строит само представление) и через EXPLAIN проверяется, что в плане нет Seq Scan.
+    Последовательное сканирование на время проверки запрещено (enable_seqscan = off), поэтому на пустой
+    или маленькой базе планировщик всё равно выберет индекс, если подходящий индекс существует
+    """
+    help = 'Проверяет через EXPLAIN, что основные запросы списковых представлений используют индексы'
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Проверка планов запросов поддерживается только для PostgreSQL')
+
+        # Берём реальные объекты, если они есть, иначе подойдут любые id, план от этого не зависит
+        user = User.objects.order_by('id').first() or User(id=1)
+        game_id = GameModel.objects.order_by('id').values_list('id', flat=True).first() or 1
+        post_id = GameNewsPost.objects.order_by('id').values_list('id', flat=True).first() or 1
+
+        # Название, представление, его kwargs из url и нужна ли авторизация
+        views = [
+            ('feed', NewsFeedView, {}, False),
+            ('hot_feed', NewsHotFeedView, {}, False),
+            ('subs_feed', NewsFeedOnlySubsView, {}, True),
+            ('library', OurLibraryListView, {}, False),
+            ('post_detail', NewsPostDetailView, {'pk': post_id}, False),
+            ('my_comments', MyCommentListView, {}, True),
+            ('my_subscribes', MySubscribesListView, {}, True),
+        ]
+
+        failed = []
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            for name, view_class, kwargs, need_login in views:
+                queryset = self.view_queryset(view_class, kwargs, user if need_login else AnonymousUser())
+                failed += self.check_plan(name, queryset)
+            # У страницы игры основной запрос - список новостей игры, а не сама игра
+            failed += self.check_plan('game_detail', GameModelDetailView.news_queryset(game_id))
+
+        if failed:
+            raise CommandError(f'Seq Scan в планах запросов: {", ".join(failed)}')
+        self.stdout.write(self.style.SUCCESS('Все основные запросы используют индексы'))
+
+    @staticmethod
+    def view_queryset(view_class, kwargs, user):
+        # Создаём представление так же, как это делает as_view(), но без выполнения запроса
+        request = RequestFactory().get('/')
+        request.user = user
+        view = view_class()
+        view.setup(request, **kwargs)
+        queryset = view.get_queryset()
+        # Страница пагинации = LIMIT, именно такой запрос уходит в базу
+        if view.paginate_by:
+            queryset = queryset[:view.paginate_by]
+        return queryset
+
+    def check_plan(self, name, queryset):
+        plan = queryset.explain()
+        if 'Seq Scan' in plan:
+            self.stdout.write(self.style.ERROR(f'{name}: Seq Scan\n{plan}'))
+            return [name]
+        self.stdout.write(f'{name}: OK')
+        return []
@@ -0,0 +1,309 @@
+import csv
+import io
+import json
+import os
+import random
+import time
+from bisect import bisect
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from PIL import Image
+
+from news.models import (HOT_POSTS_PER_GAME, ArchivedComment, ArchivedNewsPost,
+                         GameModel, GameNewsPost, PostUserComment,
+                         Subscription, Vote, hot_score)
+from users.models import User
+
+WORDS = ('patch', 'quest', 'dragon', 'sword', 'update', 'balance', 'fix', 'dungeon', 'mage', 'release', 'steam',
+         'boss', 'loot', 'party', 'skill', 'tree', 'class', 'guild', 'raid', 'event', 'season', 'map', 'hero')
+# Сколько разных текстов генерируется заранее, строки берут их по кругу, а не собирают текст для каждой строки
+TEXT_POOL_SIZE = 1000
+# Смещение steam_appid синтетических игр, чтобы не пересекаться с настоящими
+APPID_OFFSET = 1_500_000_000
+
+
+class TableWriter:
+    """
+    Буфер строк одной таблицы: на PostgreSQL пачка уходит одним COPY в формате csv,
+    на остальных базах - через bulk_create
+    Не переданные поля заполняются значениями по умолчанию полей модели (auto_now - текущим временем)
+    """
+
+    def __init__(self, model, fields, batch_size, now):
+        self.model = model
+        self.fields = [model._meta.get_field(name) for name in fields]
+        self.batch_size = batch_size
+        # {поле: значение} для остальных полей, первичный ключ и пустые поля заполнит база
+        self.defaults = {}
+        for field in model._meta.concrete_fields:
+            if field in self.fields or field.primary_key:
+                continue
+            if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+                self.defaults[field] = now
+            elif field.get_default() is not None or not field.null:
+                self.defaults[field] = field.get_default()
+        self.rows = []
+        self.written = 0
+
+    def add(self, *values):
+        self.rows.append(values)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if connection.vendor == 'postgresql':
+            self.copy()
+        else:
+            names = [field.attname for field in self.fields]
+            defaults = {field.attname: value for field, value in self.defaults.items()}
+            self.model.objects.bulk_create([self.model(**defaults, **dict(zip(names, row))) for row in self.rows])
+        self.written += len(self.rows)
+        self.rows = []
+
+    @staticmethod
+    def csv_value(value):
+        if isinstance(value, datetime):
+            return value.isoformat()
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return value
+
+    def copy(self):
+        # Строки в кавычках, числа и NULL (пустое значение) - без, поэтому пустая строка не станет NULL
+        defaults = [self.csv_value(value) for value in self.defaults.values()]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+        for row in self.rows:
+            writer.writerow([self.csv_value(value) for value in row] + defaults)
+        buffer.seek(0)
+        columns = ', '.join(field.column for field in [*self.fields, *self.defaults])
+        with connection.cursor() as cursor:
+            cursor.copy_expert(f'COPY {self.model._meta.db_table} ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+class Command(BaseCommand):
+    """
+    Генерация синтетических данных для нагрузочного тестирования: игры, посты (последние HOT_POSTS_PER_GAME
+    каждой игры - в основной таблице, остальные - сразу в архиве, как после news_archive), комментарии, голоса,
+    пользователи и подписки. Количества постов у игр, комментариев у постов, подписок у пользователей и голосов
+    распределены по Парето (немного популярных объектов и длинный хвост), активность пользователей и популярность
+    игр - тоже. Один и тот же --seed даёт один и тот же набор данных
+    Строки пишутся пачками через COPY, счётчики (комментариев, голосов, постов, подписчиков, карма) считаются
+    при генерации, поэтому пересчёт после загрузки не нужен. Всё загружается одной транзакцией
+    """
+    help = 'Генерирует синтетические игры, посты, комментарии, голоса, пользователей и подписки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=1, help='Зерно генератора')
+        parser.add_argument('--games', type=int, default=2000, help='Количество игр')
+        parser.add_argument('--users', type=int, default=100000, help='Количество пользователей')
+        parser.add_argument('--posts-per-game', type=float, default=500, help='Среднее количество постов игры')
+        parser.add_argument('--comments-per-post', type=float, default=5, help='Среднее количество комментариев')
+        parser.add_argument('--votes-per-post', type=float, default=20, help='Среднее количество голосов за пост')
+        parser.add_argument('--votes-per-comment', type=float, default=3,
+                            help='Среднее количество голосов за комментарий')
+        parser.add_argument('--subscriptions-per-user', type=float, default=5, help='Среднее количество подписок')
+        parser.add_argument('--skew', type=float, default=1.5,
+                            help='Параметр распределения Парето (больше 1, чем меньше, тем сильнее перекос)')
+        parser.add_argument('--like-ratio', type=float, default=0.8, help='Доля лайков среди голосов')
+        parser.add_argument('--days', type=int, default=3 * 365, help='За сколько дней распределены посты')
+        parser.add_argument('--post-image-ratio', type=float, default=0.3, help='Доля постов с обложкой')
+        parser.add_argument('--avatar-ratio', type=float, default=0.2, help='Доля пользователей с аватаркой')
+        parser.add_argument('--no-media', action='store_true', help='Не создавать файлы-заглушки изображений')
+        parser.add_argument('--batch-size', type=int, default=50000, help='Строк в одном COPY')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.random = random.Random(options['seed'])
+        self.now = timezone.now()
+        self.started = time.monotonic()
+        self.placeholder = None if options['no_media'] else self.placeholder_image()
+        self.titles = [self.words(6) for _ in range(TEXT_POOL_SIZE)]
+        self.contents = [self.words(200) for _ in range(TEXT_POOL_SIZE)]
+        self.messages = [self.words(25) for _ in range(TEXT_POOL_SIZE)]
+        # Активность пользователей и популярность игр - накопленные веса для выбора через bisect
+        self.user_weights = list(accumulate(self.pareto() for _ in range(options['users'])))
+        self.game_weights = list(accumulate(self.pareto() for _ in range(options['games'])))
+        # Синтетические объекты идут после уже существующих, посты и комментарии делят id с архивом
+        self.user_start = self.next_id(User)
+        self.game_start = self.next_id(GameModel)
+        self.post_start = self.post_id = max(self.next_id(GameNewsPost), self.next_id(ArchivedNewsPost))
+        self.comment_id = max(self.next_id(PostUserComment), self.next_id(ArchivedComment))
+        self.karma = [0] * options['users']
+
+        with transaction.atomic():
+            subscriber_counts = self.generate_subscriptions()
+            self.generate_games_and_posts(subscriber_counts)
+            self.generate_users()
+            if connection.vendor == 'postgresql':
+                self.reset_sequences()
+        self.log('Готово')
+
+    def log(self, message):
+        self.stdout.write(f'[{time.monotonic() - self.started:7.1f} с] {message}')
+
+    def words(self, count):
+        return ' '.join(self.random.choice(WORDS) for _ in range(count))
+
+    def pareto(self):
+        return self.random.paretovariate(self.options['skew'])
+
+    def skewed_count(self, mean):
+        # Целое по Парето со средним mean (среднее Pareto(a) равно a / (a - 1))
+        skew = self.options['skew']
+        return int(mean * (skew - 1) / skew * self.pareto())
+
+    def pick(self, weights, start):
+        return start + bisect(weights, self.random.random() * weights[-1])
+
+    def pick_distinct(self, weights, start, count):
+        chosen = set()
+        count = min(count, len(weights))
+        while len(chosen) < count:
+            chosen.add(self.pick(weights, start))
+        return chosen
+
+    def writer(self, model, *fields):
+        return TableWriter(model, fields, self.options['batch_size'], self.now)
+
+    @staticmethod
+    def next_id(model):
+        return (model.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+
+    def placeholder_image(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (320, 180), (96, 64, 32)).save(buffer, 'JPEG')
+        return buffer.getvalue()
+
+    def media(self, folder, name):
+        # Файл-заглушка для изображения, у каждого объекта свой, так как при удалении объекта удаляется и файл
+        path = f'{folder}/{name}.jpg'
+        if self.placeholder is not None:
+            os.makedirs(settings.MEDIA_ROOT / folder, exist_ok=True)
+            with open(settings.MEDIA_ROOT / path, 'wb') as file:
+                file.write(self.placeholder)
+        return path
+
+    def generate_subscriptions(self):
+        subscriptions = self.writer(Subscription, 'user_id', 'game_id')
+        counts = [0] * self.options['games']
+        for user in range(self.options['users']):
+            for game_id in self.pick_distinct(self.game_weights, self.game_start,
+                                              self.skewed_count(self.options['subscriptions_per_user'])):
+                subscriptions.add(self.user_start + user, game_id)
+                counts[game_id - self.game_start] += 1
+        subscriptions.flush()
+        self.log(f'{Subscription._meta.db_table}: {subscriptions.written}')
+        return counts
+
+    def votes(self, count):
+        # Голоса объекта: id разных пользователей и значения
+        like_ratio = self.options['like_ratio']
+        return [(user_id, Vote.LIKE if self.random.random() < like_ratio else Vote.DISLIKE)
+                for user_id in self.pick_distinct(self.user_weights, self.user_start, count)]
+
+    def generate_games_and_posts(self, subscriber_counts):
+        options = self.options
+        games = self.writer(GameModel, 'id', 'name', 'image', 'description', 'steam_appid', 'post_count',
+                            'subscriber_count')
+        post_fields = ('id', 'game_id', 'gid', 'title', 'author', 'date', 'source_url', 'content', 'created_timestamp',
+                       'likes', 'dislikes', 'rating_total', 'comment_count', 'post_image')
+        posts = self.writer(GameNewsPost, *post_fields, 'hot_score')
+        archived_posts = self.writer(ArchivedNewsPost, *post_fields)
+        comment_fields = ('id', 'user_id', 'post_id', 'message', 'created_timestamp', 'likes', 'dislikes',
+                          'rating_total')
+        comments = self.writer(PostUserComment, *comment_fields, 'finish_timestamp')
+        archived_comments = self.writer(ArchivedComment, *comment_fields)
+        votes = self.writer(Vote, 'user_id', 'post_id', 'comment_id', 'value')
+        newest = int(self.now.timestamp())
+        oldest = newest - options['days'] * 24 * 60 * 60
+
+        for game in range(options['games']):
+            game_id = self.game_start + game
+            post_count = max(1, self.skewed_count(options['posts_per_game']))
+            # Посты игры от новых к старым, первые HOT_POSTS_PER_GAME остаются в основной таблице
+            for number, date in enumerate(sorted((self.random.randint(oldest, newest) for _ in range(post_count)),
+                                                 reverse=True)):
+                hot = number < HOT_POSTS_PER_GAME
+                post_id = self.post_id
+                self.post_id += 1
+                post_votes = self.votes(self.skewed_count(options['votes_per_post']))
+                likes = sum(value == Vote.LIKE for _, value in post_votes)
+                dislikes = len(post_votes) - likes
+                comment_count = self.skewed_count(options['comments_per_post'])
+                created = datetime.fromtimestamp(date, tz=self.now.tzinfo)
+                image = (self.media('posts_images', f'synthetic_{post_id}')
+                         if hot and self.random.random() < options['post_image_ratio'] else '')
+                row = (post_id, game_id, f'synthetic-{post_id}', self.titles[post_id % TEXT_POOL_SIZE], 'synthetic',
+                       date, f'https://store.steampowered.com/news/{post_id}', self.contents[post_id % TEXT_POOL_SIZE],
+                       created, likes, dislikes, likes - dislikes, comment_count, image)
+                if hot:
+                    posts.add(*row, hot_score(likes - dislikes, date))
+                    for user_id, value in post_votes:
+                        votes.add(user_id, post_id, None, value)
+                else:
+                    archived_posts.add(*row)
+                for _ in range(comment_count):
+                    self.add_comment(post_id, created, hot, comments if hot else archived_comments, votes)
+            games.add(game_id, f'Synthetic Game {game_id}', self.media('games_images', f'synthetic_{game_id}'),
+                      self.words(30), APPID_OFFSET + game_id, post_count, subscriber_counts[game])
+            if (game + 1) % 100 == 0:
+                self.log(f'Игры: {game + 1}, посты: {self.post_id - self.post_start}')
+
+        for writer in (games, posts, archived_posts, comments, archived_comments, votes):
+            writer.flush()
+            self.log(f'{writer.model._meta.db_table}: {writer.written}')
+
+    def add_comment(self, post_id, post_created, hot, writer, votes):
+        comment_id = self.comment_id
+        self.comment_id += 1
+        user_id = self.pick(self.user_weights, self.user_start)
+        comment_votes = self.votes(self.skewed_count(self.options['votes_per_comment']))
+        likes = sum(value == Vote.LIKE for _, value in comment_votes)
+        dislikes = len(comment_votes) - likes
+        self.karma[user_id - self.user_start] += likes - dislikes
+        created = post_created + timedelta(minutes=self.random.randint(1, 60 * 24 * 7))
+        row = (comment_id, user_id, post_id, self.messages[comment_id % TEXT_POOL_SIZE], created, likes, dislikes,
+               likes - dislikes)
+        if hot:
+            # Как в PostUserComment.save: удалить комментарий можно в течение 5 минут
+            writer.add(*row, created + timedelta(minutes=5))
+            for voter_id, value in comment_votes:
+                votes.add(voter_id, None, comment_id, value)
+        else:
+            writer.add(*row)
+
+    def generate_users(self):
+        users = self.writer(User, 'id', 'username', 'email', 'password', 'check_email', 'karma', 'digest_post_id',
+                            'avatar', 'date_joined')
+        # Все синтетические пользователи с одним паролем, хэш считается один раз
+        password = make_password('synthetic')
+        for user in range(self.options['users']):
+            user_id = self.user_start + user
+            avatar = (self.media('users_images', f'synthetic_{user_id}')
+                      if self.random.random() < self.options['avatar_ratio'] else '')
+            # Дайджест не должен разослать всем синтетическим пользователям уже существующие посты
+            users.add(user_id, f'synthetic_{user_id}', f'synthetic_{user_id}@example.com', password, True,
+                      self.karma[user], self.post_id - 1, avatar, self.now)
+        users.flush()
+        self.log(f'{User._meta.db_table}: {users.written}')
+
+    def reset_sequences(self):
+        # id задавались явно, последовательности сдвигаются за последний выданный id (у постов и комментариев -
+        # с учётом архива, который делит с ними id)
+        with connection.cursor() as cursor:
+            for model, last_id in ((User, self.user_start + self.options['users'] - 1),
+                                   (GameModel, self.game_start + self.options['games'] - 1),
+                                   (GameNewsPost, self.post_id - 1),
+                                   (PostUserComment, self.comment_id - 1)):
+                table = model._meta.db_table
+                cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                               f"GREATEST((SELECT max(id) FROM {table}), %s))", [last_id])
@@ -0,0 +1,272 @@
+import json
+import random
+import statistics
+import threading
+import time
+from collections import Counter
+from importlib import import_module
+from urllib.parse import urlencode
+
+import urllib3
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from news.management.commands.benchmark import WORDS, percentile
+from news.models import GameModel, GameNewsPost, PostUserComment, Subscription
+from news.views import NewsFeedView, NewsPostDetailView, OurLibraryListView
+from users.models import User
+
+# Префикс имён пользователей нагрузочного теста, подготовка переиспользует их между запусками
+USER_PREFIX = 'load_user_'
+# Сколько страниц лент и списков открывают анонимные посетители
+BROWSE_PAGES = 3
+
+
+class VirtualUser:
+    """
+    Посетитель: свои cookie (сессия и csrf)
+    Лимиты на пользователя считаются по каждому посетителю, лимиты по IP - по адресу нагрузочного теста,
+    если только тестовый сервер не запущен с RATE_LIMIT_IP_HEADER: тогда посетитель передаёт в нём свой адрес
+    """
+
+    def __init__(self, number, seed, session_key=None):
+        self.random = random.Random(seed * 100003 + number)
+        self.csrf_token = get_random_string(32)
+        cookies = {settings.CSRF_COOKIE_NAME: self.csrf_token}
+        if session_key:
+            cookies[settings.SESSION_COOKIE_NAME] = session_key
+        self.headers = {'Cookie': '; '.join(f'{name}={value}' for name, value in cookies.items())}
+        if settings.RATE_LIMIT_IP_HEADER:
+            # Имя заголовка из META (HTTP_X_REAL_IP) -> X-Real-Ip
+            header = settings.RATE_LIMIT_IP_HEADER.removeprefix('HTTP_').replace('_', '-').title()
+            self.headers[header] = f'10.{number // 65536 % 256}.{number // 256 % 256}.{number % 256}'
+        self.results = []
+
+
+class Command(BaseCommand):
+    """
+    Сценарии нагрузки на запущенный сервер (manage.py runserver, gunicorn, uvicorn) с локальными базой и redis:
+        browse      - анонимные посетители листают ленты, библиотеку, игры и посты
+        subs_feed   - пользователи с множеством подписок открывают ленту подписок
+        vote_storm  - все пользователи голосуют за один пост через add_voice
+        comments    - пост с множеством комментариев: чтение страниц комментариев и новые комментарии
+    Команда запускается с теми же настройками, что и сервер: пользователи, их подписки, сессии и комментарии
+    создаются прямо в базе (повторные запуски их переиспользуют), данные игр и постов - из generate_data
+    Ответ 429 (ограничение частоты) считается отдельно от ошибок, ошибки - соединение, 5xx и остальные 4xx
+    Все посетители приходят с одного адреса и делят между собой лимиты по IP, чтобы у каждого был свой лимит,
+    тестовый сервер и команду запускают с RATE_LIMIT_IP_HEADER=HTTP_X_REAL_IP (только на тестовом стенде:
+    без прокси, перезаписывающего заголовок, так лимиты по IP обходит любой клиент)
+    """
+    help = 'Нагрузочные сценарии против запущенного сервера: p50/p95/p99, пропускная способность и доля ошибок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://localhost:8000', help='Адрес запущенного сервера')
+        parser.add_argument('--scenario', action='append', choices=('browse', 'subs_feed', 'vote_storm', 'comments'),
+                            help='Сценарий (можно несколько раз), по умолчанию - все по очереди')
+        parser.add_argument('--users', type=int, default=20, help='Одновременных посетителей')
+        parser.add_argument('--duration', type=float, default=30, help='Длительность каждого сценария, секунд')
+        parser.add_argument('--warmup', type=float, default=3,
+                            help='Первые секунды сценария не входят в статистику')
+        parser.add_argument('--think', type=float, default=0,
+                            help='Пауза посетителя между запросами, секунд (случайная от 0 до удвоенной)')
+        parser.add_argument('--timeout', type=float, default=30, help='Таймаут запроса, секунд')
+        parser.add_argument('--subscriptions', type=int, default=300,
+                            help='Подписок у каждого пользователя сценария subs_feed')
+        parser.add_argument('--comments', type=int, default=500, help='Комментариев у поста сценариев comments')
+        parser.add_argument('--seed', type=int, default=1, help='Зерно выбора страниц и действий посетителей')
+        parser.add_argument('--output', help='Файл для результатов в JSON')
+
+    def handle(self, *args, **options):
+        self.base_url = options['base_url'].rstrip('/')
+        self.think = options['think']
+        games = list(GameModel.objects.order_by('-post_count', 'id').values_list('id', flat=True)[:1000])
+        posts = list(GameNewsPost.objects.order_by('-id').values_list('id', flat=True)[:1000])
+        if not games or not posts:
+            raise CommandError('В базе нет игр или постов, сначала заполните её командой generate_data')
+        self.games, self.posts = games, posts
+        self.pages = {
+            'feed': max(1, min(BROWSE_PAGES, len(posts) // NewsFeedView.paginate_by)),
+            'library': max(1, min(BROWSE_PAGES, len(games) // OurLibraryListView.paginate_by)),
+            'subs_feed': BROWSE_PAGES,
+        }
+        # Пост сценариев vote_storm и comments - самый новый
+        self.target = posts[0]
+        self.stdout.write('Подготовка пользователей, подписок и комментариев...')
+        session_keys = self.prepare(options['users'], options['subscriptions'], options['comments'])
+        comments = PostUserComment.objects.filter(post_id=self.target).count()
+        self.pages['post_detail'] = max(1, min(BROWSE_PAGES, comments // NewsPostDetailView.paginate_by))
+        self.stdout.write('Подготовка завершена, убедитесь что сервер запущен с той же базой')
+
+        http = urllib3.PoolManager(maxsize=options['users'], block=True, timeout=options['timeout'])
+        report = {
+            'meta': {
+                'started_at': timezone.now().isoformat(),
+                'base_url': self.base_url,
+                'users': options['users'],
+                'duration': options['duration'],
+                'warmup': options['warmup'],
+                'think': self.think,
+                'seed': options['seed'],
+            },
+            'results': {},
+        }
+        for name in options['scenario'] or ('browse', 'subs_feed', 'vote_storm', 'comments'):
+            anonymous = name == 'browse'
+            users = [VirtualUser(number, options['seed'], None if anonymous else session_keys[number])
+                     for number in range(options['users'])]
+            result = self.run(http, name, users, options['duration'], options['warmup'])
+            report['results'][name] = result
+            self.print_result(name, result)
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(report, file, indent=2, ensure_ascii=False)
+            self.stdout.write(self.style.SUCCESS(f'Результаты сохранены в {options["output"]}'))
+
+    def prepare(self, count, subscriptions, comments):
+        """
+        Пользователи с подтверждённой почтой, подписками на самые крупные игры и открытыми сессиями,
+        у целевого поста - не меньше comments комментариев
+        Возвращает ключи сессий пользователей по порядку
+        """
+        names = [f'{USER_PREFIX}{number}' for number in range(count)]
+        existing = set(User.objects.filter(username__in=names).values_list('username', flat=True))
+        User.objects.bulk_create([
+            User(username=name, email=f'{name}@example.com', check_email=True, avatar='users_images/load.jpg')
+            for name in names if name not in existing
+        ])
+        by_name = {user.username: user for user in User.objects.filter(username__in=names)}
+        users = [by_name[name] for name in names]
+        Subscription.objects.bulk_create([
+            Subscription(user=user, game_id=game_id) for user in users for game_id in self.games[:subscriptions]
+        ], ignore_conflicts=True, batch_size=5000)
+        cache.delete_many([Subscription.cache_key(user.id) for user in users])
+
+        missing = comments - PostUserComment.objects.filter(post_id=self.target).count()
+        if missing > 0:
+            PostUserComment.objects.bulk_create([
+                PostUserComment(user=users[number % len(users)], post_id=self.target,
+                                message=' '.join(random.choices(WORDS, k=30)), finish_timestamp=timezone.now())
+                for number in range(missing)
+            ], batch_size=5000)
+            GameNewsPost.objects.filter(id=self.target).update(comment_count=F('comment_count') + missing)
+
+        # Сессии создаются так же, как при входе на сайт (django.contrib.auth.login), без формы входа
+        session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        session_keys = []
+        for user in users:
+            session = session_store()
+            session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+            session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+            session_keys.append(session.session_key)
+        return session_keys
+
+    def page(self, vu, url, pages):
+        number = vu.random.randint(1, pages)
+        return url if number == 1 else f'{url}?page={number}'
+
+    def next_request(self, name, vu):
+        # (шаг, метод, адрес, тело формы) - следующий запрос посетителя в сценарии
+        rand = vu.random
+        if name == 'browse':
+            step = rand.choices(('feed', 'hot_feed', 'library', 'game_detail', 'post_detail'),
+                                weights=(40, 15, 15, 15, 15))[0]
+            if step == 'feed':
+                return step, 'GET', self.page(vu, reverse('news:feed'), self.pages['feed']), None
+            if step == 'hot_feed':
+                return step, 'GET', self.page(vu, reverse('news:hot_feed'), self.pages['feed']), None
+            if step == 'library':
+                return step, 'GET', self.page(vu, reverse('news:library'), self.pages['library']), None
+            if step == 'game_detail':
+                return step, 'GET', reverse('news:game_detail', kwargs={'pk': rand.choice(self.games)}), None
+            return step, 'GET', reverse('news:post_detail', kwargs={'pk': rand.choice(self.posts)}), None
+        if name == 'subs_feed':
+            return 'subs_feed', 'GET', self.page(vu, reverse('news:subs_feed'), self.pages['subs_feed']), None
+        if name == 'vote_storm':
+            url = reverse('news:add_voice', kwargs={'object_type': 'post', 'object_id': self.target,
+                                                    'voice_type': rand.choice(('likes', 'dislikes'))})
+            return 'add_voice', 'GET', url, None
+        # comments: в основном чтение страниц комментариев, каждый десятый запрос - новый комментарий
+        if rand.random() < 0.1:
+            return ('write_comment', 'POST', reverse('news:write_comment', kwargs={'post_id': self.target}),
+                    {'message': ' '.join(rand.choices(WORDS, k=20))})
+        return 'post_detail', 'GET', self.page(vu, reverse('news:post_detail', kwargs={'pk': self.target}),
+                                               self.pages['post_detail']), None
+
+    def visit(self, http, name, vu, stop_at, measure_from):
+        while time.perf_counter() < stop_at:
+            step, method, url, data = self.next_request(name, vu)
+            headers = dict(vu.headers, Referer=self.base_url + url)
+            body = None
+            if data is not None:
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+                headers['X-CSRFToken'] = vu.csrf_token
+                body = urlencode(data)
+            start = time.perf_counter()
+            try:
+                # Перенаправления (после голоса и комментария) не выполняются, замеряется сам запрос
+                status = http.request(method, self.base_url + url, body=body, headers=headers,
+                                      redirect=False, retries=False).status
+            except urllib3.exceptions.HTTPError:
+                status = 'error'
+            if start >= measure_from:
+                vu.results.append((step, time.perf_counter() - start, status))
+            if self.think:
+                time.sleep(vu.random.uniform(0, self.think * 2))
+
+    def run(self, http, name, users, duration, warmup):
+        self.stdout.write(f'{name}: {len(users)} посетителей, {duration:g} с...')
+        measure_from = time.perf_counter() + warmup
+        stop_at = measure_from + duration
+        threads = [threading.Thread(target=self.visit, args=(http, name, vu, stop_at, measure_from))
+                   for vu in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results = [result for vu in users for result in vu.results]
+        summary = self.summary(results, duration)
+        summary['steps'] = {
+            step: self.summary([result for result in results if result[0] == step], duration)
+            for step in sorted({result[0] for result in results})
+        }
+        return summary
+
+    @staticmethod
+    def summary(results, duration):
+        # Ошибки - всё, кроме успешных ответов, перенаправлений и 429
+        statuses = Counter(str(status) for _, _, status in results)
+        latencies = [latency for _, latency, _ in results]
+        errors = sum(count for status, count in statuses.items()
+                     if status != '429' and (status == 'error' or int(status) >= 400))
+        if not results:
+            return {'requests': 0, 'statuses': {}}
+        return {
+            'requests': len(results),
+            'throughput_rps': round(len(results) / duration, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+            'mean_ms': round(statistics.mean(latencies) * 1000, 1),
+            'error_rate': round(errors / len(results), 4),
+            'limited_rate': round(statuses['429'] / len(results), 4),
+            'statuses': dict(sorted(statuses.items())),
+        }
+
+    def print_result(self, name, result):
+        if not result['requests']:
+            self.stdout.write(self.style.ERROR(f'{name}: нет запросов'))
+            return
+        for step, summary in [(name, result)] + [(f'  {step}', summary) for step, summary in result['steps'].items()]:
+            line = (f'{step}: {summary["requests"]} запросов, {summary["throughput_rps"]} в секунду, '
+                    f'p50 {summary["p50_ms"]} мс, p95 {summary["p95_ms"]} мс, p99 {summary["p99_ms"]} мс, '
+                    f'ошибок {summary["error_rate"]:.1%}, 429 {summary["limited_rate"]:.1%}')
+            self.stdout.write(self.style.ERROR(line) if summary['error_rate'] else line)
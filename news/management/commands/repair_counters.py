@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from news.models import (ArchivedComment, ArchivedNewsPost, GameModel,
+                         GameNewsPost, PostUserComment, Subscription)
+
+
+def count_of(model, field):
+    # Количество строк model, ссылающихся полем field на текущую строку внешнего запроса
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef('pk')}).values(field).annotate(count=Count('*')).values('count')
+    ), 0)
+
+
+class Command(BaseCommand):
+    """
+    Пересчёт денормализованных счётчиков: комментариев у постов (и архивных), постов и подписчиков у игр
+    Счётчики поддерживаются при каждом изменении, команда нужна после ручных правок базы и каскадных удалений
+    Пересчёт идёт пачками по id, каждая пачка - один UPDATE только тех строк, где счётчик разошёлся
+    """
+    help = 'Пересчитывает счётчики комментариев, постов и подписчиков'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Размер пачки по id')
+
+    def handle(self, *args, **options):
+        # Модель и её счётчики: поле -> выражение с настоящим значением
+        counters = [
+            (GameNewsPost, {'comment_count': count_of(PostUserComment, 'post')}),
+            (ArchivedNewsPost, {'comment_count': count_of(ArchivedComment, 'post')}),
+            (GameModel, {
+                'post_count': count_of(GameNewsPost, 'game') + count_of(ArchivedNewsPost, 'game'),
+                'subscriber_count': count_of(Subscription, 'game'),
+            }),
+        ]
+        for model, fields in counters:
+            fixed = self.repair(model, fields, options['batch_size'])
+            self.stdout.write(f'{model._meta.verbose_name_plural}: исправлено {fixed}')
+        self.stdout.write(self.style.SUCCESS('Счётчики пересчитаны'))
+
+    @staticmethod
+    def repair(model, fields, batch_size):
+        differs = Q()
+        for field, actual in fields.items():
+            differs |= ~Q(**{field: actual})
+        max_id = model.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        fixed = 0
+        for start in range(0, max_id + 1, batch_size):
+            fixed += model.objects.filter(differs, id__gte=start, id__lt=start + batch_size).update(**fields)
+        return fixed
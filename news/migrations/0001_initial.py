@@ -0,0 +1,65 @@
+# Generated by Django 4.2.2 on 2026-10-19 17:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(unique=True, verbose_name='Название')),
+                ('image', models.ImageField(upload_to='games_images', verbose_name='Изображение')),
+                ('description', models.TextField(verbose_name='Описание')),
+                ('full_description', models.TextField(blank=True, verbose_name='Полное описание')),
+                ('steam_appid', models.PositiveIntegerField(unique=True, verbose_name='Идентификатор Steam')),
+                ('metacritic', models.JSONField(default=dict, verbose_name='Данные metacritic')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GameNewsPost',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gid', models.CharField(verbose_name='Идентификатор новостей Steam')),
+                ('title', models.TextField(max_length=256, verbose_name='Заголовок')),
+                ('author', models.CharField(max_length=128, verbose_name='Автор')),
+                ('date', models.PositiveIntegerField(verbose_name='Дата')),
+                ('source_url', models.URLField(verbose_name='Источник')),
+                ('content', models.TextField(verbose_name='Наполнение')),
+                ('created_timestamp', models.DateTimeField(verbose_name='Дата публикации')),
+                ('rating', models.JSONField(default=dict)),
+                ('post_image', models.ImageField(blank=True, upload_to='posts_images', verbose_name='Обложка')),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='news.gamemodel', verbose_name='Игра')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Subscription',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='news.gamemodel')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PostUserComment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_timestamp', models.DateTimeField(auto_now_add=True, verbose_name='Время создания')),
+                ('finish_timestamp', models.DateTimeField(default=None, null=True, verbose_name='Возможность удалить ДО')),
+                ('message', models.TextField(max_length=512, verbose_name='Текст')),
+                ('rating', models.JSONField(default=dict, verbose_name='Рейтинговая система')),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='news.gamenewspost', verbose_name='Пост')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+        ),
+    ]
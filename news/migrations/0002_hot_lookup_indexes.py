@@ -0,0 +1,95 @@
+# Generated by Django 4.2.2 on 2026-10-19 17:20
+
+from django.db import migrations, models
+
+from rpg_agg.migration_operations import (AddIndexConcurrently,
+                                           drop_invalid_index)
+
+
+def add_unique_concurrently(model_name, table, columns, constraint):
+    """
+    Уникальное ограничение через CREATE UNIQUE INDEX CONCURRENTLY + ADD CONSTRAINT USING INDEX,
+    чтобы не блокировать запись в таблицу на время построения индекса
+    """
+    return migrations.SeparateDatabaseAndState(
+        database_operations=[
+            drop_invalid_index(constraint.name),
+            migrations.RunSQL(
+                sql=f'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {constraint.name} ON {table} ({columns});',
+                reverse_sql=f'DROP INDEX CONCURRENTLY IF EXISTS {constraint.name};',
+            ),
+            migrations.RunSQL(
+                sql=f'ALTER TABLE {table} ADD CONSTRAINT {constraint.name} UNIQUE USING INDEX {constraint.name};',
+                reverse_sql=f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {constraint.name};',
+            ),
+        ],
+        state_operations=[
+            migrations.AddConstraint(model_name=model_name, constraint=constraint),
+        ],
+    )
+
+
+class Migration(migrations.Migration):
+    # CONCURRENTLY не может выполняться внутри транзакции
+    atomic = False
+
+    dependencies = [
+        ('news', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='gamemodel',
+            options={'verbose_name': 'Игра', 'verbose_name_plural': 'Игры'},
+        ),
+        migrations.AlterModelOptions(
+            name='gamenewspost',
+            options={'verbose_name': 'Пост', 'verbose_name_plural': 'Посты'},
+        ),
+        AddIndexConcurrently(
+            model_name='gamenewspost',
+            index=models.Index(fields=['-date'], name='news_post_date_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='gamenewspost',
+            index=models.Index(fields=['game', '-date'], name='news_post_game_date_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='postusercomment',
+            index=models.Index(fields=['post', 'created_timestamp'], name='news_comment_post_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='postusercomment',
+            index=models.Index(fields=['user', '-created_timestamp'], name='news_comment_user_created_idx'),
+        ),
+        # Дубликаты постов (параллельные обновления новостей одной игры) удаляем, оставляя самый ранний,
+        # комментарии к дубликатам переносятся на него, одним запросом, чтобы это прошло в одной транзакции
+        migrations.RunSQL(
+            sql='WITH duplicates AS ('
+                '    SELECT a.id, min(b.id) AS keep_id FROM news_gamenewspost a JOIN news_gamenewspost b '
+                '    ON a.game_id = b.game_id AND a.gid = b.gid AND a.id > b.id GROUP BY a.id'
+                '), moved AS ('
+                '    UPDATE news_postusercomment c SET post_id = d.keep_id FROM duplicates d WHERE c.post_id = d.id'
+                ') '
+                'DELETE FROM news_gamenewspost p USING duplicates d WHERE p.id = d.id;',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        # Возможные дубликаты подписок (до появления ограничения) удаляем, оставляя самую раннюю
+        migrations.RunSQL(
+            sql='DELETE FROM news_subscription a USING news_subscription b '
+                'WHERE a.user_id = b.user_id AND a.game_id = b.game_id AND a.id > b.id;',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        add_unique_concurrently(
+            model_name='gamenewspost',
+            table='news_gamenewspost',
+            columns='game_id, gid',
+            constraint=models.UniqueConstraint(fields=('game', 'gid'), name='news_post_game_gid_uniq'),
+        ),
+        add_unique_concurrently(
+            model_name='subscription',
+            table='news_subscription',
+            columns='user_id, game_id',
+            constraint=models.UniqueConstraint(fields=('user', 'game'), name='news_subscription_user_game_uniq'),
+        ),
+    ]
@@ -0,0 +1,105 @@
+# Generated by Django 4.2.2 on 2026-10-19 17:23
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+from rpg_agg.migration_operations import AddIndexConcurrently
+
+# Размер пачки при заполнении search_vector у уже существующих строк
+BATCH_SIZE = 5000
+
+
+def search_trigger_sql(table, weighted_fields):
+    """
+    Функция-триггер, пересчитывающая search_vector при вставке и изменении индексируемых полей
+    Каждое поле индексируется в русской и английской конфигурации со своим весом (A - заголовок, B - текст)
+    """
+    vector = ' || '.join(
+        f"setweight(to_tsvector('pg_catalog.{config}', coalesce(NEW.{field}, '')), '{weight}')"
+        for field, weight in weighted_fields
+        for config in ('russian', 'english')
+    )
+    columns = ', '.join(field for field, _ in weighted_fields)
+    return f"""
+        CREATE OR REPLACE FUNCTION {table}_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := {vector};
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER {table}_search_vector_update
+            BEFORE INSERT OR UPDATE OF {columns} ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {table}_search_vector_update();
+    """
+
+
+def drop_search_trigger_sql(table):
+    return f"""
+        DROP TRIGGER IF EXISTS {table}_search_vector_update ON {table};
+        DROP FUNCTION IF EXISTS {table}_search_vector_update();
+    """
+
+
+def fill_search_vectors(apps, schema_editor):
+    # Заполняем вектор у существующих строк пачками по id, "пустое" обновление поля запускает триггер
+    # Миграция не атомарна, поэтому каждая пачка фиксируется отдельно и не держит блокировку на всю таблицу
+    with schema_editor.connection.cursor() as cursor:
+        for table, field in (('news_gamemodel', 'name'), ('news_gamenewspost', 'title')):
+            cursor.execute(f'SELECT coalesce(max(id), 0) FROM {table}')
+            max_id = cursor.fetchone()[0]
+            for start in range(0, max_id + 1, BATCH_SIZE):
+                cursor.execute(
+                    f'UPDATE {table} SET {field} = {field} WHERE id >= %s AND id < %s AND search_vector IS NULL',
+                    [start, start + BATCH_SIZE],
+                )
+
+
+class Migration(migrations.Migration):
+    # CONCURRENTLY не может выполняться внутри транзакции
+    atomic = False
+
+    dependencies = [
+        ('news', '0002_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='gamemodel',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='gamenewspost',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            sql=search_trigger_sql('news_gamemodel', (('name', 'A'), ('description', 'B'))),
+            reverse_sql=drop_search_trigger_sql('news_gamemodel'),
+        ),
+        migrations.RunSQL(
+            sql=search_trigger_sql('news_gamenewspost', (('title', 'A'), ('content', 'B'))),
+            reverse_sql=drop_search_trigger_sql('news_gamenewspost'),
+        ),
+        migrations.RunPython(fill_search_vectors, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='gamemodel',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='news_game_search_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='gamemodel',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='news_game_name_trgm_idx', opclasses=('gin_trgm_ops',)),
+        ),
+        AddIndexConcurrently(
+            model_name='gamenewspost',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='news_post_search_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='gamenewspost',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['title'], name='news_post_title_trgm_idx', opclasses=('gin_trgm_ops',)),
+        ),
+    ]
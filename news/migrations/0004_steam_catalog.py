@@ -0,0 +1,28 @@
+# Generated by Django 4.2.2 on 2026-10-19 17:24
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0003_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SteamApp',
+            fields=[
+                ('appid', models.PositiveIntegerField(primary_key=True, serialize=False, verbose_name='Идентификатор Steam')),
+                ('name', models.CharField(max_length=256, verbose_name='Название')),
+                ('type', models.PositiveSmallIntegerField(choices=[(1, 'game'), (2, 'dlc'), (3, 'software'), (4, 'video'), (5, 'hardware')], default=1, verbose_name='Тип')),
+            ],
+            options={
+                'verbose_name': 'Приложение Steam',
+                'verbose_name_plural': 'Приложения Steam',
+                'indexes': [models.Index(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('name'), name='text_pattern_ops'), name='news_steamapp_name_prefix_idx'), django.contrib.postgres.indexes.GinIndex(fields=['name'], name='news_steamapp_name_trgm_idx', opclasses=('gin_trgm_ops',))],
+            },
+        ),
+    ]
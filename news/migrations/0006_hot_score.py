@@ -0,0 +1,45 @@
+# Generated by Django 4.2.2 on 2026-10-19 17:33
+
+from django.db import migrations, models
+
+from rpg_agg.migration_operations import AddIndexConcurrently
+
+# Размер пачки при заполнении hot_score у уже существующих постов
+BATCH_SIZE = 5000
+
+
+def fill_hot_scores(apps, schema_editor):
+    # Та же формула, что и в news.models.hot_score, пачками по id, каждая пачка фиксируется отдельно
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT coalesce(max(id), 0) FROM news_gamenewspost')
+        max_id = cursor.fetchone()[0]
+        for start in range(0, max_id + 1, BATCH_SIZE):
+            cursor.execute(
+                "UPDATE news_gamenewspost SET hot_score = "
+                "sign(coalesce((rating ->> 'total')::int, 0)) "
+                "* log(greatest(abs(coalesce((rating ->> 'total')::int, 0)), 1)) + date / 45000.0 "
+                "WHERE id >= %s AND id < %s",
+                [start, start + BATCH_SIZE],
+            )
+
+
+class Migration(migrations.Migration):
+    # CONCURRENTLY не может выполняться внутри транзакции
+    atomic = False
+
+    dependencies = [
+        ('news', '0005_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gamenewspost',
+            name='hot_score',
+            field=models.FloatField(default=0, verbose_name='Оценка популярности'),
+        ),
+        migrations.RunPython(fill_hot_scores, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='gamenewspost',
+            index=models.Index(fields=['-hot_score', '-id'], name='news_post_hot_idx'),
+        ),
+    ]
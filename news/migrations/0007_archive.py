@@ -0,0 +1,56 @@
+# Generated by Django 4.2.2 on 2026-10-19 17:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('news', '0006_hot_score'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedNewsPost',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('gid', models.CharField(verbose_name='Идентификатор новостей Steam')),
+                ('title', models.TextField(max_length=256, verbose_name='Заголовок')),
+                ('author', models.CharField(max_length=128, verbose_name='Автор')),
+                ('date', models.PositiveIntegerField(verbose_name='Дата')),
+                ('source_url', models.URLField(verbose_name='Источник')),
+                ('content', models.TextField(verbose_name='Наполнение')),
+                ('created_timestamp', models.DateTimeField(verbose_name='Дата публикации')),
+                ('rating', models.JSONField(default=dict)),
+                ('post_image', models.ImageField(blank=True, upload_to='posts_images', verbose_name='Обложка')),
+                ('archived_at', models.DateTimeField(auto_now_add=True, verbose_name='Перенесён в архив')),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='news.gamemodel', verbose_name='Игра')),
+            ],
+            options={
+                'verbose_name': 'Архивный пост',
+                'verbose_name_plural': 'Архивные посты',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedComment',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('created_timestamp', models.DateTimeField(verbose_name='Время создания')),
+                ('message', models.TextField(max_length=512, verbose_name='Текст')),
+                ('rating', models.JSONField(default=dict, verbose_name='Рейтинговая система')),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='news.archivednewspost', verbose_name='Пост')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='archivednewspost',
+            constraint=models.UniqueConstraint(fields=('game', 'gid'), name='news_archived_post_game_gid_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedcomment',
+            index=models.Index(fields=['post', 'created_timestamp'], name='news_archived_comment_post_idx'),
+        ),
+    ]
@@ -0,0 +1,178 @@
+# Generated by Django 4.2.2 on 2026-10-19 17:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Размер пачки при переносе голосов из json списков
+BATCH_SIZE = 2000
+
+# Модели с рейтингом и поле ссылки на них в Vote (у архивных моделей голосов нет, только счётчики)
+RATED_MODELS = (
+    ('gamenewspost', 'post'),
+    ('postusercomment', 'comment'),
+    ('archivednewspost', None),
+    ('archivedcomment', None),
+)
+
+
+def move_votes(apps, schema_editor):
+    """
+    Переносит имена проголосовавших из rating['likes'] / rating['dislikes'] в таблицу Vote и заполняет счётчики
+    Учитываются только существующие пользователи, каждый один раз (лайк важнее, если имя оказалось в обоих списках)
+    Миграция не атомарна, каждая пачка по id фиксируется отдельно
+    """
+    User = apps.get_model('users', 'User')
+    Vote = apps.get_model('news', 'Vote')
+    for model_name, target in RATED_MODELS:
+        model = apps.get_model('news', model_name)
+        max_id = model.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        for start in range(0, max_id + 1, BATCH_SIZE):
+            rows = list(model.objects.filter(id__gte=start, id__lt=start + BATCH_SIZE).values_list('id', 'rating'))
+            usernames = {name for _, rating in rows for voice in ('likes', 'dislikes') for name in rating.get(voice, [])}
+            user_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+            votes, objects = [], []
+            for object_id, rating in rows:
+                voters, counters = set(), {}
+                for voice, value in (('likes', 1), ('dislikes', -1)):
+                    names = [name for name in dict.fromkeys(rating.get(voice, [])) if name in user_ids and name not in voters]
+                    voters.update(names)
+                    counters[voice] = len(names)
+                    if target:
+                        votes += [Vote(user_id=user_ids[name], value=value, **{f'{target}_id': object_id}) for name in names]
+                objects.append(model(id=object_id, rating_total=counters['likes'] - counters['dislikes'], **counters))
+            Vote.objects.bulk_create(votes, batch_size=BATCH_SIZE)
+            model.objects.bulk_update(objects, ('likes', 'dislikes', 'rating_total'), batch_size=BATCH_SIZE)
+
+
+def restore_rating_lists(apps, schema_editor):
+    # Обратно: списки имён из Vote, у архивных моделей списки пустые, сохраняется только total
+    Vote = apps.get_model('news', 'Vote')
+    for model_name, target in RATED_MODELS:
+        model = apps.get_model('news', model_name)
+        max_id = model.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        for start in range(0, max_id + 1, BATCH_SIZE):
+            objects = {object_id: model(id=object_id, rating={'total': total, 'likes': [], 'dislikes': []})
+                       for object_id, total in model.objects.filter(id__gte=start, id__lt=start + BATCH_SIZE)
+                       .values_list('id', 'rating_total')}
+            if target:
+                votes = Vote.objects.filter(**{f'{target}_id__in': objects}).values_list(f'{target}_id', 'user__username', 'value')
+                for object_id, username, value in votes:
+                    objects[object_id].rating['likes' if value == 1 else 'dislikes'].append(username)
+            model.objects.bulk_update(objects.values(), ('rating',), batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+    # Перенос голосов идёт пачками, каждая в своей транзакции
+    atomic = False
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('news', '0007_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedcomment',
+            name='dislikes',
+            field=models.PositiveIntegerField(default=0, verbose_name='Дизлайки'),
+        ),
+        migrations.AddField(
+            model_name='archivedcomment',
+            name='likes',
+            field=models.PositiveIntegerField(default=0, verbose_name='Лайки'),
+        ),
+        migrations.AddField(
+            model_name='archivedcomment',
+            name='rating_total',
+            field=models.IntegerField(default=0, verbose_name='Рейтинг'),
+        ),
+        migrations.AddField(
+            model_name='archivednewspost',
+            name='dislikes',
+            field=models.PositiveIntegerField(default=0, verbose_name='Дизлайки'),
+        ),
+        migrations.AddField(
+            model_name='archivednewspost',
+            name='likes',
+            field=models.PositiveIntegerField(default=0, verbose_name='Лайки'),
+        ),
+        migrations.AddField(
+            model_name='archivednewspost',
+            name='rating_total',
+            field=models.IntegerField(default=0, verbose_name='Рейтинг'),
+        ),
+        migrations.AddField(
+            model_name='gamenewspost',
+            name='dislikes',
+            field=models.PositiveIntegerField(default=0, verbose_name='Дизлайки'),
+        ),
+        migrations.AddField(
+            model_name='gamenewspost',
+            name='likes',
+            field=models.PositiveIntegerField(default=0, verbose_name='Лайки'),
+        ),
+        migrations.AddField(
+            model_name='gamenewspost',
+            name='rating_total',
+            field=models.IntegerField(default=0, verbose_name='Рейтинг'),
+        ),
+        migrations.AddField(
+            model_name='postusercomment',
+            name='dislikes',
+            field=models.PositiveIntegerField(default=0, verbose_name='Дизлайки'),
+        ),
+        migrations.AddField(
+            model_name='postusercomment',
+            name='likes',
+            field=models.PositiveIntegerField(default=0, verbose_name='Лайки'),
+        ),
+        migrations.AddField(
+            model_name='postusercomment',
+            name='rating_total',
+            field=models.IntegerField(default=0, verbose_name='Рейтинг'),
+        ),
+        migrations.CreateModel(
+            name='Vote',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.SmallIntegerField(choices=[(1, 'Лайк'), (-1, 'Дизлайк')], verbose_name='Голос')),
+                ('comment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='news.postusercomment', verbose_name='Комментарий')),
+                ('post', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='news.gamenewspost', verbose_name='Пост')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Голос',
+                'verbose_name_plural': 'Голоса',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='vote',
+            constraint=models.UniqueConstraint(condition=models.Q(('post__isnull', False)), fields=('user', 'post'), name='news_vote_user_post_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='vote',
+            constraint=models.UniqueConstraint(condition=models.Q(('comment__isnull', False)), fields=('user', 'comment'), name='news_vote_user_comment_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='vote',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('comment__isnull', True), ('post__isnull', False)), models.Q(('comment__isnull', False), ('post__isnull', True)), _connector='OR'), name='news_vote_one_target'),
+        ),
+        migrations.RunPython(move_votes, restore_rating_lists),
+        migrations.RemoveField(
+            model_name='archivedcomment',
+            name='rating',
+        ),
+        migrations.RemoveField(
+            model_name='archivednewspost',
+            name='rating',
+        ),
+        migrations.RemoveField(
+            model_name='gamenewspost',
+            name='rating',
+        ),
+        migrations.RemoveField(
+            model_name='postusercomment',
+            name='rating',
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 4.2.2 on 2026-10-19 17:44
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+# Размер пачки при заполнении счётчиков
+BATCH_SIZE = 5000
+
+
+def fill_counters(apps, schema_editor):
+    # Заполняем счётчики у существующих строк пачками по id, как и команда repair_counters
+    def count_of(model_name, field):
+        model = apps.get_model('news', model_name)
+        return Coalesce(Subquery(
+            model.objects.filter(**{field: OuterRef('pk')}).values(field).annotate(count=Count('*')).values('count')
+        ), 0)
+
+    counters = [
+        ('GameNewsPost', {'comment_count': count_of('PostUserComment', 'post')}),
+        ('ArchivedNewsPost', {'comment_count': count_of('ArchivedComment', 'post')}),
+        ('GameModel', {
+            'post_count': count_of('GameNewsPost', 'game') + count_of('ArchivedNewsPost', 'game'),
+            'subscriber_count': count_of('Subscription', 'game'),
+        }),
+    ]
+    for model_name, fields in counters:
+        model = apps.get_model('news', model_name)
+        max_id = model.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        for start in range(0, max_id + 1, BATCH_SIZE):
+            model.objects.filter(id__gte=start, id__lt=start + BATCH_SIZE).update(**fields)
+
+
+class Migration(migrations.Migration):
+    # Заполнение идёт пачками, каждая в своей транзакции
+    atomic = False
+
+    dependencies = [
+        ('news', '0008_votes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivednewspost',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Комментариев'),
+        ),
+        migrations.AddField(
+            model_name='gamemodel',
+            name='post_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Постов (включая архив)'),
+        ),
+        migrations.AddField(
+            model_name='gamemodel',
+            name='subscriber_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Подписчиков'),
+        ),
+        migrations.AddField(
+            model_name='gamenewspost',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Комментариев'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -1,26 +1,142 @@
+import math
 import os
 from datetime import timedelta
 
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVectorField,
+                                            TrigramSimilarity,
+                                            TrigramWordSimilarity)
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
+from django.db.models import (BooleanField, ExpressionWrapper, F, Q, Value,
+                              Window)
+from django.db.models.functions import (Abs, Greatest, Log, RowNumber, Sign,
+                                        Upper)
+from django.utils import timezone
 
 from users.models import User
 
+# Конфигурации полнотекстового поиска, контент у нас и на русском, и на английском
+SEARCH_CONFIGS = ('russian', 'english')
+
+
+# Сколько последних постов каждой игры хранится в основной таблице, более старые переносятся в архив
+HOT_POSTS_PER_GAME = 9
+
+# Через сколько секунд новизна поста перевешивает в 10 раз больший рейтинг (12.5 часов)
+HOT_SCORE_TIME_SCALE = 45000
+
+
+def hot_score(total, date):
+    """
+    Оценка для "горячей" ленты: логарифм рейтинга плюс время публикации
+    Новые посты получают оценку выше старых, поэтому относительное "затухание" со временем достигается без
+    пересчёта всех строк, оценка поста меняется только при голосовании
+    """
+    sign = (total > 0) - (total < 0)
+    return sign * math.log10(max(abs(total), 1)) + date / HOT_SCORE_TIME_SCALE
+
+
+# То же, что hot_score, но выражением для UPDATE в базе, total - выражение рейтинга
+def hot_score_expression(total):
+    return ExpressionWrapper(
+        Sign(total) * Log(10, Greatest(Abs(total), 1)) + F('date') / Value(float(HOT_SCORE_TIME_SCALE)),
+        output_field=models.FloatField(),
+    )
+
+
+# QuerySet с полнотекстовым поиском по search_vector и триграммным поиском (на случай опечаток) по trigram_field
+class SearchQuerySet(models.query.QuerySet):
+    trigram_field = None
+
+    def search(self, text):
+        # Запрос сразу в двух конфигурациях, websearch понимает "кавычки", OR и -исключения
+        query = SearchQuery(text, config=SEARCH_CONFIGS[0], search_type='websearch')
+        for config in SEARCH_CONFIGS[1:]:
+            query |= SearchQuery(text, config=config, search_type='websearch')
+        # Оба условия обслуживаются GIN индексами, поэтому фильтрация не сканирует таблицу целиком
+        return self.filter(
+            Q(search_vector=query) | Q(**{f'{self.trigram_field}__trigram_similar': text})
+        ).annotate(
+            rank=SearchRank(F('search_vector'), query),
+            similarity=TrigramSimilarity(self.trigram_field, text),
+        ).order_by('-rank', '-similarity')
+
+
+class GameQuerySet(SearchQuerySet):
+    trigram_field = 'name'
+
+
+class PostQuerySet(SearchQuerySet):
+    trigram_field = 'title'
+
+    # Пересчитать оценку "горячей" ленты одним UPDATE по рейтингу в базе, та же формула, что и в hot_score
+    def refresh_hot_scores(self):
+        return self.update(hot_score=hot_score_expression(F('rating_total')))
+
+    # Посты, не входящие в HOT_POSTS_PER_GAME последних постов своей игры
+    def outside_hot_limit(self):
+        return self.annotate(position=Window(
+            RowNumber(), partition_by=F('game_id'), order_by=(F('date').desc(), F('id').desc()),
+        )).filter(position__gt=HOT_POSTS_PER_GAME)
+
+    # Перенести посты вместе с комментариями в архив с теми же id, одной транзакцией, вставки и удаление пачками
+    # Возвращает количество перенесённых постов
+    def archive(self):
+        post_fields = [field.attname for field in ArchivedNewsPost._meta.concrete_fields if field.name != 'archived_at']
+        comment_fields = [field.attname for field in ArchivedComment._meta.concrete_fields]
+        with transaction.atomic():
+            posts = [ArchivedNewsPost(**row) for row in self.select_for_update().values(*post_fields)]
+            post_ids = [post.id for post in posts]
+            comments = [ArchivedComment(**row) for row in
+                        PostUserComment.objects.filter(post_id__in=post_ids).values(*comment_fields)]
+            ArchivedNewsPost.objects.bulk_create(posts, batch_size=500)
+            ArchivedComment.objects.bulk_create(comments, batch_size=500)
+            # Удаляем через queryset, а не post.delete(), чтобы обложки остались у архивных постов
+            PostUserComment.objects.filter(post_id__in=post_ids).delete()
+            GameNewsPost.objects.filter(id__in=post_ids).delete()
+        return len(post_ids)
+
+
+# Менеджер для моделей с поиском, search_vector нужен только базе данных, в python его не загружаем
+class SearchManager(models.Manager):
+    def get_queryset(self):
+        return super(SearchManager, self).get_queryset().defer('search_vector')
+
 
 class GameModel(models.Model):
+    objects = SearchManager.from_queryset(GameQuerySet)()
     name = models.CharField(verbose_name='Название', unique=True)
     image = models.ImageField(upload_to='games_images', verbose_name='Изображение')
     description = models.TextField(verbose_name='Описание')
     full_description = models.TextField(verbose_name='Полное описание', blank=True)
     steam_appid = models.PositiveIntegerField(unique=True, verbose_name='Идентификатор Steam')
     metacritic = models.JSONField(default=dict, verbose_name='Данные metacritic')
+    # Поисковый вектор по name и description, заполняется триггером в БД (см. миграцию 0003_search)
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Время последнего изменения страницы игры (сама игра и её список новостей), для условных GET запросов
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Изменено')
+    # Счётчики для карточек игр, меняются в тех же транзакциях, что и посты и подписки, пересчёт - repair_counters
+    post_count = models.PositiveIntegerField(default=0, verbose_name='Постов (включая архив)')
+    subscriber_count = models.PositiveIntegerField(default=0, verbose_name='Подписчиков')
 
-    class META:
+    class Meta:
         verbose_name = 'Игра'
         verbose_name_plural = 'Игры'
+        indexes = [
+            GinIndex(fields=('search_vector',), name='news_game_search_idx'),
+            GinIndex(fields=('name',), opclasses=('gin_trgm_ops',), name='news_game_name_trgm_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    # Отметить игру изменённой одним UPDATE, без загрузки и пересохранения всей строки, changes - другие изменения
+    @staticmethod
+    def touch(game_id, **changes):
+        GameModel.objects.filter(id=game_id).update(updated_at=timezone.now(), **changes)
+
     def delete(self, using=None, keep_parents=False):
         # При удалении объекта, удаляем его изображение
         os.remove(self.image.path)
@@ -28,6 +144,7 @@ class GameModel(models.Model):
 
 
 class GameNewsPost(models.Model):
+    objects = SearchManager.from_queryset(PostQuerySet)()
     game = models.ForeignKey(to=GameModel, on_delete=models.CASCADE, verbose_name='Игра')
     gid = models.CharField(verbose_name='Идентификатор новостей Steam')
     title = models.TextField(max_length=256, verbose_name='Заголовок')
@@ -36,17 +153,40 @@ class GameNewsPost(models.Model):
     source_url = models.URLField(verbose_name='Источник')
     content = models.TextField(verbose_name='Наполнение')
     created_timestamp = models.DateTimeField(verbose_name='Дата публикации')
-    rating = models.JSONField(default=dict)
+    # Счётчики голосов (сами голоса в Vote) и рейтинг = likes - dislikes
+    likes = models.PositiveIntegerField(default=0, verbose_name='Лайки')
+    dislikes = models.PositiveIntegerField(default=0, verbose_name='Дизлайки')
+    rating_total = models.IntegerField(default=0, verbose_name='Рейтинг')
     post_image = models.ImageField(upload_to='posts_images', blank=True, verbose_name='Обложка')
+    # Поисковый вектор по title и content, заполняется триггером в БД (см. миграцию 0003_search)
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Время последнего изменения страницы поста (пост, его рейтинг, комментарии и их рейтинг), для условных GET запросов
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Изменено')
+    # Оценка для "горячей" ленты, пересчитывается при каждом сохранении и голосовании, см. hot_score
+    hot_score = models.FloatField(default=0, verbose_name='Оценка популярности')
+    # Счётчик комментариев, меняется в тех же транзакциях, что и комментарии, пересчёт - repair_counters
+    comment_count = models.PositiveIntegerField(default=0, verbose_name='Комментариев')
 
-    class META:
+    class Meta:
         verbose_name = 'Пост'
         verbose_name_plural = 'Посты'
+        constraints = [
+            # Один и тот же пост steam (gid) не может дважды попасть к одной игре
+            models.UniqueConstraint(fields=('game', 'gid'), name='news_post_game_gid_uniq'),
+        ]
+        indexes = [
+            # Общая лента новостей, сортировка по дате
+            models.Index(fields=('-date',), name='news_post_date_idx'),
+            # Новости конкретной игры (страница игры, лента подписок, обновление новостей)
+            models.Index(fields=('game', '-date'), name='news_post_game_date_idx'),
+            # "Горячая" лента
+            models.Index(fields=('-hot_score', '-id'), name='news_post_hot_idx'),
+            GinIndex(fields=('search_vector',), name='news_post_search_idx'),
+            GinIndex(fields=('title',), opclasses=('gin_trgm_ops',), name='news_post_title_trgm_idx'),
+        ]
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        # Формирует рейтинг на основе длинны списков "лайк" и "дизлайк", в которых находятся имена пользователей
-        # Проголосовавших за тот или иной выбор
-        self.rating['total'] = len(self.rating['likes']) - len(self.rating['dislikes'])
+        self.hot_score = hot_score(self.rating_total, self.date)
         return super(GameNewsPost, self).save(force_insert=force_insert, force_update=force_update,
                                               using=using, update_fields=update_fields)
 
@@ -54,43 +194,313 @@ class GameNewsPost(models.Model):
         # Удаление обложки при удалении объекта
         if self.post_image:
             os.remove(self.post_image.path)
-        return super(GameNewsPost, self).delete(using=using, keep_parents=keep_parents)
+        with transaction.atomic():
+            result = super(GameNewsPost, self).delete(using=using, keep_parents=keep_parents)
+            if result[1].get(self._meta.label):
+                GameModel.touch(self.game_id, post_count=F('post_count') - 1)
+        return result
 
     def __str__(self):
         return f'{self.game.name} - {self.gid}'
 
+    # Отметить пост изменённым одним UPDATE, без загрузки и пересохранения всей строки, changes - другие изменения
+    @staticmethod
+    def touch(post_id, **changes):
+        GameNewsPost.objects.filter(id=post_id).update(updated_at=timezone.now(), **changes)
+
+    # Изменить счётчики голосов поста одним UPDATE вместе с рейтингом, оценкой "горячей" ленты и временем изменения
+    # Возвращает количество изменённых строк (0 - поста нет)
+    @staticmethod
+    def add_votes(post_id, likes, dislikes):
+        total = likes - dislikes
+        return GameNewsPost.objects.filter(id=post_id).update(
+            likes=F('likes') + likes,
+            dislikes=F('dislikes') + dislikes,
+            rating_total=F('rating_total') + total,
+            hot_score=hot_score_expression(F('rating_total') + total),
+            updated_at=timezone.now(),
+        )
+
+
+# Архив постов, выпавших из HOT_POSTS_PER_GAME последних постов игры (см. PostQuerySet.archive)
+# Пост переносится с тем же id, поэтому остаётся доступным по старой ссылке, а основная таблица, её индексы
+# и запросы ленты и страниц игр не растут вместе с историей
+class ArchivedNewsPost(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    game = models.ForeignKey(to=GameModel, on_delete=models.CASCADE, verbose_name='Игра')
+    gid = models.CharField(verbose_name='Идентификатор новостей Steam')
+    title = models.TextField(max_length=256, verbose_name='Заголовок')
+    author = models.CharField(max_length=128, verbose_name='Автор')
+    date = models.PositiveIntegerField(verbose_name='Дата')
+    source_url = models.URLField(verbose_name='Источник')
+    content = models.TextField(verbose_name='Наполнение')
+    created_timestamp = models.DateTimeField(verbose_name='Дата публикации')
+    likes = models.PositiveIntegerField(default=0, verbose_name='Лайки')
+    dislikes = models.PositiveIntegerField(default=0, verbose_name='Дизлайки')
+    rating_total = models.IntegerField(default=0, verbose_name='Рейтинг')
+    comment_count = models.PositiveIntegerField(default=0, verbose_name='Комментариев')
+    post_image = models.ImageField(upload_to='posts_images', blank=True, verbose_name='Обложка')
+    archived_at = models.DateTimeField(auto_now_add=True, verbose_name='Перенесён в архив')
+
+    class Meta:
+        verbose_name = 'Архивный пост'
+        verbose_name_plural = 'Архивные посты'
+        constraints = [
+            # По нему же обновление новостей проверяет, что пост steam уже был и не создаёт его заново
+            models.UniqueConstraint(fields=('game', 'gid'), name='news_archived_post_game_gid_uniq'),
+        ]
 
-# Модифицированный QuerySet (Django ORM)
-class CommentQuerySet(models.query.QuerySet):
-    # Возвращает общий рейтинг комментариев пользователя
-    def make_user_rating(self):
-        return sum(post.rating['total'] for post in self)
+    def __str__(self):
+        return f'{self.game.name} - {self.gid}'
+
+
+class ArchivedComment(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    created_timestamp = models.DateTimeField(verbose_name='Время создания')
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE, verbose_name='Пользователь')
+    post = models.ForeignKey(to=ArchivedNewsPost, on_delete=models.CASCADE, verbose_name='Пост')
+    message = models.TextField(max_length=512, verbose_name='Текст')
+    likes = models.PositiveIntegerField(default=0, verbose_name='Лайки')
+    dislikes = models.PositiveIntegerField(default=0, verbose_name='Дизлайки')
+    rating_total = models.IntegerField(default=0, verbose_name='Рейтинг')
+
+    class Meta:
+        indexes = [
+            # Комментарии к посту в порядке написания
+            models.Index(fields=('post', 'created_timestamp'), name='news_archived_comment_post_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user.name} {self.post}'
 
 
 class PostUserComment(models.Model):
-    objects = CommentQuerySet.as_manager()
     created_timestamp = models.DateTimeField(auto_now_add=True, verbose_name='Время создания')
     finish_timestamp = models.DateTimeField(null=True, default=None, verbose_name='Возможность удалить ДО')
     user = models.ForeignKey(to=User, on_delete=models.CASCADE,
                              verbose_name='Пользователь')
     post = models.ForeignKey(to=GameNewsPost, on_delete=models.CASCADE, verbose_name='Пост')
     message = models.TextField(max_length=512, verbose_name='Текст')
-    rating = models.JSONField(default=dict, verbose_name='Рейтинговая система')
+    # Счётчики голосов (сами голоса в Vote) и рейтинг = likes - dislikes
+    likes = models.PositiveIntegerField(default=0, verbose_name='Лайки')
+    dislikes = models.PositiveIntegerField(default=0, verbose_name='Дизлайки')
+    rating_total = models.IntegerField(default=0, verbose_name='Рейтинг')
+
+    class Meta:
+        indexes = [
+            # Комментарии к посту в порядке написания
+            models.Index(fields=('post', 'created_timestamp'), name='news_comment_post_created_idx'),
+            # Комментарии пользователя, от новых к старым
+            models.Index(fields=('user', '-created_timestamp'), name='news_comment_user_created_idx'),
+        ]
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         # При создании/изменении контролирует время возможности удалить пользователем свой коммент
+        # (created_timestamp у нового комментария заполняется только при сохранении)
         if not self.finish_timestamp:
-            self.finish_timestamp = self.created_timestamp + timedelta(minutes=5)
-        # Формирует рейтинг на основе длинны списков "лайк" и "дизлайк", в которых находятся имена пользователей
-        # Проголосовавших за тот или иной выбор
-        self.rating['total'] = len(self.rating['likes']) - len(self.rating['dislikes'])
-        return super(PostUserComment, self).save(force_insert=force_insert, force_update=force_update,
-                                                 using=using, update_fields=update_fields)
+            self.finish_timestamp = (self.created_timestamp or timezone.now()) + timedelta(minutes=5)
+        adding = self._state.adding
+        with transaction.atomic():
+            super(PostUserComment, self).save(force_insert=force_insert, force_update=force_update,
+                                              using=using, update_fields=update_fields)
+            # Комментарий - часть страницы поста, отмечаем пост изменённым, новый комментарий увеличивает счётчик
+            if adding:
+                GameNewsPost.touch(self.post_id, comment_count=F('comment_count') + 1)
+            else:
+                GameNewsPost.touch(self.post_id)
+
+    def delete(self, using=None, keep_parents=False):
+        with transaction.atomic():
+            # Рейтинг берём из базы под блокировкой, голоса могли изменить его после загрузки комментария
+            rating_total = PostUserComment.objects.select_for_update().filter(id=self.id).values_list(
+                'rating_total', flat=True).first() or 0
+            result = super(PostUserComment, self).delete(using=using, keep_parents=keep_parents)
+            # Комментарий уже мог быть удалён параллельным запросом, тогда счётчики не трогаем
+            if result[1].get(self._meta.label):
+                # Рейтинг удалённого комментария больше не входит в карму автора
+                User.objects.filter(id=self.user_id).update(karma=F('karma') - rating_total)
+                GameNewsPost.touch(self.post_id, comment_count=F('comment_count') - 1)
+        return result
 
     def __str__(self):
         return f'{self.user.name} {self.post}'
 
+    # Изменить счётчики голосов комментария и карму автора, возвращает количество изменённых строк (0 - комментария нет)
+    # Вызывается внутри транзакции голосования (Vote.cast, news.votes.save_votes)
+    @staticmethod
+    def add_votes(comment_id, likes, dislikes):
+        updated = PostUserComment.objects.filter(id=comment_id).update(
+            likes=F('likes') + likes,
+            dislikes=F('dislikes') + dislikes,
+            rating_total=F('rating_total') + likes - dislikes,
+        )
+        User.objects.filter(postusercomment=comment_id).update(karma=F('karma') + likes - dislikes)
+        # Рейтинг комментария - часть страницы поста, отмечаем пост изменённым
+        GameNewsPost.objects.filter(postusercomment=comment_id).update(updated_at=timezone.now())
+        return updated
+
+
+# Голос пользователя за пост или комментарий, ровно одна из ссылок post/comment заполнена
+class Vote(models.Model):
+    LIKE = 1
+    DISLIKE = -1
+    # Тип голоса из url -> значение
+    VOICES = {'likes': LIKE, 'dislikes': DISLIKE}
+    # Тип объекта из url -> модель
+    TARGETS = {'post': GameNewsPost, 'comment': PostUserComment}
+
+    # Отдельный индекс по пользователю не нужен, пользователь - первое поле уникальных индексов
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE, db_index=False, verbose_name='Пользователь')
+    post = models.ForeignKey(to=GameNewsPost, on_delete=models.CASCADE, null=True, blank=True, verbose_name='Пост')
+    comment = models.ForeignKey(to=PostUserComment, on_delete=models.CASCADE, null=True, blank=True,
+                                verbose_name='Комментарий')
+    value = models.SmallIntegerField(choices=((LIKE, 'Лайк'), (DISLIKE, 'Дизлайк')), verbose_name='Голос')
+
+    class Meta:
+        verbose_name = 'Голос'
+        verbose_name_plural = 'Голоса'
+        constraints = [
+            # Один голос пользователя на объект
+            models.UniqueConstraint(fields=('user', 'post'), condition=Q(post__isnull=False),
+                                    name='news_vote_user_post_uniq'),
+            models.UniqueConstraint(fields=('user', 'comment'), condition=Q(comment__isnull=False),
+                                    name='news_vote_user_comment_uniq'),
+            models.CheckConstraint(check=Q(post__isnull=False, comment__isnull=True)
+                                   | Q(post__isnull=True, comment__isnull=False),
+                                   name='news_vote_one_target'),
+        ]
+
+    @classmethod
+    def cast(cls, user, object_type, object_id, value):
+        """
+        Голос пользователя за пост или комментарий: повторный такой же голос ничего не меняет, противоположный - заменяет
+        Голос и счётчики пишутся одной транзакцией, счётчики меняются одним UPDATE с F() выражениями, поэтому
+        одновременные голоса не теряются, а уникальный индекс не даёт проголосовать дважды
+        Если объекта нет, бросает DoesNotExist его модели
+        """
+        model = cls.TARGETS[object_type]
+        target = {f'{object_type}_id': object_id}
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    cls.objects.create(user=user, value=value, **target)
+                switched = False
+            except IntegrityError:
+                # Голос уже есть: противоположный меняем, такой же оставляем как есть
+                if not cls.objects.filter(user=user, value=-value, **target).update(value=value):
+                    return
+                switched = True
+            likes = (value == cls.LIKE) - (switched and value == cls.DISLIKE)
+            dislikes = (value == cls.DISLIKE) - (switched and value == cls.LIKE)
+            if not model.add_votes(object_id, likes, dislikes):
+                raise model.DoesNotExist
+
 
 class Subscription(models.Model):
     user = models.ForeignKey(to=User, on_delete=models.CASCADE)
     game = models.ForeignKey(to=GameModel, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            # Пользователь подписан на игру не более одного раза, индекс также служит для поиска подписок пользователя
+            models.UniqueConstraint(fields=('user', 'game'), name='news_subscription_user_game_uniq'),
+        ]
+
+    # Время жизни закэшированного множества подписок, сбрасывается раньше при любом изменении подписок пользователя
+    CACHE_TIMEOUT = 60 * 60 * 24
+
+    @staticmethod
+    def cache_key(user_id):
+        return f'subscriptions:{user_id}'
+
+    # Множество id игр, на которые подписан пользователь, хранится в кэше (redis)
+    # Один запрос только за id из индекса (user, game), без загрузки самих игр, и ноль запросов при тёплом кэше
+    @classmethod
+    def game_ids(cls, user):
+        if not user.is_authenticated:
+            return set()
+        key = cls.cache_key(user.id)
+        ids = cache.get(key)
+        if ids is None:
+            # Кэшируется надолго, поэтому читаем из основной базы, а не с возможно отставшей реплики
+            ids = set(cls.objects.db_manager('default').filter(user_id=user.id).values_list('game_id', flat=True))
+            cache.set(key, ids, cls.CACHE_TIMEOUT)
+        return ids
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        adding = self._state.adding
+        with transaction.atomic():
+            super(Subscription, self).save(force_insert=force_insert, force_update=force_update,
+                                           using=using, update_fields=update_fields)
+            if adding:
+                GameModel.objects.filter(id=self.game_id).update(subscriber_count=F('subscriber_count') + 1)
+        # После создания/изменения подписки сбрасываем кэш подписок пользователя
+        cache.delete(self.cache_key(self.user_id))
+
+    def delete(self, using=None, keep_parents=False):
+        with transaction.atomic():
+            result = super(Subscription, self).delete(using=using, keep_parents=keep_parents)
+            # Подписка уже могла быть удалена параллельным запросом, тогда счётчик не трогаем
+            if result[1].get(self._meta.label):
+                GameModel.objects.filter(id=self.game_id).update(subscriber_count=F('subscriber_count') - 1)
+        # После удаления подписки сбрасываем кэш подписок пользователя
+        cache.delete(self.cache_key(self.user_id))
+        return result
+
+
+# QuerySet каталога приложений steam
+class SteamAppQuerySet(models.query.QuerySet):
+    def search(self, text):
+        # Совпадения по началу названия идут первыми, затем похожие по словам (опечатки, слово из середины названия)
+        # Оба условия обслуживаются индексами: btree по UPPER(name) для префикса и GIN триграммный для похожести
+        return self.filter(
+            Q(name__istartswith=text) | Q(name__trigram_word_similar=text)
+        ).annotate(
+            prefix=ExpressionWrapper(Q(name__istartswith=text), output_field=BooleanField()),
+            similarity=TrigramWordSimilarity(text, 'name'),
+        ).order_by('-prefix', '-similarity', 'name')
+
+
+# Локальная копия каталога приложений steam, периодически синхронизируется задачей news.tasks.steam_catalog_update
+class SteamApp(models.Model):
+    GAME = 1
+    DLC = 2
+    SOFTWARE = 3
+    VIDEO = 4
+    HARDWARE = 5
+    TYPES = (
+        (GAME, 'game'),
+        (DLC, 'dlc'),
+        (SOFTWARE, 'software'),
+        (VIDEO, 'video'),
+        (HARDWARE, 'hardware'),
+    )
+
+    objects = SteamAppQuerySet.as_manager()
+    # appid сам по себе уникален, поэтому он же первичный ключ, без лишнего id и лишнего индекса
+    appid = models.PositiveIntegerField(primary_key=True, verbose_name='Идентификатор Steam')
+    name = models.CharField(max_length=256, verbose_name='Название')
+    type = models.PositiveSmallIntegerField(choices=TYPES, default=GAME, verbose_name='Тип')
+
+    class Meta:
+        verbose_name = 'Приложение Steam'
+        verbose_name_plural = 'Приложения Steam'
+        indexes = [
+            # Поиск по началу названия без учёта регистра (UPPER(name) LIKE 'TEXT%')
+            models.Index(OpClass(Upper('name'), name='text_pattern_ops'), name='news_steamapp_name_prefix_idx'),
+            # Нечёткий поиск по словам названия
+            GinIndex(fields=('name',), opclasses=('gin_trgm_ops',), name='news_steamapp_name_trgm_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.appid})'
+
+    # Ссылка на страницу приложения в магазине steam
+    @property
+    def link(self):
+        return f'https://store.steampowered.com/app/{self.appid}'
+
+    # Небольшая обложка приложения из cdn steam
+    @property
+    def img(self):
+        return f'https://cdn.cloudflare.steamstatic.com/steam/apps/{self.appid}/capsule_sm_120.jpg'
@@ -0,0 +1,182 @@
+"""
+Поток новых постов в формате server-sent events
+Задача news_post_update публикует каждый новый пост в канал redis pub/sub, а каждый процесс веб-сервера держит
+ровно одну подписку на этот канал и раздаёт сообщения всем своим клиентам через asyncio очереди
+Представление асинхронное и рассчитано на запуск через ASGI (rpg_agg.asgi), например: uvicorn rpg_agg.asgi:application
+Тогда тысячи ожидающих клиентов обслуживаются одним циклом событий, без отдельного потока на каждого
+
+Django 4.2 не замечает отключение клиента, пока отдаёт потоковый ответ, а uvicorn молча отбрасывает данные
+для закрытого соединения, поэтому пинги об отключении не сообщают. Вместо этого подключение живёт
+не дольше STREAM_LIFETIME_SECONDS, после чего браузер сам переподключается (retry) и присылает id последнего
+полученного поста (Last-Event-ID), посты, добавленные за время переподключения, досылаются из базы.
+Так очередь закрытой вкладки освобождается не позже чем через STREAM_LIFETIME_SECONDS
+
+Middleware проекта (MetricsMiddleware, ReplicaRoutingMiddleware, ProfilerMiddleware) только синхронные,
+поэтому под ASGI Django выполняет цепочку middleware и само представление до возврата ответа в потоке
+через sync_to_async, один раз на подключение. Отдача событий идёт уже в цикле событий, без потоков
+"""
+import asyncio
+import json
+
+import redis
+import redis.asyncio as aioredis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.urls import reverse
+
+from news.models import GameNewsPost, Subscription
+
+# Как часто отправлять комментарий-пинг, чтобы прокси не закрывали простаивающее соединение
+KEEPALIVE_SECONDS = 15
+# Сколько секунд держится одно подключение, дальше поток закрывается и браузер переподключается
+STREAM_LIFETIME_SECONDS = 5 * 60
+# Через сколько миллисекунд браузер переподключается после закрытия потока
+RETRY_MILLISECONDS = 5000
+# Сколько сообщений может ждать медленный клиент, дальше новые сообщения для него отбрасываются,
+# столько же последних постов досылается при переподключении
+CLIENT_QUEUE_SIZE = 100
+# Пауза перед повторным подключением к redis после ошибки
+RECONNECT_SECONDS = 1
+
+# Синхронный клиент для публикации из celery задач
+publisher = redis.Redis.from_url(settings.REDIS_URL)
+
+
+def post_summary(post_id, game_id, game_name, title, date):
+    # Краткая сводка поста для события, без тяжелого content
+    return json.dumps({
+        'id': post_id,
+        'game_id': game_id,
+        'game_name': game_name,
+        'title': title,
+        'date': date,
+        'url': reverse('news:post_detail', kwargs={'pk': post_id}),
+    }, ensure_ascii=False)
+
+
+def publish_new_post(post):
+    publisher.publish(settings.NEWS_STREAM_CHANNEL,
+                      post_summary(post.id, post.game_id, post.game.name, post.title, post.date))
+
+
+def missed_posts(last_id, game_ids):
+    # Сводки постов новее last_id (не больше CLIENT_QUEUE_SIZE последних) по возрастанию id, game_ids - как в потоке
+    posts = GameNewsPost.objects.filter(id__gt=last_id)
+    if game_ids is not None:
+        posts = posts.filter(game_id__in=game_ids)
+    rows = posts.order_by('-id').values_list('id', 'game_id', 'game__name', 'title', 'date')[:CLIENT_QUEUE_SIZE]
+    return [post_summary(*row) for row in reversed(rows)]
+
+
+class NewsBroadcaster:
+    """
+    Одна подписка на канал redis на процесс, сообщения раскладываются по очередям подключённых клиентов
+    Слушатель запускается при подключении первого клиента и переподключается к redis при ошибках
+    """
+
+    def __init__(self):
+        self.queues = set()
+        self.task = None
+
+    async def listen(self):
+        while True:
+            client = aioredis.Redis.from_url(settings.REDIS_URL)
+            pubsub = client.pubsub()
+            try:
+                await pubsub.subscribe(settings.NEWS_STREAM_CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.dispatch(message['data'].decode())
+            except redis.RedisError:
+                await asyncio.sleep(RECONNECT_SECONDS)
+            finally:
+                await pubsub.close()
+                await client.close()
+
+    def dispatch(self, data):
+        for queue in list(self.queues):
+            # Медленный клиент не должен тормозить остальных и копить память
+            if not queue.full():
+                queue.put_nowait(data)
+
+    def subscribe(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.listen())
+        queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        self.queues.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.queues.discard(queue)
+
+
+broadcaster = NewsBroadcaster()
+
+
+async def event_stream(queue, game_ids, missed=()):
+    """
+    События для клиента: сначала пропущенные при переподключении посты missed, затем новые из очереди queue,
+    через STREAM_LIFETIME_SECONDS поток заканчивается, очередь отписывается в любом случае
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + STREAM_LIFETIME_SECONDS
+    last_id = 0
+    try:
+        # Браузер переподключится через RETRY_MILLISECONDS после закрытия потока
+        yield f'retry: {RETRY_MILLISECONDS}\n\n'
+        for data in missed:
+            last_id = json.loads(data)['id']
+            yield f'event: news_post\nid: {last_id}\ndata: {data}\n\n'
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                data = await asyncio.wait_for(queue.get(), timeout=min(KEEPALIVE_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            post = json.loads(data)
+            # Пост уже отправлен из базы при переподключении
+            if post['id'] <= last_id:
+                continue
+            # Авторизованный пользователь получает только посты игр из своих подписок
+            if game_ids is not None and post['game_id'] not in game_ids:
+                continue
+            yield f'event: news_post\nid: {post["id"]}\ndata: {data}\n\n'
+    finally:
+        broadcaster.unsubscribe(queue)
+
+
+def get_stream_game_ids(user):
+    # Для гостя None - все посты, иначе множество id игр из подписок (из кэша)
+    return Subscription.game_ids(user) if user.is_authenticated else None
+
+
+def get_stream_start(user, last_event_id):
+    # Подписки пользователя и посты, пропущенные с last_event_id (id последнего полученного поста)
+    game_ids = get_stream_game_ids(user)
+    # Заголовок присылает клиент, поэтому всё, что не похоже на id поста (bigint), игнорируется
+    valid = last_event_id.isdecimal() and int(last_event_id) < 2 ** 63
+    missed = missed_posts(int(last_event_id), game_ids) if valid else []
+    return game_ids, missed
+
+
+# Поток новых постов для ленты
+async def news_stream(request):
+    # Очередь создаётся до чтения пропущенных постов, чтобы посты между чтением и подпиской не потерялись
+    queue = broadcaster.subscribe()
+    try:
+        # Пользователь, подписки и пропущенные посты загружаются синхронным ORM, поэтому в отдельном потоке,
+        # один раз на подключение
+        game_ids, missed = await sync_to_async(get_stream_start)(request.user,
+                                                                 request.headers.get('Last-Event-ID', ''))
+    except BaseException:
+        broadcaster.unsubscribe(queue)
+        raise
+    response = StreamingHttpResponse(event_stream(queue, game_ids, missed), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Отключаем буферизацию в nginx, иначе события будут приходить пачками
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,17 +1,52 @@
 import io
 import re
+import time
 from datetime import datetime
 
 import PIL
+import urllib3
 from celery import shared_task
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 from PIL import Image
 from urllib3.contrib.socks import SOCKSProxyManager
 
-from news.models import GameModel, GameNewsPost
+from news.digest import send_digest
+from news.models import (HOT_POSTS_PER_GAME, ArchivedNewsPost, GameModel,
+                         GameNewsPost, SteamApp)
+from news.stream import publish_new_post
+from news.votes import flush_votes
+from rpg_agg.metrics import InstrumentedProxy
+from rpg_agg.task_metrics import task_count, task_slowest
 
-# Для запросов через прокси
-proxy = SOCKSProxyManager(settings.PROXY)
+# Для запросов через прокси, статусы ответов и время запросов попадают в метрики
+proxy = InstrumentedProxy(SOCKSProxyManager(settings.PROXY))
+
+# Итоги проверки приложения steam перед добавлением в библиотеку
+GAME_QUEUED = 'queued'  # РПГ, игра будет добавлена
+GAME_NOT_GAME = 'not_game'  # Не игра (саундтрек, фильм и т.п.)
+GAME_NOT_RPG = 'not_rpg'  # Игра, но без жанра РПГ
+GAME_NOT_FOUND = 'not_found'  # Steam не знает такого appid
+GAME_ERROR = 'error'  # Steam или прокси не ответили
+
+# Сколько хранится итог проверки, ошибку храним недолго, чтобы скоро можно было попробовать снова
+GAME_CHECK_TIMEOUT = 60 * 60 * 24
+GAME_CHECK_ERROR_TIMEOUT = 60
+# Пока игра создаётся, итог "будет добавлена" хранится столько, если воркер упадёт, проверку можно будет повторить
+GAME_CREATE_TIMEOUT = 60 * 10
+# Таймаут запроса к steam
+STEAM_TIMEOUT = urllib3.Timeout(connect=5, read=15)
+
+
+def game_check_cache_key(appid):
+    return f'appdetails:{appid}'
+
+
+def game_check_pending_key(appid):
+    return f'appdetails:{appid}:pending'
 
 
 def save_image(path, image_url):
@@ -20,8 +55,10 @@ def save_image(path, image_url):
     картинки прямым путем через протокол socks у меня не вышло, а при авторизации прокси через http возникала ошибка
     Image позволяет подогнать картинку под необходимый размер и формат и сохранить
     """
+    start = time.perf_counter()
     # Получаем данные об изображении
     image = proxy.request('GET', image_url)
+    task_count('image_bytes', len(image.data))
     # Отрисовываем
     image = io.BytesIO(image.data)
     # Если картинка не отрисована
@@ -29,11 +66,14 @@ def save_image(path, image_url):
         image = Image.open(image)
     # Возвращаем False
     except PIL.UnidentifiedImageError:
+        task_count('images_failed')
         return False
     # Подгоняем под необходимый размер
     image.thumbnail((989, 427))
     # Конвертируем в RGB, так как не все форматы изображений подходят для сохранения в jpg и сохраняем
     image.convert('RGB').save(path)
+    task_count('images_saved')
+    task_count('image_seconds', time.perf_counter() - start)
     return True
 
 
@@ -50,10 +90,22 @@ def news_post_update(game):
     news_url = f'https://api.steampowered.com/ISteamNews/GetNewsForApp/v2/?appid={game.steam_appid}&count=20&l=russian'
 
     # Запрос, формируем в json, получаем словарь по ключу appnews, в котором получаем список словарей по ключу newsitems
+    start = time.perf_counter()
     request = proxy.request('GET', news_url).json()['appnews']['newsitems']
+    # Время ответа steam по играм: сумма и самая медленная игра для лога задачи
+    steam_seconds = time.perf_counter() - start
+    task_count('games')
+    task_count('steam_seconds', steam_seconds)
+    task_slowest('slowest_game', game.steam_appid, steam_seconds)
 
     # Составляем список gid(steam идентификатор для новостей) имеющихся новостей по игре
-    list_of_gid = [post.gid for post in GameNewsPost.objects.filter(game=game)]
+    list_of_gid = list(GameNewsPost.objects.filter(game=game).values_list('gid', flat=True))
+    # Посты, уже перенесённые в архив, тоже считаются имеющимися, иначе они создавались бы заново
+    list_of_gid += ArchivedNewsPost.objects.filter(
+        game=game, gid__in=[news_post['gid'] for news_post in request]).values_list('gid', flat=True)
+
+    # Сколько новостей добавлено
+    created = 0
 
     # Шаблон для библиотеки re, чтобы взять первое попавшееся изображение в теле поста и установить в качестве обложки
     pattern = r'<img(.*?)? src="(.+?)"(.*?)?>'
@@ -87,28 +139,146 @@ def news_post_update(game):
                     # Если работа функции не будет успешной, вновь сделаем строку пустой
                     if not save_image(path=settings.MEDIA_ROOT / path_to_image, image_url=src):
                         path_to_image = ''
-            # Cоздаем объект Новостного Поста
-            GameNewsPost.objects.create(
-                game=game,
-                gid=news_post['gid'],
-                title=news_post['title'],
-                author=news_post.get('author', 'Неизвестен'),
-                date=news_post['date'],
-                source_url=news_post['url'],
-                content=content,
-                created_timestamp=datetime.astimezone(datetime.fromtimestamp(int(news_post['date']))),
-                post_image=path_to_image,
-                rating={'total': 0, 'likes': [], 'dislikes': []}
-            )
+            # Cоздаем объект Новостного Поста, вместе с ним увеличиваем счётчик постов игры
+            with transaction.atomic():
+                post = GameNewsPost.objects.create(
+                    game=game,
+                    gid=news_post['gid'],
+                    title=news_post['title'],
+                    author=news_post.get('author', 'Неизвестен'),
+                    date=news_post['date'],
+                    source_url=news_post['url'],
+                    content=content,
+                    created_timestamp=datetime.astimezone(datetime.fromtimestamp(int(news_post['date']))),
+                    post_image=path_to_image,
+                )
+                GameModel.objects.filter(id=game.id).update(post_count=F('post_count') + 1)
             list_of_gid.append(news_post['gid'])
+            created += 1
+            # Сообщаем о новом посте подключённым к потоку клиентам
+            publish_new_post(post)
         # Если gid (steam идентификатор для новостей) уже находится в нашем списке, пропускаем новость и идём к следующей
         else:
             continue
-    # В случае добавления новых новостей, необходимо уменьшить их общее количество, удалив самые старые
-    # Общий лимит для каждой игры, девять постов
-    while len(list_of_gid) > 9:
-        GameNewsPost.objects.last().delete()
-        list_of_gid.pop()
+    task_count('posts_created', created)
+    task_count('posts_skipped', len(request) - created)
+    if created:
+        # Общий лимит для каждой игры - HOT_POSTS_PER_GAME последних постов, более старые переносим в архив
+        old_ids = list(GameNewsPost.objects.filter(game=game).order_by('-date', '-id')
+                       .values_list('id', flat=True)[HOT_POSTS_PER_GAME:])
+        if old_ids:
+            task_count('posts_archived', GameNewsPost.objects.filter(id__in=old_ids).archive())
+        # Список новостей игры изменился, отмечаем страницу игры изменённой
+        GameModel.touch(game.id)
+
+
+# Запланированный перенос в архив постов сверх лимита каждой игры (например, после уменьшения HOT_POSTS_PER_GAME)
+# Пачками, каждая пачка - отдельная транзакция, чтобы не держать долгие блокировки
+@shared_task
+def news_archive(batch_size=1000):
+    archived = 0
+    while True:
+        rows = list(GameNewsPost.objects.outside_hot_limit().values_list('id', 'game_id')[:batch_size])
+        if not rows:
+            return archived
+        count = GameNewsPost.objects.filter(id__in=[post_id for post_id, _ in rows]).archive()
+        task_count('posts_archived', count)
+        archived += count
+        # Списки новостей этих игр изменились, отмечаем их страницы изменёнными, как и news_post_update
+        GameModel.objects.filter(id__in={game_id for _, game_id in rows}).update(updated_at=timezone.now())
+
+
+# Запланированная сверка оценок "горячей" ленты с рейтингом постов
+# Оценка поддерживается при каждом голосовании, задача лишь исправляет расхождения, пачками по id
+@shared_task
+def hot_scores_refresh(batch_size=5000):
+    max_id = GameNewsPost.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    for start in range(0, max_id + 1, batch_size):
+        GameNewsPost.objects.filter(id__gte=start, id__lt=start + batch_size).refresh_hot_scores()
+
+
+# Частый сброс буфера голосов из redis в базу
+@shared_task
+def votes_flush():
+    return flush_votes()
+
+
+# Запланированная рассылка дайджеста новых постов подписчикам, письма уходят через очередь users.tasks.send_outbox
+@shared_task
+def subscribers_digest():
+    return send_digest()
+
+
+# Запланированная задача синхронизации локального каталога приложений steam
+@shared_task
+def steam_catalog_update():
+    # IStoreService отдаёт каталог страницами до 50000 приложений, тип задаётся флагами include_*
+    # Поэтому каталог проходится отдельно для каждого типа, чтобы знать тип каждого приложения
+    include_flags = {
+        SteamApp.GAME: 'include_games',
+        SteamApp.DLC: 'include_dlc',
+        SteamApp.SOFTWARE: 'include_software',
+        SteamApp.VIDEO: 'include_videos',
+        SteamApp.HARDWARE: 'include_hardware',
+    }
+    for app_type, flag in include_flags.items():
+        last_appid = 0
+        while True:
+            # Включён только флаг текущего типа
+            params = {name: 'true' if name == flag else 'false' for name in include_flags.values()}
+            params.update(key=settings.STEAM_API_KEY, max_results=50000, last_appid=last_appid)
+            response = proxy.request('GET', 'https://api.steampowered.com/IStoreService/GetAppList/v1/',
+                                     fields=params, timeout=60).json()['response']
+            apps = [SteamApp(appid=app['appid'], name=app['name'][:256], type=app_type)
+                    for app in response.get('apps', [])]
+            # Вставка пачками, уже известные приложения обновляются (название могло смениться)
+            SteamApp.objects.bulk_create(apps, batch_size=5000, update_conflicts=True,
+                                         unique_fields=['appid'], update_fields=['name', 'type'])
+            if not response.get('have_more_results'):
+                break
+            last_appid = response['last_appid']
+
+
+# Отложенная задача проверки приложения steam (appdetails) перед добавлением в библиотеку
+# Итог, в том числе отрицательный, кэшируется, повторные нажатия на ту же игру не идут в steam
+@shared_task
+def game_check(appid: int):
+    # Ссылка с адресом указанным в документации steam web api, куда вставляется appid
+    game_url = f'https://store.steampowered.com/api/appdetails/?appids={appid}&l=russian'
+    try:
+        # Выполняем get запрос, на указанный адрес, конвертируем в словарь
+        # И сразу же берем значение по ключу appid(в виде строки)
+        game_data = proxy.request('GET', game_url, timeout=STEAM_TIMEOUT).json()[str(appid)]
+    except (urllib3.exceptions.HTTPError, ValueError, KeyError, TypeError):
+        cache.set(game_check_cache_key(appid), GAME_ERROR, GAME_CHECK_ERROR_TIMEOUT)
+        cache.delete(game_check_pending_key(appid))
+        return GAME_ERROR
+
+    if not game_data.get('success'):
+        result = GAME_NOT_FOUND
+    # Проверяем, тип, так как в поиске стим также может возвращать саундтреки, фильмы и проч.
+    elif game_data['data']['type'] != 'game':
+        result = GAME_NOT_GAME
+    # Проверяем есть ли среди жанров этой игры, жанр РПГ, его id в steam это цифра 3
+    elif '3' in [genre['id'] for genre in game_data['data'].get('genres', [])]:
+        result = GAME_QUEUED
+    else:
+        result = GAME_NOT_RPG
+
+    # Если РПГ присутствует, создаём игру здесь же, мы и так уже в воркере celery
+    if result == GAME_QUEUED and not GameModel.objects.filter(steam_appid=appid).exists():
+        cache.set(game_check_cache_key(appid), result, GAME_CREATE_TIMEOUT)
+        cache.delete(game_check_pending_key(appid))
+        try:
+            game_model_create(data=game_data['data'])
+        except Exception:
+            # Игра не создана (изображение, прокси, база), вместо "будет добавлена" - ошибка и скорая повторная проверка
+            cache.set(game_check_cache_key(appid), GAME_ERROR, GAME_CHECK_ERROR_TIMEOUT)
+            raise
+
+    cache.set(game_check_cache_key(appid), result, GAME_CHECK_TIMEOUT)
+    cache.delete(game_check_pending_key(appid))
+    return result
 
 
 # Отложенная задача для создания игры
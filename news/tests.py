@@ -0,0 +1,904 @@
+import io
+import itertools
+from unittest import mock
+
+import redis
+import urllib3
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.template.loader import render_to_string
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+
+from news.digest import send_digest
+from news.stream import (CLIENT_QUEUE_SIZE, NewsBroadcaster, event_stream,
+                         post_summary)
+from news.models import (ArchivedComment, ArchivedNewsPost, GameModel,
+                         GameNewsPost, PostUserComment, SteamApp,
+                         HOT_POSTS_PER_GAME, HOT_SCORE_TIME_SCALE,
+                         Subscription, Vote,
+                         hot_score)
+from news.tasks import (GAME_ERROR, GAME_NOT_FOUND, GAME_NOT_GAME,
+                        GAME_NOT_RPG, GAME_QUEUED, game_check,
+                        game_check_cache_key, game_check_pending_key,
+                        hot_scores_refresh, news_archive,
+                        steam_catalog_update)
+from news import votes
+from news.votes import (DIRTY_KEY, FLUSH_LOCK_KEY, apply_pending_votes,
+                        cast_vote, delta_key, flush_votes, pending_key,
+                        post_version_key, voters_key)
+from users.models import OutgoingEmail, User
+from users.tasks import send_outbox
+
+# Redis недоступен: add_voice пишет голос сразу в базу через Vote.cast
+REDIS_DOWN = mock.Mock(**{'pipeline.side_effect': redis.ConnectionError, 'hdel.side_effect': redis.ConnectionError})
+# steam_appid игр тестов, уникален
+APPIDS = itertools.count(1)
+
+
+def create_game(name, **fields):
+    # Игра без файла изображения, поля по умолчанию можно переопределить
+    fields = {'image': 'games_images/game.jpg', 'description': name, 'steam_appid': next(APPIDS), **fields}
+    return GameModel.objects.create(name=name, **fields)
+
+
+def create_post(game, gid, date=1700000000, **fields):
+    fields = {'title': f'Post {gid}', 'author': 'Author', 'source_url': f'https://store.steampowered.com/news/{gid}',
+              'content': 'Text', 'created_timestamp': timezone.now(), **fields}
+    return GameNewsPost.objects.create(game=game, gid=gid, date=date, **fields)
+
+
+@mock.patch('news.votes.client', REDIS_DOWN)
+@mock.patch('rpg_agg.ratelimit.overloaded', mock.Mock(return_value=False))
+@mock.patch('rpg_agg.ratelimit.retry_after', mock.Mock(return_value=0))
+class AddVoiceTests(TestCase):
+    """
+    Голосование через add_voice: новый голос, повторный такой же, смена голоса и голос за несуществующий объект
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('voter', 'voter@example.com', 'password', check_email=True)
+        cls.author = User.objects.create_user('author', 'author@example.com', 'password', check_email=True)
+        cls.post = create_post(create_game('Game'), '1')
+        cls.comment = PostUserComment.objects.create(user=cls.author, post=cls.post, message='Comment')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def vote(self, object_type, object_id, voice_type):
+        url = reverse('news:add_voice', kwargs={'object_type': object_type, 'object_id': object_id,
+                                                'voice_type': voice_type})
+        return self.client.get(url, HTTP_REFERER='/news/feed')
+
+    def assert_post_rating(self, likes, dislikes):
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.likes, self.post.dislikes, self.post.rating_total),
+                         (likes, dislikes, likes - dislikes))
+        self.assertAlmostEqual(self.post.hot_score, hot_score(likes - dislikes, self.post.date))
+
+    def test_like(self):
+        response = self.vote('post', self.post.id, 'likes')
+        self.assertRedirects(response, '/news/feed', fetch_redirect_response=False)
+        self.assertEqual(list(Vote.objects.values_list('user', 'post', 'value')), [(self.user.id, self.post.id, 1)])
+        self.assert_post_rating(1, 0)
+
+    def test_same_like_changes_nothing(self):
+        self.vote('post', self.post.id, 'likes')
+        self.vote('post', self.post.id, 'likes')
+        self.assertEqual(Vote.objects.count(), 1)
+        self.assert_post_rating(1, 0)
+
+    def test_flip(self):
+        self.vote('post', self.post.id, 'likes')
+        self.vote('post', self.post.id, 'dislikes')
+        self.assertEqual(list(Vote.objects.values_list('user', 'post', 'value')), [(self.user.id, self.post.id, -1)])
+        self.assert_post_rating(0, 1)
+
+    def test_comment_vote_changes_author_karma(self):
+        self.vote('comment', self.comment.id, 'likes')
+        self.vote('comment', self.comment.id, 'dislikes')
+        self.comment.refresh_from_db()
+        self.assertEqual((self.comment.likes, self.comment.dislikes, self.comment.rating_total), (0, 1, -1))
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.karma, -1)
+
+    def test_unknown_object(self):
+        self.assertEqual(self.vote('post', self.post.id + 1000, 'likes').status_code, 404)
+        self.assertEqual(self.vote('comment', self.comment.id + 1000, 'likes').status_code, 404)
+        self.assertEqual(self.vote('game', self.post.id, 'likes').status_code, 404)
+        self.assertEqual(self.vote('post', self.post.id, 'love').status_code, 404)
+        self.assertFalse(Vote.objects.exists())
+        self.assert_post_rating(0, 0)
+
+
+class VoteMigrationTests(TransactionTestCase):
+    """
+    Перенос голосов из json списков rating в таблицу Vote и счётчики (0008_votes) и обратно
+    """
+    before = [('news', '0007_archive')]
+    after = [('news', '0008_votes')]
+
+    def migrate(self, targets):
+        # Схема базы на момент targets, возвращает модели этого состояния
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_forward_and_reverse(self):
+        apps = self.migrate(self.before)
+        User = apps.get_model('users', 'User')
+        GameModel = apps.get_model('news', 'GameModel')
+        GameNewsPost = apps.get_model('news', 'GameNewsPost')
+        PostUserComment = apps.get_model('news', 'PostUserComment')
+        ArchivedNewsPost = apps.get_model('news', 'ArchivedNewsPost')
+        users = {name: User.objects.create(username=name, email=f'{name}@example.com')
+                 for name in ('alice', 'bob', 'carol')}
+        game = GameModel.objects.create(name='Game', image='games_images/game.jpg', description='Game', steam_appid=1)
+        post_fields = {'game': game, 'title': 'Title', 'author': 'Author', 'date': 1700000000,
+                       'source_url': 'https://store.steampowered.com/news/1', 'content': 'Text',
+                       'created_timestamp': timezone.now()}
+        # alice в обоих списках (лайк важнее), ghost - удалённый пользователь
+        post = GameNewsPost.objects.create(gid='1', rating={'total': 1, 'likes': ['alice', 'bob', 'ghost'],
+                                                            'dislikes': ['carol', 'alice']}, **post_fields)
+        comment = PostUserComment.objects.create(user=users['alice'], post=post, message='Comment',
+                                                 rating={'total': -2, 'likes': [], 'dislikes': ['bob', 'bob']})
+        archived = ArchivedNewsPost.objects.create(id=post.id + 1000, gid='2',
+                                                   rating={'total': 1, 'likes': ['alice'], 'dislikes': []},
+                                                   **post_fields)
+
+        apps = self.migrate(self.after)
+        Vote = apps.get_model('news', 'Vote')
+        self.assertEqual(set(Vote.objects.filter(post=post.id).values_list('user__username', 'value')),
+                         {('alice', 1), ('bob', 1), ('carol', -1)})
+        self.assertEqual(list(Vote.objects.filter(comment=comment.id).values_list('user__username', 'value')),
+                         [('bob', -1)])
+        counters = ('likes', 'dislikes', 'rating_total')
+        self.assertEqual(apps.get_model('news', 'GameNewsPost').objects.values_list(*counters).get(id=post.id),
+                         (2, 1, 1))
+        self.assertEqual(apps.get_model('news', 'PostUserComment').objects.values_list(*counters).get(id=comment.id),
+                         (0, 1, -1))
+        self.assertEqual(apps.get_model('news', 'ArchivedNewsPost').objects.values_list(*counters).get(id=archived.id),
+                         (1, 0, 1))
+
+        apps = self.migrate(self.before)
+        rating = apps.get_model('news', 'GameNewsPost').objects.get(id=post.id).rating
+        self.assertEqual((rating['total'], sorted(rating['likes']), rating['dislikes']),
+                         (1, ['alice', 'bob'], ['carol']))
+        self.assertEqual(apps.get_model('news', 'PostUserComment').objects.get(id=comment.id).rating,
+                         {'total': -1, 'likes': [], 'dislikes': ['bob']})
+        self.assertEqual(apps.get_model('news', 'ArchivedNewsPost').objects.get(id=archived.id).rating,
+                         {'total': 1, 'likes': [], 'dislikes': []})
+
+
+class DigestTests(TestCase):
+    """
+    Дайджест подписок: посты сгруппированы по играм, id последнего учтённого поста (digest_post_id) сдвигается,
+    пользователи без новых постов письма не получают
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        now = int(timezone.now().timestamp())
+        cls.first = create_game('First')
+        cls.second = create_game('Second')
+        cls.first_posts = [create_post(cls.first, str(number), date=now - number) for number in range(2)]
+        # Старше DIGEST_LOOKBACK_DAYS, в дайджест не попадает
+        create_post(cls.first, 'old', date=now - 60 * 60 * 24 * 30, title='Old post')
+        cls.second_post = create_post(cls.second, '10', date=now)
+        cls.reader = User.objects.create_user('reader', 'reader@example.com', 'password', check_email=True)
+        cls.seen_all = User.objects.create_user('seen_all', 'seen_all@example.com', 'password', check_email=True,
+                                                digest_post_id=cls.second_post.id)
+        cls.unverified = User.objects.create_user('unverified', 'unverified@example.com', 'password')
+        for user in (cls.reader, cls.seen_all, cls.unverified):
+            for game in (cls.first, cls.second):
+                Subscription.objects.create(user=user, game=game)
+
+    @staticmethod
+    def post_url(post):
+        return settings.FULL_DOMAIN_NAME + reverse('news:post_detail', kwargs={'pk': post.id})
+
+    def test_posts_grouped_by_game(self):
+        self.assertEqual(send_digest(), 1)
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.recipient, self.reader.email)
+        self.assertEqual(email.body, render_to_string('news/digest/email.txt', {'username': 'reader', 'blocks': [
+            render_to_string('news/digest/game.txt', {'game_name': 'First', 'more': 0, 'posts': [
+                {'title': post.title, 'url': self.post_url(post)} for post in reversed(self.first_posts)
+            ]}),
+            render_to_string('news/digest/game.txt', {'game_name': 'Second', 'more': 0, 'posts': [
+                {'title': self.second_post.title, 'url': self.post_url(self.second_post)},
+            ]}),
+        ]}))
+        self.assertNotIn('Old post', email.body)
+
+    def test_watermark(self):
+        send_digest(chunk_size=1)
+        self.assertEqual(dict(User.objects.values_list('username', 'digest_post_id')),
+                         {'reader': self.second_post.id, 'seen_all': self.second_post.id, 'unverified': 0})
+        # Повторный запуск без новых постов писем не ставит
+        self.assertEqual(send_digest(), 0)
+        post = create_post(self.second, '11', date=int(timezone.now().timestamp()), title='Fresh')
+        OutgoingEmail.objects.all().delete()
+        self.assertEqual(send_digest(), 2)
+        for email in OutgoingEmail.objects.all():
+            self.assertIn('Fresh', email.body)
+            self.assertNotIn(self.second_post.title, email.body)
+            self.assertNotIn('First', email.body)
+        self.assertEqual(set(User.objects.filter(check_email=True).values_list('digest_post_id', flat=True)),
+                         {post.id})
+
+    def test_user_without_subscriptions_skipped(self):
+        Subscription.objects.filter(user=self.reader).delete()
+        self.assertEqual(send_digest(), 0)
+        self.assertFalse(OutgoingEmail.objects.exists())
+
+    @mock.patch('users.tasks.get_connection')
+    def test_digest_sent_over_one_connection(self, get_connection):
+        User.objects.update(digest_post_id=0, check_email=True)
+        self.assertEqual(send_digest(chunk_size=1), 3)
+        self.assertEqual(send_outbox(batch_size=2), 3)
+        self.assertEqual(get_connection.return_value.open.call_count, 1)
+
+
+@mock.patch('news.stream.NewsBroadcaster.listen', mock.AsyncMock())
+class NewsStreamTests(TestCase):
+    """
+    Поток новых постов: раздача сообщений по очередям клиентов, ограничение очереди, фильтр по подпискам,
+    ограничение времени жизни подключения и досылка пропущенных постов при переподключении
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.game = create_game('Game')
+        cls.posts = [create_post(cls.game, str(number)) for number in range(3)]
+
+    @staticmethod
+    def summary(post):
+        return post_summary(post.id, post.game_id, post.game.name, post.title, post.date)
+
+    async def read(self, events):
+        return [event async for event in events]
+
+    async def test_fan_out_and_queue_limit(self):
+        broadcaster = NewsBroadcaster()
+        first, second = broadcaster.subscribe(), broadcaster.subscribe()
+        for number in range(CLIENT_QUEUE_SIZE + 5):
+            broadcaster.dispatch(str(number))
+        # Переполненная очередь хранит самые старые сообщения, новые для неё отбрасываются
+        for queue in (first, second):
+            self.assertEqual(queue.qsize(), CLIENT_QUEUE_SIZE)
+            self.assertEqual(queue.get_nowait(), '0')
+        broadcaster.unsubscribe(first)
+        broadcaster.dispatch('last')
+        self.assertEqual(first.qsize(), CLIENT_QUEUE_SIZE - 1)
+        self.assertEqual(second.qsize(), CLIENT_QUEUE_SIZE)
+        self.assertEqual(broadcaster.queues, {second})
+
+    @mock.patch('news.stream.STREAM_LIFETIME_SECONDS', 0.05)
+    async def test_stream_filters_and_ends(self):
+        with mock.patch('news.stream.broadcaster', NewsBroadcaster()) as broadcaster:
+            queue = broadcaster.subscribe()
+            other = post_summary(1000, self.game.id + 1, 'Other', 'Other', 1700000000)
+            for data in (self.summary(self.posts[1]), self.summary(self.posts[2]), other):
+                queue.put_nowait(data)
+            events = await self.read(event_stream(queue, {self.game.id}, [self.summary(self.posts[1])]))
+            # Поток закончился сам и освободил очередь
+            self.assertFalse(broadcaster.queues)
+        self.assertEqual(events, [
+            'retry: 5000\n\n',
+            f'event: news_post\nid: {self.posts[1].id}\ndata: {self.summary(self.posts[1])}\n\n',
+            f'event: news_post\nid: {self.posts[2].id}\ndata: {self.summary(self.posts[2])}\n\n',
+            ': keepalive\n\n',
+        ])
+
+    @mock.patch('news.stream.STREAM_LIFETIME_SECONDS', 0)
+    async def test_reconnect_sends_missed_posts(self):
+        url = reverse('news:stream')
+        response = await self.async_client.get(url, headers={'Last-Event-ID': str(self.posts[0].id)})
+        events = await self.read(response.streaming_content)
+        self.assertEqual(events, [b'retry: 5000\n\n'] + [
+            f'event: news_post\nid: {post.id}\ndata: {self.summary(post)}\n\n'.encode() for post in self.posts[1:]
+        ])
+        for last_event_id in ('', 'abc', str(2 ** 64)):
+            response = await self.async_client.get(url, headers={'Last-Event-ID': last_event_id})
+            self.assertEqual(await self.read(response.streaming_content), [b'retry: 5000\n\n'])
+
+
+class ApiTests(TestCase):
+    """
+    API только для чтения: курсоры, выбор полей, ETag и 304, архивные посты
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.game = create_game('Game')
+        # Посты с одинаковой датой идут в порядке убывания id
+        cls.posts = [create_post(cls.game, str(number), date=1700000000 + number // 3) for number in range(7)]
+        user = User.objects.create_user('reader', 'reader@example.com', 'password')
+        cls.archived = ArchivedNewsPost.objects.create(
+            id=cls.posts[-1].id + 100, game=cls.game, gid='old', title='Old', author='Author', date=1600000000,
+            source_url='https://store.steampowered.com/news/old', content='Text', created_timestamp=timezone.now())
+        ArchivedComment.objects.create(id=1, user=user, post=cls.archived, message='Archived comment',
+                                       created_timestamp=timezone.now())
+
+    def pages(self, name, **params):
+        # Все страницы списка по курсору next, возвращает записи по порядку
+        results, cursor = [], None
+        while True:
+            response = self.client.get(reverse(f'api_v1:{name}'), {**params, **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200)
+            results += response.json()['results']
+            cursor = response.json()['next']
+            if cursor is None:
+                return results
+
+    def test_feed_cursor_with_tied_dates(self):
+        expected = [post.id for post in sorted(self.posts, key=lambda post: (post.date, post.id), reverse=True)]
+        for limit in (1, 2, 3, 7, 8):
+            self.assertEqual([row['id'] for row in self.pages('feed', limit=limit, fields='id')], expected)
+
+    def test_games_cursor(self):
+        games = [self.game] + [create_game(f'Game {number}') for number in range(4)]
+        self.assertEqual([row['id'] for row in self.pages('games', limit=2, fields='id')], [game.id for game in games])
+
+    def test_fields(self):
+        response = self.client.get(reverse('api_v1:post_detail', kwargs={'pk': self.posts[0].id}),
+                                   {'fields': 'id,game_name,post_image'})
+        self.assertEqual(response.json(), {'id': self.posts[0].id, 'game_name': 'Game', 'post_image': None})
+        rows = self.pages('feed', fields='title')
+        self.assertEqual(rows[0], {'title': self.posts[-1].title})
+
+    def test_invalid_params(self):
+        comments = reverse('api_v1:post_comments', kwargs={'pk': self.posts[0].id})
+        for url, params in (
+                (reverse('api_v1:feed'), {'cursor': 'abc'}),
+                (reverse('api_v1:feed'), {'cursor': '1.2.3'}),
+                (reverse('api_v1:feed'), {'cursor': f'{10 ** 30}.1'}),
+                (reverse('api_v1:feed'), {'fields': 'id,password'}),
+                (reverse('api_v1:feed'), {'limit': 'all'}),
+                (reverse('api_v1:games'), {'cursor': '-1'}),
+                (reverse('api_v1:games'), {'cursor': '²'}),
+                (reverse('api_v1:games'), {'cursor': str(10 ** 30)}),
+                (reverse('api_v1:game_detail', kwargs={'pk': self.game.id}), {'fields': 'search_vector'}),
+                (comments, {'fields': 'user__password'}),
+        ):
+            with self.subTest(url=url, params=params):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json())
+
+    def test_etag(self):
+        url = reverse('api_v1:game_detail', kwargs={'pk': self.game.id})
+        response = self.client.get(url)
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        # Другие поля - другое тело и другой ETag
+        self.assertEqual(self.client.get(url, {'fields': 'id'}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        GameModel.objects.filter(id=self.game.id).update(description='Changed')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_archive_fallback(self):
+        response = self.client.get(reverse('api_v1:post_detail', kwargs={'pk': self.archived.id}), {'fields': 'title'})
+        self.assertEqual(response.json(), {'title': 'Old'})
+        response = self.client.get(reverse('api_v1:post_comments', kwargs={'pk': self.archived.id}),
+                                   {'fields': 'username,message'})
+        self.assertEqual(response.json()['results'], [{'username': 'reader', 'message': 'Archived comment'}])
+        self.assertEqual(self.client.get(reverse('api_v1:post_detail', kwargs={'pk': 10 ** 6})).status_code, 404)
+
+
+class ConditionalGetTests(TestCase):
+    """
+    304 на страницах игры и поста только при совпадении ETag, который учитывает пользователя, параметры запроса,
+    подписку и голоса из буфера
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        # Шаблоны показывают аватарку пользователя
+        cls.user = User.objects.create_user('reader', 'reader@example.com', 'password', check_email=True,
+                                            avatar='users_images/reader.png')
+        cls.game = create_game('Game')
+        cls.post = create_post(cls.game, '1')
+
+    def setUp(self):
+        # Redis не откатывается вместе с базой, подписки с тем же id пользователя могли остаться от других тестов
+        cache.delete(Subscription.cache_key(self.user.id))
+        self.game_url = reverse('news:game_detail', kwargs={'pk': self.game.id})
+        self.post_url = reverse('news:post_detail', kwargs={'pk': self.post.id})
+
+    def assert_not_modified(self, url, etag, modified=False, **params):
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200 if modified else 304)
+
+    def test_game_page(self):
+        response = self.client.get(self.game_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response)
+        etag = response['ETag']
+        self.assert_not_modified(self.game_url, etag)
+        # Только дата изменения без ETag страницу не подтверждает
+        self.assertEqual(self.client.get(self.game_url, HTTP_IF_MODIFIED_SINCE=http_date()).status_code, 200)
+        self.client.force_login(self.user)
+        self.assert_not_modified(self.game_url, etag, modified=True)
+        etag = self.client.get(self.game_url)['ETag']
+        Subscription.objects.create(user=self.user, game=self.game)
+        self.assert_not_modified(self.game_url, etag, modified=True)
+
+    @mock.patch('news.views.post_votes_version')
+    def test_post_page(self, post_votes_version):
+        post_votes_version.return_value = b'1'
+        etag = self.client.get(self.post_url)['ETag']
+        self.assert_not_modified(self.post_url, etag)
+        self.assert_not_modified(self.post_url, etag, modified=True, page=1)
+        # Голос в буфере redis меняет версию, хотя пост в базе ещё не изменился
+        post_votes_version.return_value = b'2'
+        self.assert_not_modified(self.post_url, etag, modified=True)
+        etag = self.client.get(self.post_url)['ETag']
+        PostUserComment.objects.create(user=self.user, post=self.post, message='Comment')
+        self.assert_not_modified(self.post_url, etag, modified=True)
+
+
+class SearchTests(TestCase):
+    """
+    Полнотекстовый поиск игр и постов: совпадения по словам выше похожих по триграммам, заголовок весит больше текста
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.dragon = create_game('Dragon Quest', description='Adventure')
+        cls.dragoon = create_game('Dragoon', description='Adventure')
+        cls.witcher = create_game('The Witcher', description='Fantasy')
+        create_game('Portal', description='Puzzle')
+        # Слово в тексте поста весит меньше, чем в заголовке
+        cls.in_content = create_post(cls.dragon, '1', title='Patch notes', content='New dragon mounts')
+        cls.in_title = create_post(cls.dragon, '2', title='Dragon festival', content='Event')
+        create_post(cls.witcher, '3', title='Patch notes', content='Bug fixes')
+
+    def test_word_match_ranks_above_similar_name(self):
+        self.assertEqual(list(GameModel.objects.search('dragon')), [self.dragon, self.dragoon])
+
+    def test_typo(self):
+        self.assertEqual(list(GameModel.objects.search('witcer')), [self.witcher])
+
+    def test_word_from_description(self):
+        self.assertEqual(list(GameModel.objects.search('fantasy')), [self.witcher])
+
+    def test_title_weighs_more_than_content(self):
+        self.assertEqual(list(GameNewsPost.objects.search('dragons')), [self.in_title, self.in_content])
+
+    def test_russian_stemming(self):
+        post = create_post(self.witcher, '4', title='Новые драконы', content='Текст')
+        self.assertEqual(list(GameNewsPost.objects.search('дракон')), [post])
+
+    def test_library_search(self):
+        response = self.client.get(reverse('news:library'), {'search_game': 'dragon'})
+        self.assertEqual(list(response.context['object_list']), [self.dragon, self.dragoon])
+        self.assertEqual(response.context['subs'], set())
+
+
+class SteamCatalogTests(TestCase):
+    """
+    Локальный каталог steam: синхронизация по типам и страницам, поиск сначала по началу названия, затем по словам
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        SteamApp.objects.bulk_create([
+            SteamApp(appid=10, name='The Witcher 3'),
+            SteamApp(appid=20, name='Witchfire'),
+            SteamApp(appid=30, name='Witchfire Soundtrack', type=SteamApp.DLC),
+            SteamApp(appid=40, name='Portal'),
+        ])
+
+    def autocomplete(self, term):
+        response = self.client.get(reverse('news:autocomplete'), {'term': term})
+        self.assertEqual(response['Cache-Control'], 'public, max-age=3600')
+        return response.json()['results']
+
+    def test_prefix_first_then_similar_words(self):
+        self.assertEqual(self.autocomplete('witch'), [{'appid': 20, 'name': 'Witchfire'},
+                                                      {'appid': 10, 'name': 'The Witcher 3'}])
+        self.assertEqual(self.autocomplete('PORT'), [{'appid': 40, 'name': 'Portal'}])
+
+    def test_short_term(self):
+        self.assertEqual(self.autocomplete(' wi '), [])
+
+    def test_search_page_marks_library_games(self):
+        create_game('Witchfire', steam_appid=20)
+        response = self.client.get(reverse('news:search'), {'game_name': 'witch'})
+        self.assertEqual([app.appid for app in response.context['object_list']], [20, 10])
+        self.assertEqual(response.context['game_in_library'], {20})
+
+    @mock.patch('news.tasks.proxy')
+    def test_update(self, proxy):
+        pages = {
+            ('include_games', 0): {'apps': [{'appid': 10, 'name': 'The Witcher 3: Wild Hunt'}],
+                                   'have_more_results': True, 'last_appid': 10},
+            ('include_games', 10): {'apps': [{'appid': 50, 'name': 'New game'}]},
+            ('include_dlc', 0): {'apps': [{'appid': 40, 'name': 'Portal'}]},
+        }
+
+        def request(method, url, fields, **kwargs):
+            flag = next(name for name, value in fields.items() if value == 'true')
+            return mock.Mock(**{'json.return_value': {'response': pages.get((flag, fields['last_appid']), {})}})
+
+        proxy.request.side_effect = request
+        steam_catalog_update()
+        # Страницы каждого типа запрашиваются отдельно, известные приложения обновляются
+        self.assertEqual(proxy.request.call_count, 6)
+        self.assertEqual(dict(SteamApp.objects.values_list('appid', 'name')), {
+            10: 'The Witcher 3: Wild Hunt', 20: 'Witchfire', 30: 'Witchfire Soundtrack', 40: 'Portal', 50: 'New game',
+        })
+        self.assertEqual(SteamApp.objects.get(appid=40).type, SteamApp.DLC)
+
+
+@mock.patch('rpg_agg.ratelimit.overloaded', mock.Mock(return_value=False))
+@mock.patch('rpg_agg.ratelimit.retry_after', mock.Mock(return_value=0))
+class SubscriptionCacheTests(TestCase):
+    """
+    Множество подписок пользователя в redis: запрос к базе только при холодном кэше, сброс при подписке и отписке
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reader', 'reader@example.com', 'password', check_email=True,
+                                            avatar='users_images/reader.png')
+        cls.game = create_game('Game')
+        cls.other = create_game('Other')
+
+    def setUp(self):
+        # Redis не откатывается вместе с базой, подписки с тем же id пользователя могли остаться от других тестов
+        cache.delete(Subscription.cache_key(self.user.id))
+        self.client.force_login(self.user)
+
+    def subscribe(self, name, game):
+        return self.client.get(reverse(f'news:{name}', kwargs={'game_id': game.id}), HTTP_REFERER='/news/library')
+
+    def test_cached(self):
+        Subscription.objects.create(user=self.user, game=self.game)
+        with self.assertNumQueries(1):
+            self.assertEqual(Subscription.game_ids(self.user), {self.game.id})
+        with self.assertNumQueries(0):
+            self.assertEqual(Subscription.game_ids(self.user), {self.game.id})
+
+    def test_anonymous(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(Subscription.game_ids(AnonymousUser()), set())
+
+    def test_subscribe_and_unsubscribe_reset_cache(self):
+        self.assertEqual(Subscription.game_ids(self.user), set())
+        self.assertRedirects(self.subscribe('add_subscribe', self.game), '/news/library', fetch_redirect_response=False)
+        self.subscribe('add_subscribe', self.other)
+        self.assertEqual(Subscription.game_ids(self.user), {self.game.id, self.other.id})
+        self.subscribe('delete_subscribe', self.game)
+        self.assertEqual(Subscription.game_ids(self.user), {self.other.id})
+        self.game.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual((self.game.subscriber_count, self.other.subscriber_count), (0, 1))
+
+    def test_repeated_subscribe(self):
+        self.subscribe('add_subscribe', self.game)
+        self.subscribe('add_subscribe', self.game)
+        self.assertEqual(Subscription.objects.count(), 1)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.subscriber_count, 1)
+
+    def test_subscriptions_feed(self):
+        post = create_post(self.game, '1')
+        create_post(self.other, '2')
+        Subscription.objects.create(user=self.user, game=self.game)
+        response = self.client.get(reverse('news:subs_feed'))
+        self.assertEqual(list(response.context['object_list']), [post])
+        # Кнопки библиотеки берут подписки из того же множества
+        response = self.client.get(reverse('news:library'))
+        self.assertEqual(response.context['subs'], {self.game.id})
+
+
+@mock.patch('news.tasks.proxy')
+@mock.patch('rpg_agg.ratelimit.overloaded', mock.Mock(return_value=False))
+@mock.patch('rpg_agg.ratelimit.retry_after', mock.Mock(return_value=0))
+class GameCheckTests(TestCase):
+    """
+    Проверка игры steam перед добавлением: итог кэшируется, повторные нажатия не ставят новых задач и не идут в steam
+    """
+    appid = 292030
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reader', 'reader@example.com', 'password', check_email=True,
+                                            avatar='users_images/reader.png')
+
+    def setUp(self):
+        # Redis не откатывается вместе с базой, итог проверки мог остаться от других тестов
+        cache.delete_many([game_check_cache_key(self.appid), game_check_pending_key(self.appid)])
+        self.client.force_login(self.user)
+
+    def steam_answers(self, proxy, data=None, success=True):
+        proxy.request.return_value.json.return_value = {str(self.appid): {'success': success, 'data': data}}
+
+    def test_verdicts(self, proxy):
+        for data, success, result in (
+                (None, False, GAME_NOT_FOUND),
+                ({'type': 'music'}, True, GAME_NOT_GAME),
+                ({'type': 'game', 'genres': [{'id': '1'}]}, True, GAME_NOT_RPG),
+                ({'type': 'game'}, True, GAME_NOT_RPG),
+        ):
+            self.steam_answers(proxy, data, success)
+            self.assertEqual(game_check(self.appid), result)
+            self.assertEqual(cache.get(game_check_cache_key(self.appid)), result)
+
+    def test_steam_error(self, proxy):
+        proxy.request.side_effect = urllib3.exceptions.HTTPError
+        cache.set(game_check_pending_key(self.appid), True)
+        self.assertEqual(game_check(self.appid), GAME_ERROR)
+        self.assertEqual(cache.get(game_check_cache_key(self.appid)), GAME_ERROR)
+        self.assertIsNone(cache.get(game_check_pending_key(self.appid)))
+
+    @mock.patch('news.tasks.game_model_create')
+    def test_rpg_is_created(self, game_model_create, proxy):
+        data = {'type': 'game', 'genres': [{'id': '3'}]}
+        self.steam_answers(proxy, data)
+        self.assertEqual(game_check(self.appid), GAME_QUEUED)
+        game_model_create.assert_called_once_with(data=data)
+        game_model_create.side_effect = OSError
+        cache.delete(game_check_cache_key(self.appid))
+        with self.assertRaises(OSError):
+            game_check(self.appid)
+        # Игра не создана, вместо "будет добавлена" скорая повторная проверка
+        self.assertEqual(cache.get(game_check_cache_key(self.appid)), GAME_ERROR)
+
+    @mock.patch('news.views.game_check')
+    def test_cached_verdict(self, views_game_check, proxy):
+        url = reverse('news:add_game', kwargs={'appid': self.appid})
+        status_url = reverse('news:add_game_status', kwargs={'appid': self.appid})
+        # Повторные нажатия, пока проверка в очереди, новых задач не создают
+        self.assertContains(self.client.get(url), 'Проверяем игру')
+        self.client.get(url)
+        self.assertEqual(self.client.get(status_url).json()['done'], False)
+        views_game_check.delay.assert_called_once_with(self.appid)
+        self.steam_answers(proxy, {'type': 'music'})
+        game_check(self.appid)
+        self.assertEqual(self.client.get(status_url).json()['done'], True)
+        self.assertContains(self.client.get(url), 'не является игрой')
+        self.assertEqual(views_game_check.delay.call_count, 1)
+        self.assertEqual(proxy.request.call_count, 1)
+
+    @mock.patch('news.views.game_check')
+    def test_game_in_library(self, views_game_check, proxy):
+        create_game('Game', steam_appid=self.appid)
+        self.assertContains(self.client.get(reverse('news:add_game', kwargs={'appid': self.appid})),
+                            'уже есть в нашей библиотеке')
+        views_game_check.delay.assert_not_called()
+
+
+class HotScoreTests(TestCase):
+    """
+    "Горячая" лента: порядок по рейтингу с учётом новизны, оценка меняется при голосовании и сверяется задачей
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.game = create_game('Game')
+
+    def hot_feed(self):
+        return list(self.client.get(reverse('news:hot_feed')).context['object_list'])
+
+    def test_formula(self):
+        date = 1700000000
+        # Рейтинг в 10 раз больше весит столько же, сколько HOT_SCORE_TIME_SCALE секунд новизны
+        self.assertAlmostEqual(hot_score(10, date), hot_score(1, date + HOT_SCORE_TIME_SCALE))
+        self.assertEqual(hot_score(0, date), hot_score(1, date))
+        self.assertLess(hot_score(-10, date), hot_score(0, date))
+        self.assertLess(hot_score(100, date), hot_score(0, date + 3 * HOT_SCORE_TIME_SCALE))
+
+    def test_feed_order(self):
+        old_popular = create_post(self.game, '1', date=1700000000)
+        new = create_post(self.game, '2', date=1700000000 + HOT_SCORE_TIME_SCALE)
+        disliked = create_post(self.game, '3', date=1700000000 + HOT_SCORE_TIME_SCALE)
+        self.assertEqual(self.hot_feed(), [disliked, new, old_popular])
+        GameNewsPost.add_votes(old_popular.id, 100, 0)
+        GameNewsPost.add_votes(disliked.id, 0, 10)
+        self.assertEqual(self.hot_feed(), [old_popular, new, disliked])
+
+    def test_refresh(self):
+        posts = [create_post(self.game, str(gid), date=1700000000 + gid, likes=gid, rating_total=gid)
+                 for gid in range(5)]
+        GameNewsPost.objects.update(hot_score=0)
+        hot_scores_refresh(batch_size=2)
+        for post in posts:
+            post.refresh_from_db()
+            self.assertAlmostEqual(post.hot_score, hot_score(post.rating_total, post.date))
+
+
+class ArchiveTests(TestCase):
+    """
+    Перенос в архив постов сверх HOT_POSTS_PER_GAME последних постов игры вместе с комментариями, с теми же id
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reader', 'reader@example.com', 'password', avatar='users_images/a.png')
+        cls.game = create_game('Game', post_count=HOT_POSTS_PER_GAME + 2)
+        cls.other = create_game('Other', post_count=HOT_POSTS_PER_GAME)
+        # Два самых старых поста первой игры выходят за лимит, у второй игры постов ровно по лимиту
+        cls.posts = [create_post(cls.game, f'game-{number}', date=1700000000 + number)
+                     for number in range(HOT_POSTS_PER_GAME + 2)]
+        cls.other_posts = [create_post(cls.other, f'other-{number}', date=1600000000 + number)
+                           for number in range(HOT_POSTS_PER_GAME)]
+        cls.comment = PostUserComment.objects.create(user=cls.user, post=cls.posts[0], message='Old comment')
+
+    def test_outside_hot_limit(self):
+        self.assertEqual(set(GameNewsPost.objects.outside_hot_limit().values_list('id', flat=True)),
+                         {self.posts[0].id, self.posts[1].id})
+
+    def test_news_archive(self):
+        self.assertEqual(news_archive(batch_size=1), 2)
+        self.assertEqual(news_archive(), 0)
+        self.assertEqual(set(ArchivedNewsPost.objects.values_list('id', 'title')),
+                         {(post.id, post.title) for post in self.posts[:2]})
+        self.assertEqual(GameNewsPost.objects.filter(game=self.game).count(), HOT_POSTS_PER_GAME)
+        self.assertEqual(GameNewsPost.objects.filter(game=self.other).count(), HOT_POSTS_PER_GAME)
+        archived_comment = ArchivedComment.objects.get()
+        self.assertEqual((archived_comment.id, archived_comment.post_id, archived_comment.message),
+                         (self.comment.id, self.posts[0].id, 'Old comment'))
+        self.assertFalse(PostUserComment.objects.exists())
+        # Счётчик постов игры учитывает архив
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.post_count, HOT_POSTS_PER_GAME + 2)
+
+    def test_old_link(self):
+        news_archive()
+        response = self.client.get(reverse('news:post_detail', kwargs={'pk': self.posts[0].id}))
+        archived_url = reverse('news:archived_post_detail', kwargs={'pk': self.posts[0].id})
+        self.assertRedirects(response, archived_url, status_code=301)
+        self.assertContains(self.client.get(archived_url), 'Old comment')
+
+
+class VoteBufferTests(TestCase):
+    """
+    Буфер голосов в redis: голос принимается без записи в базу, сбрасывается пачками, после ошибки базы
+    возвращается в буфер, не затирая более новый голос
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'voter{number}', f'voter{number}@example.com', 'password')
+                     for number in range(2)]
+        cls.post = create_post(create_game('Game'), '1')
+
+    def setUp(self):
+        # Redis не откатывается вместе с базой, буфер с теми же id объектов мог остаться от других тестов
+        votes.client.delete(DIRTY_KEY, FLUSH_LOCK_KEY, post_version_key(self.post.id),
+                            *(key(object_type, self.post.id) for key in (voters_key, pending_key, delta_key)
+                              for object_type in ('post', 'comment')))
+
+    def assert_post_rating(self, likes, dislikes):
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.likes, self.post.dislikes), (likes, dislikes))
+        self.assertAlmostEqual(self.post.hot_score, hot_score(likes - dislikes, self.post.date))
+
+    def test_cast_and_flush(self):
+        cast_vote(self.users[0], 'post', self.post.id, 1)
+        cast_vote(self.users[0], 'post', self.post.id, 1)
+        cast_vote(self.users[1], 'post', self.post.id, 1)
+        cast_vote(self.users[1], 'post', self.post.id, -1)
+        self.assertFalse(Vote.objects.exists())
+        # До сброса страницы добавляют несохранённые голоса к счётчикам из базы
+        post, = apply_pending_votes('post', [GameNewsPost.objects.get(id=self.post.id)])
+        self.assertEqual((post.likes, post.dislikes, post.rating_total), (1, 1, 0))
+        self.assertEqual(flush_votes(), 1)
+        self.assertEqual(set(Vote.objects.values_list('user', 'value')),
+                         {(self.users[0].id, 1), (self.users[1].id, -1)})
+        self.assert_post_rating(1, 1)
+        self.assertEqual(flush_votes(), 0)
+        self.assert_post_rating(1, 1)
+
+    def test_known_vote_is_warmed_from_database(self):
+        Vote.objects.create(user=self.users[0], post=self.post, value=1)
+        GameNewsPost.add_votes(self.post.id, 1, 0)
+        cast_vote(self.users[0], 'post', self.post.id, 1)
+        self.assertEqual(flush_votes(), 0)
+        cast_vote(self.users[0], 'post', self.post.id, -1)
+        flush_votes()
+        self.assertEqual(list(Vote.objects.values_list('user', 'value')), [(self.users[0].id, -1)])
+        self.assert_post_rating(0, 1)
+
+    def test_database_error_returns_votes(self):
+        cast_vote(self.users[0], 'post', self.post.id, 1)
+        cast_vote(self.users[1], 'post', self.post.id, 1)
+
+        def vote_again_and_fail(taken):
+            # Пока пачка сохраняется, пользователь успевает передумать
+            cast_vote(self.users[0], 'post', self.post.id, -1)
+            raise DatabaseError
+
+        with mock.patch('news.votes.save_votes', side_effect=vote_again_and_fail):
+            with self.assertRaises(DatabaseError):
+                flush_votes()
+        self.assertFalse(votes.client.exists(FLUSH_LOCK_KEY))
+        self.assertEqual(flush_votes(), 1)
+        self.assertEqual(set(Vote.objects.values_list('user', 'value')),
+                         {(self.users[0].id, -1), (self.users[1].id, 1)})
+        self.assert_post_rating(1, 1)
+
+    def test_votes_of_deleted_post_are_dropped(self):
+        cast_vote(self.users[0], 'post', self.post.id, 1)
+        GameNewsPost.objects.filter(id=self.post.id).delete()
+        self.assertEqual(flush_votes(), 1)
+        self.assertFalse(Vote.objects.exists())
+
+    def test_parallel_flush(self):
+        cast_vote(self.users[0], 'post', self.post.id, 1)
+        votes.client.set(FLUSH_LOCK_KEY, 'other')
+        self.assertEqual(flush_votes(), 0)
+        self.assertFalse(Vote.objects.exists())
+
+
+class CounterTests(TestCase):
+    """
+    Денормализованные счётчики: комментарии поста, посты игры и карма автора при удалении, пересчёт командой
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', 'author@example.com', 'password')
+        cls.voter = User.objects.create_user('voter', 'voter@example.com', 'password')
+        cls.game = create_game('Game', post_count=1)
+        cls.post = create_post(cls.game, '1')
+        cls.comment = PostUserComment.objects.create(user=cls.author, post=cls.post, message='Comment')
+
+    def assert_counters(self, comment_count, karma):
+        self.post.refresh_from_db()
+        self.author.refresh_from_db()
+        self.assertEqual((self.post.comment_count, self.author.karma), (comment_count, karma))
+
+    def delete_comment(self, user):
+        self.client.force_login(user)
+        return self.client.get(reverse('news:delete_comment', kwargs={'comment_id': self.comment.id}),
+                               HTTP_REFERER='/news/my_comments')
+
+    def test_delete_comment(self):
+        self.assert_counters(1, 0)
+        # Комментарий загружен до голоса, из кармы вычитается рейтинг из базы
+        comment = PostUserComment.objects.get(id=self.comment.id)
+        Vote.cast(self.voter, 'comment', self.comment.id, Vote.LIKE)
+        self.assert_counters(1, 1)
+        comment.delete()
+        self.assert_counters(0, 0)
+        # Повторное удаление (параллельный запрос) счётчики не трогает
+        self.comment.delete()
+        self.assert_counters(0, 0)
+
+    def test_only_author_deletes(self):
+        Vote.cast(self.voter, 'comment', self.comment.id, Vote.DISLIKE)
+        self.delete_comment(self.voter)
+        self.assert_counters(1, -1)
+        self.assertRedirects(self.delete_comment(self.author), '/news/my_comments', fetch_redirect_response=False)
+        self.assertFalse(PostUserComment.objects.exists())
+        self.assert_counters(0, 0)
+
+    def test_delete_post(self):
+        self.post.delete()
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.post_count, 0)
+
+    def test_repair_counters(self):
+        GameNewsPost.objects.update(comment_count=5)
+        GameModel.objects.update(post_count=0, subscriber_count=3)
+        call_command('repair_counters', batch_size=1, stdout=io.StringIO())
+        self.post.refresh_from_db()
+        self.game.refresh_from_db()
+        self.assertEqual((self.post.comment_count, self.game.post_count, self.game.subscriber_count), (1, 1, 0))
@@ -1,19 +1,24 @@
 from django.urls import path
 
-from news.views import (GameModelDetailView, MyCommentListView,
+from news.stream import news_stream
+from news.views import (ArchivedPostDetailView, GameModelDetailView, MyCommentListView,
                         MySubscribesListView, NewsFeedOnlySubsView,
-                        NewsFeedView, NewsPostDetailView, OurLibraryListView,
+                        NewsFeedView, NewsHotFeedView, NewsPostDetailView, OurLibraryListView,
                         SearchGame, WriteComment, add_game, add_subscribe,
-                        add_voice, delete_comment, delete_subscribe)
+                        add_game_status, add_voice, delete_comment,
+                        delete_subscribe, game_autocomplete)
 
 app_name = 'news'
 
 urlpatterns = [
     path('feed', NewsFeedView.as_view(), name='feed'),
     path('search', SearchGame.as_view(), name='search'),
+    path('autocomplete', game_autocomplete, name='autocomplete'),
     path('library', OurLibraryListView.as_view(), name='library'),
     path('add_game/<int:appid>', add_game, name='add_game'),
+    path('add_game_status/<int:appid>', add_game_status, name='add_game_status'),
     path('post_detail/<int:pk>', NewsPostDetailView.as_view(), name='post_detail'),
+    path('archive/post_detail/<int:pk>', ArchivedPostDetailView.as_view(), name='archived_post_detail'),
     path('write_comment/<int:post_id>', WriteComment.as_view(), name='write_comment'),
     path('add_voice/<str:object_type>/<int:object_id>/<str:voice_type>', add_voice, name='add_voice'),
     path('my_comments', MyCommentListView.as_view(), name='my_comments'),
@@ -23,4 +28,6 @@ urlpatterns = [
     path('delete_subscribe/<int:game_id>', delete_subscribe, name='delete_subscribe'),
     path('game_detail/<int:pk>', GameModelDetailView.as_view(), name='game_detail'),
     path('only_subs_feed', NewsFeedOnlySubsView.as_view(), name='subs_feed'),
+    path('hot_feed', NewsHotFeedView.as_view(), name='hot_feed'),
+    path('stream', news_stream, name='stream'),
 ]
@@ -1,30 +1,32 @@
-from django.conf import settings
+import hashlib
+
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.views import LoginView
-from django.http import HttpResponseRedirect
-from django.shortcuts import redirect, render
-from django.urls import reverse_lazy
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import Http404, HttpResponseRedirect, JsonResponse
+from django.shortcuts import get_object_or_404, redirect, render
+from django.urls import reverse, reverse_lazy
+from django.utils.decorators import method_decorator
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import CreateView
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.views.generic.list import ListView
-# Библиотека для поиска игр в стиме, не уверен, что она официальная, так как парсит страницу поиска
-from steam import Steam
-# Библиотека с модулем прокси socks, для запросов через прокси
-from urllib3.contrib.socks import SOCKSProxyManager
-from datetime import timedelta
 
 from news.forms import WriteCommentForm
-from news.models import GameModel, GameNewsPost, PostUserComment, Subscription
-from news.tasks import game_model_create
+from news.models import (ArchivedComment, ArchivedNewsPost, GameModel,
+                         GameNewsPost, PostUserComment, SteamApp, Subscription,
+                         Vote)
+from news.tasks import (GAME_CHECK_ERROR_TIMEOUT, GAME_ERROR, GAME_NOT_FOUND,
+                        GAME_NOT_GAME, GAME_NOT_RPG, GAME_QUEUED, game_check,
+                        game_check_cache_key, game_check_pending_key)
+from news.votes import apply_pending_votes, cast_vote, post_votes_version
+from rpg_agg.db_router import UsePrimaryMixin, use_primary
+from rpg_agg.ratelimit import RateLimitMixin, rate_limit
 from users.forms import LoginUserForm
 
-# Для работы библиотеки по поиску игр, необходим API key зарегистрированный в стим для работы с их API
-steam = Steam(settings.STEAM_API_KEY)
-
-# Для доступа к играм и новостям закрытых для ру региона, прокси менеджер из urllib3, по протоколу socks (подойдёт любой)
-proxy = SOCKSProxyManager(settings.PROXY)
-
 
 # Просто базовая страничка
 class IndexView(LoginView):
@@ -40,6 +42,24 @@ class NewsFeedView(ListView):
     paginate_orphans = True
     ordering = '-date'
 
+    # Поиск по заголовкам и тексту новостей
+    def get_queryset(self):
+        # Если через форму было отправлено значение в поле search_news, то мы его получим
+        text = self.request.GET.get('search_news', '')
+        if text:
+            # Полнотекстовый поиск, результаты отсортированы по релевантности
+            return GameNewsPost.objects.search(text)
+        return super(NewsFeedView, self).get_queryset()
+
+
+# "Горячая" лента, посты отсортированы по сохранённой оценке популярности (рейтинг с учётом новизны) по индексу
+class NewsHotFeedView(ListView):
+    model = GameNewsPost
+    template_name = 'news/feed.html'
+    paginate_by = 12
+    paginate_orphans = True
+    ordering = ('-hot_score', '-id')
+
 
 # Кнопка "Подписки" на странице ленты, чтобы отобразить новости только тех игр, на которые он подписан
 class NewsFeedOnlySubsView(LoginRequiredMixin, ListView):
@@ -48,31 +68,45 @@ class NewsFeedOnlySubsView(LoginRequiredMixin, ListView):
     paginate_orphans = True
 
     def get_queryset(self):
-        # Сначала собираются id игр через связь User-SubModel-GameModel
-        subs = [sub.game.id for sub in Subscription.objects.filter(user=self.request.user)]
-        # Потом тупо отфильтровываются новости через список id в subs
-        return [post for post in GameNewsPost.objects.all().order_by('-date') if post.game.id in subs]
+        # Новости игр, на которые подписан пользователь, id игр берутся из закэшированного множества подписок
+        return GameNewsPost.objects.filter(game_id__in=Subscription.game_ids(self.request.user)).order_by('-date')
 
 
-# Поиск игр в steam через библиотеку Steam
+# Поиск игр steam по локальному каталогу (news.models.SteamApp), без запросов к steam
 class SearchGame(ListView):
     template_name = 'news/search.html'
+    # Сколько результатов показываем
+    results_limit = 20
 
     def get_queryset(self):
         # Если через форму было отправлено значение в поле game_name, то мы его получим
         game_name = self.request.GET.get('game_name', '')
-        # Подкапотная магия из библиотеки Steam, с полученным именем, если оно не пустое
-        game_list = steam.apps.search_games(game_name).get('apps') if game_name else []
-        # По итогу возвращается список словарей, где словарь=игра, больше пяти не возвращается
-        return game_list
+        if not game_name:
+            return []
+        # Список найденных игр, сначала совпадения по началу названия, затем похожие
+        return list(SteamApp.objects.filter(type=SteamApp.GAME).search(game_name)[:self.results_limit])
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super(SearchGame, self).get_context_data(object_list=object_list, **kwargs)
-        # Список уникальных для steam номеров, чтобы видеть, есть ли эта игра уже у нас или нет
-        context['game_in_library'] = [game.steam_appid for game in GameModel.objects.all()]
+        # Множество steam номеров найденных игр, которые уже есть у нас, одним запросом по индексу steam_appid
+        appids = [app.appid for app in context['object_list']]
+        context['game_in_library'] = set(
+            GameModel.objects.filter(steam_appid__in=appids).values_list('steam_appid', flat=True)
+        ) if appids else set()
         return context
 
 
+# Автодополнение названий игр для полей поиска, отвечает JSON'ом из локального каталога steam
+@cache_control(public=True, max_age=3600)
+def game_autocomplete(request) -> JsonResponse:
+    term = request.GET.get('term', '').strip()
+    # На одну-две буквы подсказки бессмысленны, а запрос получился бы тяжёлым
+    if len(term) < 3:
+        return JsonResponse({'results': []})
+    apps = SteamApp.objects.filter(type=SteamApp.GAME).search(term).values('appid', 'name')[:10]
+    return JsonResponse({'results': list(apps)})
+
+
 # Страничка библиотеки с играми, которые есть в базе
 class OurLibraryListView(ListView):
     template_name = 'news/library.html'
@@ -81,13 +115,9 @@ class OurLibraryListView(ListView):
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super(OurLibraryListView, self).get_context_data(object_list=object_list, **kwargs)
-        # Если пользователь авторизован, мы получим список id игр, на которые он подписан
+        # Множество id игр, на которые подписан пользователь (из кэша), для неавторизованного пустое
         # Если подписан кнопка-Отписаться, если нет-Подписаться
-        # Если не авторизован, список пуст
-        if self.request.user.is_authenticated:
-            context['subs'] = [sub.game.id for sub in Subscription.objects.filter(user=self.request.user)]
-        else:
-            context['subs'] = []
+        context['subs'] = Subscription.game_ids(self.request.user)
         return context
 
     # Здесь реализован поиск игры уже по нашему сайту, просто для удобства поиска пользователю
@@ -95,78 +125,144 @@ class OurLibraryListView(ListView):
         # Если через форму было отправлено значение в поле game_name, то мы его получим
         name = self.request.GET.get('search_game', '')
         if name:
-            # Если имя было отправлено, поиск осуществляется в Базе Данных через Django ORM
-            return GameModel.objects.all().filter(name__icontains=name).order_by('name')
+            # Если имя было отправлено, полнотекстовый и триграммный поиск по индексам, сортировка по релевантности
+            return GameModel.objects.search(name)
         return GameModel.objects.all().order_by('name')
 
 
-# Функция добавления игры, декораторы проверяют авторизован ли пользователь и подтверждена ли почта
+# Сообщения для каждого итога проверки игры из news.tasks.game_check: (заголовок, текст)
+GAME_CHECK_MESSAGES = {
+    GAME_QUEUED: ('Отлично', 'Скоро игра будет добавлена в нашу библиотеку'),
+    GAME_NOT_GAME: ('Упс', 'Этот объект не является игрой'),
+    GAME_NOT_RPG: ('Упс', 'Среди жанров этой игры РПГ не было найдено'),
+    GAME_NOT_FOUND: ('Упс', 'Steam не знает такой игры'),
+    GAME_ERROR: ('Упс', 'Steam сейчас не отвечает, попробуйте немного позже'),
+}
+GAME_CHECK_PENDING_MESSAGE = ('Минутку', 'Проверяем игру в steam')
+
+
+# Функция добавления игры, декораторы проверяют авторизован ли пользователь и подтверждена ли почта, и частоту запросов
+# Проверка игры в steam идёт в celery, веб воркер никогда не ждёт steam
 @login_required
 @user_passes_test(lambda u: u.check_email, login_url='users:not_verify')
+@rate_limit('add_game')
 def add_game(request, appid: int) -> render:
     template_name = 'users/message_template.html'
 
     # Заготовка контекста
     context = {
-        'message_head': 'Упс',
-        'redirect_url': request.META['HTTP_REFERER'],
+        'redirect_url': request.META.get('HTTP_REFERER', reverse('news:search')),
         'button_name': 'Вернуться'
     }
 
-    # Ссылка с адресом указанным в документации steam web api, куда вставляется appid
-    game_url = f'https://store.steampowered.com/api/appdetails/?appids={appid}&l=russian'
-    # Выполняем get запрос, на указанный адрес, конвертируем в словарь
-    # И сразу же берем значение по ключу appid(в виде строки)
-    game_data = proxy.request('GET', game_url).json()[str(appid)]
-    # Берём основную информацию по игре, которая хранится в ключе data
-    game_data = game_data['data']
-    # Проверяем, тип, так как в поиске стим также может возвращать саундтреки, фильмы и проч.
-    if game_data['type'] != 'game':
-        context['message'] = 'Этот объект не является игрой'
+    # Если игра уже есть в библиотеке, в steam идти незачем
+    if GameModel.objects.filter(steam_appid=appid).exists():
+        context['message_head'], context['message'] = 'Отлично', 'Эта игра уже есть в нашей библиотеке'
         return render(request, template_name=template_name, context=context)
-    # Проверяем есть ли среди жанров этой игры, жанр РПГ, его id в steam это цифра 3
-    if '3' in [genre['id'] for genre in game_data['genres']]:
-        # Если РПГ присутствует, отправляем на выполнение отложенную задачу из news.tasks
-        game_model_create.delay(data=game_data)
-        # Корректируем контекст
-        context['message_head'] = 'Отлично'
-        context['message'] = 'Скоро игра будет добавлена в нашу библиотеку'
-        # Перенаправляем на страничку с сообщением
-        return render(request, template_name=template_name, context=context)
-    # Если РПГ в списке не было
-    else:
-        context['message'] = 'Среди жанров этой игры РПГ не было найдено'
+
+    # Итог проверки этой игры уже известен (в том числе отрицательный)
+    result = cache.get(game_check_cache_key(appid))
+    if result is not None:
+        context['message_head'], context['message'] = GAME_CHECK_MESSAGES[result]
         return render(request, template_name=template_name, context=context)
 
+    # Ставим проверку в очередь, cache.add атомарен, поэтому повторные нажатия не создают лишних задач
+    if cache.add(game_check_pending_key(appid), True, GAME_CHECK_ERROR_TIMEOUT):
+        game_check.delay(appid)
+    # Страничка сама опросит add_game_status и покажет итог
+    context['message_head'], context['message'] = GAME_CHECK_PENDING_MESSAGE
+    context['status_url'] = reverse('news:add_game_status', kwargs={'appid': appid})
+    return render(request, template_name=template_name, context=context)
+
+
+# Итог проверки игры для опроса со странички add_game
+@login_required
+def add_game_status(request, appid: int) -> JsonResponse:
+    result = cache.get(game_check_cache_key(appid))
+    # Ни итога, ни отметки о проверке в очереди: воркер не успел или упал, ставим проверку заново
+    if result is None and cache.add(game_check_pending_key(appid), True, GAME_CHECK_ERROR_TIMEOUT):
+        game_check.delay(appid)
+    message_head, message = GAME_CHECK_MESSAGES[result] if result is not None else GAME_CHECK_PENDING_MESSAGE
+    return JsonResponse({'done': result is not None, 'message_head': message_head, 'message': message},
+                        json_dumps_params={'ensure_ascii': False})
+
+
+# Время последнего изменения объекта, один запрос по первичному ключу, результат запоминается на время запроса
+def object_updated_at(request, model, pk):
+    attr = f'_{model._meta.model_name}_updated_at'
+    if not hasattr(request, attr):
+        setattr(request, attr, model.objects.filter(id=pk).values_list('updated_at', flat=True).first())
+    return getattr(request, attr)
+
+
+# Версия страницы для ETag: время изменения объекта, кто смотрит (шапка и кнопки зависят от пользователя),
+# параметры запроса (номер страницы) и прочие части, влияющие на содержимое
+def page_etag(request, updated_at, *parts):
+    if updated_at is None:
+        return None
+    version = ':'.join(str(part) for part in (updated_at.timestamp(), request.user.id, request.GET.urlencode(), *parts))
+    return hashlib.md5(version.encode()).hexdigest()
+
+
+def game_detail_etag(request, pk):
+    # Кнопка подписки тоже часть страницы, её состояние берётся из закэшированного множества подписок
+    return page_etag(request, object_updated_at(request, GameModel, pk), pk in Subscription.game_ids(request.user))
+
+
+def post_detail_etag(request, pk):
+    # Голоса из буфера (ещё не в базе) тоже меняют страницу
+    return page_etag(request, object_updated_at(request, GameNewsPost, pk), post_votes_version(pk))
+
 
 # Детальная страница игры
+# Браузер каждый раз перепроверяет страницу (no-cache), и если она не менялась (If-None-Match),
+# получает 304 ещё до основных запросов и рендеринга шаблона
+# Только по ETag: Last-Modified не учитывает пользователя, номер страницы и голоса из буфера
+@method_decorator([cache_control(private=True, no_cache=True),
+                   condition(etag_func=game_detail_etag)],
+                  name='dispatch')
 class GameModelDetailView(DetailView):
     model = GameModel
     template_name = 'news/game_detail.html'
 
+    # Новости игры, date и created_timestamp совпадают, но сортировка по date идёт по индексу (game, -date)
+    @staticmethod
+    def news_queryset(game_id):
+        return GameNewsPost.objects.filter(game_id=game_id).order_by('-date')
+
     def get_context_data(self, **kwargs):
         context = super(GameModelDetailView, self).get_context_data(**kwargs)
         # Собираем все новости по этой игре
-        context['game_news'] = GameNewsPost.objects.filter(game=self.object).order_by('-created_timestamp')
-        # Если пользователь авторизован, мы получим список id игр, на которые он подписан
+        context['game_news'] = self.news_queryset(self.object.id)
+        # Множество id игр, на которые подписан пользователь (из кэша), для неавторизованного пустое
         # Если подписан кнопка-Отписаться, если нет-Подписаться
-        # Если не авторизован, список пуст
-        if self.request.user.is_authenticated:
-            context['subs'] = [sub.game.id for sub in Subscription.objects.filter(user=self.request.user)]
-        else:
-            context['subs'] = []
+        context['subs'] = Subscription.game_ids(self.request.user)
         return context
 
 
 # Детальная страница новостного поста, но по сути это страница со списком комментариев к определенному посту
+# Условные GET запросы так же, как у страницы игры
+@method_decorator([cache_control(private=True, no_cache=True),
+                   condition(etag_func=post_detail_etag)],
+                  name='dispatch')
 class NewsPostDetailView(ListView):
     template_name = 'news/post_detail.html'
     paginate_by = 30
 
+    def get(self, request, *args, **kwargs):
+        # Пост, чей id получен через url
+        self.object = GameNewsPost.objects.select_related('game').filter(id=kwargs['pk']).first()
+        if self.object is None:
+            # Старые посты переносятся в архив с тем же id, ссылки на них продолжают работать
+            get_object_or_404(ArchivedNewsPost.objects.only('id'), id=kwargs['pk'])
+            return redirect('news:archived_post_detail', pk=kwargs['pk'], permanent=True)
+        return super(NewsPostDetailView, self).get(request, *args, **kwargs)
+
     def get_context_data(self, **kwargs):
         context = super(NewsPostDetailView, self).get_context_data(**kwargs)
-        # контекст с данными поста, чей id получен через url
-        context['object'] = GameNewsPost.objects.get(id=self.kwargs['pk'])
+        # Счётчики голосов вместе с ещё не сохранёнными в базу голосами из буфера
+        context['object'] = apply_pending_votes('post', [self.object])[0]
+        context['object_list'] = apply_pending_votes('comment', context['object_list'])
         return context
 
     # Список комментариев к данному посту
@@ -174,9 +270,25 @@ class NewsPostDetailView(ListView):
         return PostUserComment.objects.filter(post_id=self.kwargs['pk']).order_by('created_timestamp')
 
 
+# Архивный пост, только для чтения: без голосования и новых комментариев
+class ArchivedPostDetailView(ListView):
+    template_name = 'news/post_detail.html'
+    paginate_by = 30
+    extra_context = {'archived': True}
+
+    def get_context_data(self, **kwargs):
+        context = super(ArchivedPostDetailView, self).get_context_data(**kwargs)
+        context['object'] = get_object_or_404(ArchivedNewsPost.objects.select_related('game'), id=self.kwargs['pk'])
+        return context
+
+    def get_queryset(self):
+        return ArchivedComment.objects.filter(post_id=self.kwargs['pk']).order_by('created_timestamp')
+
+
 # Написание комментария, с миксинами проверяющими аутентификацию и верификацию пользователя
-class WriteComment(LoginRequiredMixin, UserPassesTestMixin, CreateView):
+class WriteComment(UsePrimaryMixin, LoginRequiredMixin, UserPassesTestMixin, RateLimitMixin, CreateView):
     form_class = WriteCommentForm
+    rate_limit_scope = 'comment'
 
     def get_success_url(self):
         # Возвращает на ту же страницу где был отправлен комментарий
@@ -186,10 +298,9 @@ class WriteComment(LoginRequiredMixin, UserPassesTestMixin, CreateView):
         # Заполняем необходимые данные для создания модели Поста
         form.instance.user = self.request.user
         form.instance.post = GameNewsPost.objects.get(id=self.kwargs['post_id'])
-        form.instance.rating = {'total': 0, 'likes': [], 'dislikes': []}
         form.instance.message = self.request.POST['message']
-        # Время после которого пользователь не сможет удалить свой комментарий
-        form.instance.finish_timestamp = form.instance.created_timestamp + timedelta(minutes=5)
+        # Время, после которого пользователь не сможет удалить свой комментарий, и счётчик комментариев поста
+        # заполняются при сохранении комментария, см. PostUserComment.save
         return super(WriteComment, self).form_valid(form=form)
 
     # Функция необходимая для миксина UserPassesTestMixin, которая возвращает объект, чью истинность надо проверить
@@ -211,6 +322,11 @@ class MyCommentListView(LoginRequiredMixin, ListView):
         # Возвращает список комментариев пользователя отсортированных по убыванию времени их создания
         return PostUserComment.objects.filter(user=self.request.user).order_by('-created_timestamp')
 
+    def get_context_data(self, **kwargs):
+        context = super(MyCommentListView, self).get_context_data(**kwargs)
+        context['object_list'] = apply_pending_votes('comment', context['object_list'])
+        return context
+
 
 # Страничка где пользователь может просмотреть свои подписки
 class MySubscribesListView(LoginRequiredMixin, ListView):
@@ -220,17 +336,18 @@ class MySubscribesListView(LoginRequiredMixin, ListView):
     def get_queryset(self):
         # Если через форму было отправлено значение в поле search_name, то мы его получим
         name = self.request.GET.get('search_game', '')
-        # Cписок (querySet) подписок пользователя через связь Foreign Key
-        queryset = Subscription.objects.filter(user=self.request.user)
+        # Игры, на которые подписан пользователь, через связь GameModel-Subscription
+        queryset = GameModel.objects.filter(subscription__user=self.request.user)
         # Если в поиске введено имя
         if name:
-            # Список игр по подпискам, которые содержат в имени подстроку name, сортировка в алфавитном порядке по имени
-            return [sub.game for sub in queryset.filter(game__name__icontains=name).order_by('game__name')]
-        # Иначе список игр по подпискам без поиска
-        return [sub.game for sub in queryset.order_by('game__name')]
+            # Игры по подпискам, найденные поиском, сортировка по релевантности
+            return queryset.search(name)
+        # Иначе игры по подпискам без поиска
+        return queryset.order_by('name')
 
 
 # Позволяет удалить свой комментарий пользователю, декоратор проверяет авторизован ли он
+@use_primary
 @login_required
 def delete_comment(request, comment_id: int) -> HttpResponseRedirect:
     # Находим комментарий по его id полученному через url
@@ -242,42 +359,29 @@ def delete_comment(request, comment_id: int) -> HttpResponseRedirect:
     return HttpResponseRedirect(request.META['HTTP_REFERER'])
 
 
-# Позволяет проголосовать, в декораторах проверка авторизации и верификации пользователя
+# Позволяет проголосовать, в декораторах проверка авторизации и верификации пользователя и частоты запросов
+@use_primary
 @login_required
 @user_passes_test(lambda u: u.check_email, login_url='users:not_verify')
+@rate_limit('vote')
 def add_voice(request, object_type: str, object_id: int, voice_type: str) -> HttpResponseRedirect:
-    username = request.user.username
-    # Типы объектов которые могли получить голос
-    voice_object = {
-        'post': GameNewsPost,
-        'comment': PostUserComment
-    }
-    # Через словарь получаем тип объекта и находим его через полученный id
-    voice_object = voice_object[object_type].objects.get(id=object_id)
-    # Противоположность, каждого голоса, чтобы к полученному прибавлять, у противоположного убавлять
-    opposite_voice = {
-        'likes': 'dislikes',
-        'dislikes': 'likes'
-    }
-    # Получаем тип противоположного голоса
-    opposite_voice = opposite_voice[voice_type]
-    # Доп. проверка, что пользователя нет в списке проголосовавших к объекту тем или иным голосом
-    if username not in voice_object.rating[voice_type]:
-        # Если его нет, смело добавляем
-        voice_object.rating[voice_type].append(username)
-
-    # Если пользователь есть в списке противоположно проголосовавших, убираем его оттуда
-    if username in voice_object.rating[opposite_voice]:
-        voice_object.rating[opposite_voice].remove(username)
-    # Cохраняем изменения
-    voice_object.save()
+    # Типы объектов которые могут получить голос и типы голосов
+    if object_type not in Vote.TARGETS or voice_type not in Vote.VOICES:
+        raise Http404
+    # Голос принимается в буфер redis и сохраняется в базу задачей votes_flush, см. news.votes
+    try:
+        cast_vote(request.user, object_type, object_id, Vote.VOICES[voice_type])
+    except ObjectDoesNotExist:
+        raise Http404
     # Возвращает на ту же страницу, откуда делался запрос
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
 
-# Функция добавления подписки, декораторы проверяют авторизацию и верификацию
+# Функция добавления подписки, декораторы проверяют авторизацию, верификацию и частоту запросов
+@use_primary
 @login_required
 @user_passes_test(lambda u: u.check_email, login_url='users:not_verify')
+@rate_limit('subscribe')
 def add_subscribe(request, game_id: int) -> HttpResponseRedirect:
     # Находим игру по id полученному через url
     game = GameModel.objects.get(id=game_id)
@@ -290,6 +394,7 @@ def add_subscribe(request, game_id: int) -> HttpResponseRedirect:
 
 
 # Функция удаления подписки, декоратор проверяет авторизацию
+@use_primary
 @login_required
 def delete_subscribe(request, game_id: int) -> HttpResponseRedirect:
     # Берём пользователя сделавшего запрос
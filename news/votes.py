@@ -0,0 +1,222 @@
+"""
+Буфер голосов в redis (write-behind)
+Голос сразу принимается в redis и подтверждается пользователю, без записи в базу и без блокировки строки поста
+Для каждого объекта (поста или комментария) в redis хранятся:
+    voters  - известные голоса пользователей (прогреваются из таблицы Vote) и id поста, к странице которого относится объект
+    pending - ещё не сохранённые в базу голоса пользователей
+    delta   - ещё не сохранённые изменения счётчиков likes / dislikes
+Задача news.tasks.votes_flush каждые несколько секунд сохраняет накопленное в базу пачками (flush_votes),
+а страницы до этого момента добавляют delta к счётчикам из базы (apply_pending_votes)
+Если redis недоступен, голос пишется сразу в базу (Vote.cast)
+"""
+import redis
+from django.conf import settings
+from django.db import transaction
+from redis.exceptions import LockNotOwnedError
+
+from news.models import Vote
+from users.models import User
+
+# Сколько хранятся известные голоса объекта, продлевается при каждом голосе
+VOTERS_TIMEOUT = 60 * 60 * 24
+# Сколько объектов сохраняется в базу одной транзакцией
+FLUSH_BATCH_SIZE = 500
+# Множество объектов ("post:1", "comment:2") с несохранёнными голосами
+DIRTY_KEY = 'votes:dirty'
+# Блокировка, чтобы сбросы буфера не шли параллельно и не переставляли голоса одного пользователя
+FLUSH_LOCK_KEY = 'votes:flush'
+FLUSH_LOCK_TIMEOUT = 60
+
+client = redis.Redis.from_url(settings.REDIS_URL)
+
+# Голос пользователя атомарно: такой же голос ничего не меняет, новый или противоположный меняет delta
+# KEYS: voters, pending, delta, dirty, версия голосов страницы поста; ARGV: id пользователя, голос, объект, время жизни
+CAST_SCRIPT = client.register_script("""
+local old = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+local new = tonumber(ARGV[2])
+if old == new then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], new)
+redis.call('HSET', KEYS[2], ARGV[1], new)
+redis.call('HINCRBY', KEYS[3], new == 1 and 'likes' or 'dislikes', 1)
+if old ~= 0 then
+    redis.call('HINCRBY', KEYS[3], old == 1 and 'likes' or 'dislikes', -1)
+end
+redis.call('SADD', KEYS[4], ARGV[3])
+redis.call('INCR', KEYS[5])
+for i = 1, 5 do
+    if i ~= 4 then
+        redis.call('EXPIRE', KEYS[i], ARGV[4])
+    end
+end
+return 1
+""")
+
+
+def voters_key(object_type, object_id):
+    return f'votes:{object_type}:{object_id}:voters'
+
+
+def pending_key(object_type, object_id):
+    return f'votes:{object_type}:{object_id}:pending'
+
+
+def delta_key(object_type, object_id):
+    return f'votes:{object_type}:{object_id}:delta'
+
+
+def post_version_key(post_id):
+    return f'votes:post:{post_id}:version'
+
+
+def warm_voter(user, object_type, object_id):
+    """
+    Первый голос пользователя за объект с момента прогрева: объект и прежний голос читаются из базы
+    Возвращает id поста, к странице которого относится объект, если объекта нет - бросает DoesNotExist его модели
+    """
+    model = Vote.TARGETS[object_type]
+    post_id = model.objects.filter(id=object_id).values_list('id' if object_type == 'post' else 'post_id',
+                                                             flat=True).first()
+    if post_id is None:
+        raise model.DoesNotExist
+    value = Vote.objects.filter(user=user, **{f'{object_type}_id': object_id}).values_list('value', flat=True).first()
+    key = voters_key(object_type, object_id)
+    # HSETNX не затирает голос, принятый параллельным запросом
+    client.pipeline().hsetnx(key, 'post', post_id).hsetnx(key, user.id, value or 0).expire(key, VOTERS_TIMEOUT).execute()
+    return post_id
+
+
+def cast_vote(user, object_type, object_id, value):
+    """
+    Принять голос в буфер, в базу он попадёт при следующем сбросе
+    Если объекта нет, бросает DoesNotExist его модели
+    """
+    key = voters_key(object_type, object_id)
+    try:
+        post_id, known = client.pipeline().hget(key, 'post').hexists(key, user.id).execute()
+        if post_id is None or not known:
+            post_id = warm_voter(user, object_type, object_id)
+        CAST_SCRIPT(
+            keys=[key, pending_key(object_type, object_id), delta_key(object_type, object_id), DIRTY_KEY,
+                  post_version_key(int(post_id))],
+            args=[user.id, value, f'{object_type}:{object_id}', VOTERS_TIMEOUT],
+        )
+    except redis.RedisError:
+        Vote.cast(user, object_type, object_id, value)
+        # Известный голос пользователя в redis теперь устарел, убираем его, чтобы следующий голос прогрел его из базы
+        try:
+            client.hdel(key, user.id)
+        except redis.RedisError:
+            pass
+
+
+def take_pending(object_type, object_id):
+    # Забрать несохранённые голоса и delta объекта одной транзакцией redis
+    pipe = client.pipeline()
+    pipe.hgetall(pending_key(object_type, object_id))
+    pipe.hgetall(delta_key(object_type, object_id))
+    pipe.delete(pending_key(object_type, object_id), delta_key(object_type, object_id))
+    pending, delta, _ = pipe.execute()
+    return ({int(user_id): int(value) for user_id, value in pending.items()},
+            {name.decode(): int(count) for name, count in delta.items()})
+
+
+def return_pending(taken):
+    # Вернуть забранное в буфер после ошибки, более новый голос пользователя, принятый за это время, остаётся
+    pipe = client.pipeline()
+    for (object_type, object_id), (pending, delta) in taken.items():
+        for user_id, value in pending.items():
+            pipe.hsetnx(pending_key(object_type, object_id), user_id, value)
+        for name, count in delta.items():
+            pipe.hincrby(delta_key(object_type, object_id), name, count)
+        pipe.sadd(DIRTY_KEY, f'{object_type}:{object_id}')
+    pipe.execute()
+
+
+def save_votes(taken):
+    # Одна транзакция на пачку объектов: счётчики одним UPDATE на объект, голоса пользователей - заменой строк Vote
+    user_ids = {user_id for pending, _ in taken.values() for user_id in pending}
+    # Голоса удалённых за это время пользователей не сохраняем, иначе вся пачка упадёт на внешнем ключе
+    existing_users = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+    votes = []
+    with transaction.atomic():
+        for (object_type, object_id), (pending, delta) in taken.items():
+            model = Vote.TARGETS[object_type]
+            # Объект мог быть удалён или перенесён в архив, тогда его голоса отбрасываются
+            if not model.add_votes(object_id, delta.get('likes', 0), delta.get('dislikes', 0)):
+                continue
+            target = {f'{object_type}_id': object_id}
+            Vote.objects.filter(user_id__in=pending, **target).delete()
+            votes += [Vote(user_id=user_id, value=value, **target)
+                      for user_id, value in pending.items() if user_id in existing_users]
+        Vote.objects.bulk_create(votes, batch_size=1000)
+
+
+def flush_votes(batch_size=FLUSH_BATCH_SIZE):
+    """
+    Сохранить накопленные в redis голоса в базу, возвращает количество обработанных объектов
+    При ошибке базы голоса возвращаются в буфер, если же воркер упадёт между чтением из redis и записью в базу,
+    будет потеряна не больше чем одна пачка
+    """
+    lock = client.lock(FLUSH_LOCK_KEY, timeout=FLUSH_LOCK_TIMEOUT, blocking_timeout=0)
+    if not lock.acquire():
+        return 0
+    flushed = 0
+    try:
+        while True:
+            members = client.spop(DIRTY_KEY, batch_size)
+            if not members:
+                return flushed
+            taken = {}
+            for member in members:
+                object_type, object_id = member.decode().split(':')
+                taken[(object_type, int(object_id))] = take_pending(object_type, int(object_id))
+            try:
+                save_votes(taken)
+            except Exception:
+                return_pending(taken)
+                raise
+            flushed += len(taken)
+            # Большой буфер может сбрасываться дольше FLUSH_LOCK_TIMEOUT, блокировка продлевается после каждой пачки
+            # Если она уже истекла и перешла к другому сбросу, остаток буфера оставляем ему
+            try:
+                lock.extend(FLUSH_LOCK_TIMEOUT, replace_ttl=True)
+            except LockNotOwnedError:
+                return flushed
+    finally:
+        try:
+            lock.release()
+        except LockNotOwnedError:
+            pass
+
+
+def apply_pending_votes(object_type, objects):
+    """
+    Добавить к счётчикам объектов ещё не сохранённые голоса из буфера, один запрос к redis на страницу
+    Возвращает список объектов
+    """
+    objects = list(objects)
+    if not objects:
+        return objects
+    pipe = client.pipeline(transaction=False)
+    for obj in objects:
+        pipe.hmget(delta_key(object_type, obj.id), 'likes', 'dislikes')
+    try:
+        deltas = pipe.execute()
+    except redis.RedisError:
+        return objects
+    for obj, (likes, dislikes) in zip(objects, deltas):
+        likes, dislikes = int(likes or 0), int(dislikes or 0)
+        obj.likes += likes
+        obj.dislikes += dislikes
+        obj.rating_total += likes - dislikes
+    return objects
+
+
+def post_votes_version(post_id):
+    # Меняется при каждом голосе за пост или его комментарии, часть ETag страницы поста
+    try:
+        return client.get(post_version_key(post_id))
+    except redis.RedisError:
+        return None
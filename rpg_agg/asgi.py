@@ -3,6 +3,9 @@ ASGI config for rpg_agg project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The server-sent events stream (news.stream) needs this entry point, e.g.:
+    uvicorn rpg_agg.asgi:application --workers 2
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
@@ -3,6 +3,9 @@ import os
 from celery import Celery
 from celery.schedules import crontab
 
+# Метрики и строка лога по каждой задаче, модуль подключает обработчики сигналов celery
+from rpg_agg import task_metrics  # noqa: F401
+
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rpg_agg.settings')
 
@@ -13,6 +16,34 @@ app.conf.beat_schedule = {
         'task': 'news.tasks.all_game_news_update',
         'schedule': crontab(minute='0', hour='*/4'),  # Каждые 4 часа
     },
+    'votes_flush_every_5_seconds': {
+        'task': 'news.tasks.votes_flush',
+        'schedule': 5.0,  # Каждые 5 секунд
+    },
+    'steam_catalog_every_day': {
+        'task': 'news.tasks.steam_catalog_update',
+        'schedule': crontab(minute='30', hour='3'),  # Каждый день в 3:30
+    },
+    'hot_scores_every_day': {
+        'task': 'news.tasks.hot_scores_refresh',
+        'schedule': crontab(minute='0', hour='5'),  # Каждый день в 5:00
+    },
+    'news_archive_every_day': {
+        'task': 'news.tasks.news_archive',
+        'schedule': crontab(minute='30', hour='5'),  # Каждый день в 5:30
+    },
+    'subscribers_digest_every_day': {
+        'task': 'news.tasks.subscribers_digest',
+        'schedule': crontab(minute='0', hour='9'),  # Каждый день в 9:00
+    },
+    'karma_every_day': {
+        'task': 'users.tasks.karma_reconcile',
+        'schedule': crontab(minute='0', hour='4'),  # Каждый день в 4:00
+    },
+    'send_outbox_every_minute': {
+        'task': 'users.tasks.send_outbox',
+        'schedule': crontab(),  # Каждую минуту, повторные попытки отправки писем
+    },
     'every_midnight': {
         'task': 'users.tasks.check_finish_email_verify',
         'schedule': crontab(minute='0', hour='0'),  # Каждый день в полночь
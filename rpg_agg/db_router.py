@@ -0,0 +1,132 @@
+"""
+Маршрутизация запросов к базе между основной базой (default) и репликами (settings.DATABASE_REPLICAS)
+
+На реплики уходят только чтения из "безопасных" (GET/HEAD) запросов к сайту, всё остальное (celery задачи,
+команды manage.py, POST запросы, представления помеченные use_primary) работает с основной базой
+Пользователь, который только что что-то записал, на PRIMARY_PIN_SECONDS закрепляется за основной базой (cookie),
+чтобы сразу видеть свои изменения, даже если реплика ещё не догнала основную базу
+Реплика, отставшая больше чем на REPLICA_MAX_LAG_SECONDS, временно не используется
+"""
+import contextvars
+import random
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+
+# Читать с реплики можно только внутри запроса, который разрешил это middleware, по умолчанию - основная база
+_use_replica = contextvars.ContextVar('use_replica', default=False)
+# Была ли в этом запросе запись в базу
+_wrote = contextvars.ContextVar('wrote', default=False)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PIN_COOKIE = 'use_primary'
+# Приложения, запись в которые не закрепляет пользователя за основной базой: сессии сохраняются попутно
+# (вход, выход, сообщения), а не действием, результат которого пользователь должен сразу увидеть
+PIN_EXEMPT_APPS = ('sessions',)
+
+# Отставание реплик, проверяется не чаще раза в LAG_CHECK_SECONDS на процесс: {алиас: (время проверки, отставание)}
+LAG_CHECK_SECONDS = 5
+_replica_lag = {}
+
+# Отставание реплики в секундах, на основной базе (не в режиме восстановления) и у догнавшей реплики - 0
+# Реплика без подключённого WAL receiver (нет строки в pg_stat_wal_receiver или статус не streaming) не получает
+# новых изменений, даже если всё полученное уже применено, и считается бесконечно отставшей
+# Статус виден пользователю с ролью pg_read_all_stats, без неё - только наличие процесса WAL receiver
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE coalesce(status, 'streaming') = 'streaming')
+            THEN 'Infinity'::float8
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp())::float8, 'Infinity'::float8)
+    END
+"""
+
+
+def replica_lag(alias):
+    checked, lag = _replica_lag.get(alias, (0, 0))
+    if time.monotonic() - checked > LAG_CHECK_SECONDS:
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(LAG_SQL)
+                lag = float(cursor.fetchone()[0])
+        except Exception:
+            # Недоступная реплика считается бесконечно отставшей до следующей проверки
+            lag = float('inf')
+        _replica_lag[alias] = (time.monotonic(), lag)
+    return lag
+
+
+def available_replicas():
+    return [alias for alias in settings.DATABASE_REPLICAS if replica_lag(alias) <= settings.REPLICA_MAX_LAG_SECONDS]
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not _use_replica.get():
+            return 'default'
+        replicas = available_replicas()
+        return random.choice(replicas) if replicas else 'default'
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label not in PIN_EXEMPT_APPS:
+            _wrote.set(True)
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики - копии основной базы, связи между объектами из любых алиасов допустимы
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Реплики получают схему через репликацию
+        return db == 'default'
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Разрешает чтение с реплик для безопасных запросов, если пользователь не закреплён за основной базой,
+    и закрепляет пользователя за основной базой после запроса, в котором была запись
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        use_replica = request.method in SAFE_METHODS and PIN_COOKIE not in request.COOKIES
+        replica_token = _use_replica.set(use_replica)
+        wrote_token = _wrote.set(False)
+        try:
+            response = self.get_response(request)
+            wrote = _wrote.get()
+        finally:
+            _use_replica.reset(replica_token)
+            _wrote.reset(wrote_token)
+        if wrote:
+            response.set_cookie(PIN_COOKIE, '1', max_age=settings.PRIMARY_PIN_SECONDS, httponly=True, samesite='Lax')
+        return response
+
+
+def use_primary(view):
+    """
+    Декоратор для представлений, которые читают и затем пишут (в том числе на GET запросах),
+    все их запросы идут в основную базу, чтобы не принять решение по устаревшим данным реплики
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = _use_replica.set(False)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            _use_replica.reset(token)
+    return wrapper
+
+
+class UsePrimaryMixin:
+    """
+    То же, что use_primary, для представлений-классов
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        return use_primary(super(UsePrimaryMixin, self).dispatch)(request, *args, **kwargs)
@@ -0,0 +1,162 @@
+"""
+Метрики в формате Prometheus (prometheus_client), отдаются представлением metrics_view по адресу /metrics
+
+    MetricsMiddleware       - время ответа, количество и время SQL запросов на представление
+    TimedDjangoTemplates    - бэкенд шаблонов, замеряющий рендеринг страниц (settings.TEMPLATES)
+    InstrumentedRedisCache  - бэкенд кэша, считающий попадания и промахи по префиксу ключа (settings.CACHES)
+    InstrumentedProxy       - обёртка прокси для запросов к steam, считает статусы ответов и время
+
+Всё агрегируется в памяти процесса, на запрос приходится несколько операций с счётчиками
+При нескольких процессах (gunicorn, uvicorn --workers) нужно задать переменную окружения PROMETHEUS_MULTIPROC_DIR
+(пустая папка, очищается при перезапуске), тогда процессы пишут метрики в файлы, а /metrics собирает их вместе
+"""
+import os
+import time
+from contextlib import ExitStack
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.cache.backends.redis import RedisCache
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template.backends.django import DjangoTemplates, Template
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Время ответа представления',
+                            ['view', 'method', 'status'])
+REQUEST_QUERIES = Histogram('http_request_db_queries', 'SQL запросов на запрос к представлению', ['view'],
+                            buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200))
+REQUEST_DB_TIME = Histogram('http_request_db_duration_seconds', 'Время SQL запросов на запрос к представлению',
+                            ['view'])
+TEMPLATE_RENDER = Histogram('template_render_duration_seconds', 'Время рендеринга шаблона страницы', ['template'])
+CACHE_REQUESTS = Counter('cache_requests_total', 'Чтения из кэша', ['prefix', 'result'])
+STEAM_REQUESTS = Counter('steam_requests_total', 'Запросы через прокси', ['endpoint', 'status'])
+STEAM_LATENCY = Histogram('steam_request_duration_seconds', 'Время запросов через прокси', ['endpoint'])
+
+
+class QueryTimer:
+    # execute_wrapper для подсчёта SQL запросов и их суммарного времени
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+class MetricsMiddleware:
+    """
+    Время ответа, количество и время SQL запросов (во всех базах, включая реплики) на представление
+    Представление - имя маршрута (news:feed), для не найденных адресов - unresolved
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(timer))
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        REQUEST_LATENCY.labels(view, request.method, response.status_code).observe(duration)
+        REQUEST_QUERIES.labels(view).observe(timer.count)
+        REQUEST_DB_TIME.labels(view).observe(timer.duration)
+        return response
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        start = time.perf_counter()
+        try:
+            return super(TimedTemplate, self).render(context=context, request=request)
+        finally:
+            TEMPLATE_RENDER.labels(self.origin.template_name or 'string').observe(time.perf_counter() - start)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """
+    Бэкенд шаблонов django, замеряющий рендеринг шаблонов, загружаемых представлениями (render, TemplateView),
+    вложенные через extends и include шаблоны входят во время страницы
+    """
+
+    def get_template(self, template_name):
+        return TimedTemplate(super(TimedDjangoTemplates, self).get_template(template_name).template, self)
+
+    def from_string(self, template_code):
+        return TimedTemplate(super(TimedDjangoTemplates, self).from_string(template_code).template, self)
+
+
+def cache_prefix(key):
+    # Префикс ключа (subscriptions:1 -> subscriptions), чтобы метки не зависели от id объектов
+    return str(key).split(':', 1)[0]
+
+
+class InstrumentedRedisCache(RedisCache):
+    """
+    Кэш redis, считающий попадания и промахи чтений
+    """
+    _missing = object()
+
+    def get(self, key, default=None, version=None):
+        value = super(InstrumentedRedisCache, self).get(key, self._missing, version=version)
+        CACHE_REQUESTS.labels(cache_prefix(key), 'miss' if value is self._missing else 'hit').inc()
+        return default if value is self._missing else value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        values = super(InstrumentedRedisCache, self).get_many(keys, version=version)
+        for key in keys:
+            CACHE_REQUESTS.labels(cache_prefix(key), 'hit' if key in values else 'miss').inc()
+        return values
+
+
+def steam_endpoint(url):
+    # Для api steam - адрес метода без параметров, для остальных (изображения на cdn) - только хост
+    parts = urlsplit(url)
+    return parts.netloc + parts.path if parts.netloc.endswith('steampowered.com') else parts.netloc
+
+
+class InstrumentedProxy:
+    """
+    Обёртка менеджера прокси (urllib3), считает ответы по статусам и время запросов,
+    запрос, упавший с ошибкой соединения, считается со статусом error
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = steam_endpoint(url)
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            response = self.manager.request(method, url, *args, **kwargs)
+            status = response.status
+            return response
+        finally:
+            STEAM_LATENCY.labels(endpoint).observe(time.perf_counter() - start)
+            STEAM_REQUESTS.labels(endpoint, status).inc()
+
+
+def metrics_view(request):
+    # Доступно серверу prometheus (settings.METRICS_ALLOWED_IPS) и персоналу сайта
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS and not request.user.is_staff:
+        return HttpResponseForbidden()
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,32 @@
+"""
+Операции миграций для индексов, которые строятся без блокировки таблицы (CREATE INDEX CONCURRENTLY)
+Прерванное построение оставляет индекс INVALID с тем же именем, и повторный запуск миграции падает на нём,
+поэтому перед построением такой индекс удаляется
+"""
+from django.contrib.postgres import operations
+from django.db import migrations
+
+
+def remove_invalid_index(schema_editor, name):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+                       'WHERE pg_class.relname = %s AND NOT pg_index.indisvalid', [name])
+        if cursor.fetchone():
+            cursor.execute(f'DROP INDEX CONCURRENTLY {schema_editor.quote_name(name)};')
+
+
+def drop_invalid_index(name):
+    # Шаг миграции перед CREATE INDEX CONCURRENTLY в RunSQL
+    def operation(apps, schema_editor):
+        remove_invalid_index(schema_editor, name)
+    return migrations.RunPython(operation, migrations.RunPython.noop)
+
+
+class AddIndexConcurrently(operations.AddIndexConcurrently):
+    # AddIndexConcurrently, который сначала удаляет INVALID индекс с тем же именем
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self._ensure_not_in_transaction(schema_editor)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            remove_invalid_index(schema_editor, self.index.name)
+        super(AddIndexConcurrently, self).database_forwards(app_label, schema_editor, from_state, to_state)
@@ -0,0 +1,219 @@
+"""
+Профилирование отдельных запросов персонала сайта по запросу: заголовок X-Profile или параметр ?_profile=1
+
+Пока выполняется представление (вместе с рендерингом шаблонов и SQL), отдельный поток раз в settings.PROFILE_INTERVAL
+снимает стек потока запроса, стеки сворачиваются в формат flamegraph.pl / speedscope ("a;b;c количество"),
+кадры шаблонов и SQL подписываются именем шаблона и текстом запроса, отдельно записывается список SQL запросов
+Профиль сохраняется в redis на PROFILE_TTL секунд (хранятся последние PROFILE_KEEP), его id - в заголовке ответа
+X-Profile-Id, профили смотрятся в админке по адресу /admin/profiles/
+
+Запросы без заголовка и параметра проходят middleware после одной проверки, без потоков и обёрток
+"""
+import json
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import ExitStack
+
+import redis
+from django.conf import settings
+from django.contrib import admin
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+from django.http import Http404, HttpResponse
+from django.shortcuts import render
+from django.template.base import Template
+from django.utils import timezone
+
+client = redis.Redis.from_url(settings.REDIS_URL)
+
+# Включение профилирования: заголовок (X-Profile: 1) или параметр адреса
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_PARAM = '_profile'
+# Заголовок ответа с id сохранённого профиля
+PROFILE_ID_HEADER = 'X-Profile-Id'
+# Ключи redis: профиль целиком и список кратких описаний последних профилей
+PROFILE_KEY = 'profile:{}'
+PROFILES_KEY = 'profiles'
+# Сколько символов SQL запроса попадает в подпись кадра
+SQL_LABEL_LENGTH = 80
+
+# Кадры, которые подписываются не именем функции: рендеринг шаблона (включая extends и include) и SQL запрос
+TEMPLATE_CODE = Template._render.__code__
+SQL_CODES = (CursorWrapper._execute.__code__, CursorWrapper._executemany.__code__)
+
+
+def frame_label(frame):
+    # Подпись кадра для свёрнутого стека, ";" - разделитель кадров, поэтому в подписи не встречается
+    code = frame.f_code
+    if code is TEMPLATE_CODE:
+        template = frame.f_locals.get('self')
+        return f'template {getattr(template, "name", None) or "string"}'
+    if code in SQL_CODES:
+        sql = ' '.join(str(frame.f_locals.get('sql', '')).split())
+        return f'sql {sql[:SQL_LABEL_LENGTH]}'.replace(';', ',')
+    return f'{frame.f_globals.get("__name__", "?")}:{code.co_name}:{code.co_firstlineno}'.replace(';', ',')
+
+
+def folded_stack(frame):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Sampler(threading.Thread):
+    """
+    Поток, снимающий стек потока запроса раз в interval секунд
+    stacks - {свёрнутый стек: количество выборок}
+    """
+
+    def __init__(self, thread_id, interval):
+        super(Sampler, self).__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[folded_stack(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class QueryLog:
+    # execute_wrapper, записывающий SQL запросы профилируемого запроса
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({'db': context['connection'].alias, 'sql': sql, 'many': many,
+                                 'ms': round((time.perf_counter() - start) * 1000, 3)})
+
+
+class ProfilerMiddleware:
+    """
+    Профилирует запросы персонала сайта с заголовком X-Profile или параметром _profile
+    Стоит после AuthenticationMiddleware, оборачивает представление вместе с рендерингом шаблона
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if PROFILE_HEADER not in request.META and f'{PROFILE_PARAM}=' not in request.META.get('QUERY_STRING', ''):
+            return self.get_response(request)
+        if not request.user.is_staff:
+            return self.get_response(request)
+
+        sampler = Sampler(threading.get_ident(), settings.PROFILE_INTERVAL)
+        log = QueryLog()
+        started_at = timezone.now()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(log))
+            sampler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                sampler.stop()
+        duration = time.perf_counter() - start
+
+        summary = {
+            'id': f'{started_at:%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}',
+            'started_at': started_at.isoformat(),
+            'method': request.method,
+            'path': request.get_full_path(),
+            'user': request.user.username,
+            'status': response.status_code,
+            'ms': round(duration * 1000, 1),
+            'queries': len(log.queries),
+            'queries_ms': round(sum(query['ms'] for query in log.queries), 1),
+            'samples': sum(sampler.stacks.values()),
+        }
+        profile = {**summary, 'interval': settings.PROFILE_INTERVAL, 'stacks': dict(sampler.stacks),
+                   'query_list': log.queries}
+        try:
+            with client.pipeline() as pipe:
+                pipe.set(PROFILE_KEY.format(summary['id']), json.dumps(profile, ensure_ascii=False),
+                         ex=settings.PROFILE_TTL)
+                pipe.lpush(PROFILES_KEY, json.dumps(summary, ensure_ascii=False))
+                pipe.ltrim(PROFILES_KEY, 0, settings.PROFILE_KEEP - 1)
+                pipe.execute()
+        except redis.RedisError:
+            return response
+        response[PROFILE_ID_HEADER] = summary['id']
+        return response
+
+
+def top_frames(stacks, limit=30):
+    """
+    Кадры с наибольшим временем: [(подпись, выборок со вложенными вызовами, выборок в самом кадре)]
+    Рекурсивные вызовы считаются в стеке один раз
+    """
+    total, own = Counter(), Counter()
+    for stack, count in stacks.items():
+        labels = stack.split(';')
+        for label in set(labels):
+            total[label] += count
+        own[labels[-1]] += count
+    return [(label, count, own[label]) for label, count in total.most_common(limit)]
+
+
+@admin.site.admin_view
+def profiles_view(request):
+    # Список последних профилей, в админке для персонала
+    profiles = [json.loads(item) for item in client.lrange(PROFILES_KEY, 0, -1)]
+    return render(request, 'admin/profiles.html', {
+        **admin.site.each_context(request),
+        'title': 'Профили запросов',
+        'profiles': profiles,
+        'profile_param': PROFILE_PARAM,
+    })
+
+
+@admin.site.admin_view
+def profile_view(request, profile_id):
+    # Профиль: SQL запросы, самые долгие кадры и свёрнутые стеки для flamegraph.pl / speedscope (?format=folded)
+    data = client.get(PROFILE_KEY.format(profile_id))
+    if data is None:
+        raise Http404
+    profile = json.loads(data)
+    if request.GET.get('format') == 'folded':
+        response = HttpResponse(''.join(f'{stack} {count}\n' for stack, count in profile['stacks'].items()),
+                                content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="profile-{profile_id}.folded"'
+        return response
+
+    interval_ms = profile['interval'] * 1000
+    samples = profile['samples'] or 1
+    frames = [{'label': label, 'ms': round(count * interval_ms, 1), 'own_ms': round(own * interval_ms, 1),
+               'percent': round(count * 100 / samples, 1)}
+              for label, count, own in top_frames(profile['stacks'])]
+    # Одинаковые запросы (обычно N+1) вместе: текст, количество и суммарное время
+    repeated = Counter()
+    repeated_ms = Counter()
+    for query in profile['query_list']:
+        repeated[query['sql']] += 1
+        repeated_ms[query['sql']] += query['ms']
+    return render(request, 'admin/profile.html', {
+        **admin.site.each_context(request),
+        'title': f'Профиль {profile["method"]} {profile["path"]}',
+        'profile': profile,
+        'frames': frames,
+        'repeated': [{'sql': sql, 'count': count, 'ms': round(repeated_ms[sql], 1)}
+                     for sql, count in repeated.most_common() if count > 1],
+    })
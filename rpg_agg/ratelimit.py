@@ -0,0 +1,135 @@
+"""
+Ограничение частоты запросов к пишущим представлениям и сброс нагрузки
+
+Лимиты - скользящее окно в redis (sorted set с временем каждого запроса), отдельно на пользователя и на IP,
+для каждой группы представлений задаются в settings.RATE_LIMITS: {группа: {'user': (запросов, секунд), 'ip': ...}}
+Кроме того, пока очередь celery длиннее SHED_QUEUE_DEPTH или запрос к основной базе дольше SHED_DB_LATENCY секунд,
+ограниченные представления сразу отвечают 429, оставляя базу и steam для чтения сайта
+Если redis недоступен, запросы пропускаются без ограничений
+"""
+import time
+import uuid
+from functools import wraps
+
+import redis
+from django.conf import settings
+from django.db import connections
+from django.shortcuts import render
+
+client = redis.Redis.from_url(settings.REDIS_URL)
+# Очередь задач celery по умолчанию в брокере redis - список с этим именем
+CELERY_QUEUE = 'celery'
+
+# Запрос в окне: старые записи удаляются, при свободном месте добавляется новая
+# Возвращает 0, если запрос разрешён, иначе через сколько миллисекунд освободится место
+# KEYS: ключ окна; ARGV: текущее время (мс), размер окна (мс), лимит, уникальный id запроса
+WINDOW_SCRIPT = client.register_script("""
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - window)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    return math.max(tonumber(oldest[2]) + window - now, 1)
+end
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+redis.call('PEXPIRE', KEYS[1], window)
+return 0
+""")
+
+# Признаки перегрузки проверяются не чаще раза в SHED_CHECK_SECONDS на процесс: (время проверки, перегружен ли)
+SHED_CHECK_SECONDS = 5
+_overloaded = (0, False)
+
+
+def client_ip(request):
+    # Адрес клиента, за прокси - из заголовка, который прокси выставляет сам (settings.RATE_LIMIT_IP_HEADER),
+    # без настроенного заголовка - адрес соединения, заголовкам от самого клиента доверять нельзя
+    if settings.RATE_LIMIT_IP_HEADER:
+        return request.META.get(settings.RATE_LIMIT_IP_HEADER) or request.META.get('REMOTE_ADDR', '')
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def retry_after(scope, request):
+    """
+    Проверить и учесть запрос в окнах группы scope, возвращает 0 или через сколько секунд можно повторить
+    Запрос учитывается только в окнах, где он уместился, поэтому отклонённые запросы не продлевают блокировку
+    """
+    limits = settings.RATE_LIMITS[scope]
+    identities = {'ip': client_ip(request)}
+    if request.user.is_authenticated:
+        identities['user'] = request.user.id
+    now = int(time.time() * 1000)
+    request_id = uuid.uuid4().hex
+    wait = 0
+    for kind, identity in identities.items():
+        if kind not in limits:
+            continue
+        count, seconds = limits[kind]
+        wait = max(wait, WINDOW_SCRIPT(keys=[f'ratelimit:{scope}:{kind}:{identity}'],
+                                       args=[now, seconds * 1000, count, request_id]))
+    return -(-wait // 1000)
+
+
+def overloaded():
+    global _overloaded
+    checked, result = _overloaded
+    if time.monotonic() - checked > SHED_CHECK_SECONDS:
+        try:
+            result = client.llen(CELERY_QUEUE) > settings.SHED_QUEUE_DEPTH
+        except redis.RedisError:
+            result = False
+        if not result:
+            start = time.monotonic()
+            try:
+                with connections['default'].cursor() as cursor:
+                    cursor.execute('SELECT 1')
+            except Exception:
+                # Недоступная база - тоже перегрузка, запись всё равно не пройдёт
+                result = True
+            else:
+                result = time.monotonic() - start > settings.SHED_DB_LATENCY
+        _overloaded = (time.monotonic(), result)
+    return result
+
+
+def too_many_requests(request, seconds):
+    response = render(request, 'users/message_template.html', {
+        'message_head': 'Не так быстро',
+        'message': 'Слишком много запросов, попробуйте немного позже',
+        'redirect_url': request.META.get('HTTP_REFERER', '/'),
+        'button_name': 'Вернуться',
+    }, status=429)
+    response['Retry-After'] = seconds
+    return response
+
+
+def rate_limit(scope):
+    """
+    Декоратор для представлений: лимиты группы scope из settings.RATE_LIMITS и сброс нагрузки
+    Ставится после проверок авторизации, чтобы лимит считался на пользователя
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if overloaded():
+                return too_many_requests(request, SHED_CHECK_SECONDS)
+            try:
+                wait = retry_after(scope, request)
+            except redis.RedisError:
+                wait = 0
+            if wait:
+                return too_many_requests(request, wait)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class RateLimitMixin:
+    """
+    То же, что rate_limit, для представлений-классов, группа задаётся атрибутом rate_limit_scope
+    Ставится в списке базовых классов после миксинов авторизации
+    """
+    rate_limit_scope = None
+
+    def dispatch(self, request, *args, **kwargs):
+        return rate_limit(self.rate_limit_scope)(super(RateLimitMixin, self).dispatch)(request, *args, **kwargs)
@@ -48,6 +48,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'django.contrib.humanize',
+    'django.contrib.postgres',
 
     'celery',
 
@@ -56,21 +57,27 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'rpg_agg.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'rpg_agg.db_router.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Профилирование запросов персонала по заголовку или параметру, после AuthenticationMiddleware
+    'rpg_agg.profiler.ProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'rpg_agg.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
-        'DIRS': [],
+        # Шаблоны django с замером времени рендеринга для метрик
+        'BACKEND': 'rpg_agg.metrics.TimedDjangoTemplates',
+        # Шаблоны страниц админки, которые не относятся к приложениям (профили запросов)
+        'DIRS': [BASE_DIR / 'rpg_agg' / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
@@ -99,6 +106,29 @@ DATABASES = {
     }
 }
 
+# Реплики только для чтения, адреса через запятую в DB_REPLICA_HOSTS (host или host:port)
+# Для локальной проверки маршрутизации можно указать DB_REPLICA_HOSTS=localhost, тогда реплика - та же база
+DATABASE_REPLICAS = []
+for number, replica_host in enumerate(env.list('DB_REPLICA_HOSTS', default=[]), start=1):
+    host, _, port = replica_host.partition(':')
+    DATABASES[f'replica_{number}'] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port or '5432',
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica_{number}')
+
+# Зеркало основной базы для тестов маршрутизации (rpg_agg.tests): отдельное подключение к той же тестовой базе
+# (TEST MIRROR), в DATABASE_REPLICAS не входит, поэтому без тестов не используется
+DATABASES['replica_test'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+
+DATABASE_ROUTERS = ['rpg_agg.db_router.PrimaryReplicaRouter']
+# Реплика, отставшая сильнее, временно не используется для чтения
+REPLICA_MAX_LAG_SECONDS = 5
+# Сколько пользователь после записи читает только из основной базы
+PRIMARY_PIN_SECONDS = 15
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -177,15 +207,54 @@ PROXY = env('PROXY')
 
 # REDIS
 
+REDIS_URL = "redis://localhost:6379"
+
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.redis.RedisCache",
-        "LOCATION": f"redis://localhost:6379",
+        # RedisCache со счётчиками попаданий и промахов для метрик
+        "BACKEND": "rpg_agg.metrics.InstrumentedRedisCache",
+        "LOCATION": REDIS_URL,
     }
 }
 
+# Канал redis pub/sub, через который рассылаются новые посты (news.stream)
+NEWS_STREAM_CHANNEL = 'news:new_posts'
+
+# METRICS (rpg_agg.metrics)
+
+# Адреса, с которых доступен /metrics (сервер prometheus), персоналу сайта он доступен всегда
+METRICS_ALLOWED_IPS = env.list('METRICS_ALLOWED_IPS', default=['127.0.0.1'])
+# Порт http сервера с метриками воркера celery (rpg_agg.task_metrics), 0 - не запускать
+WORKER_METRICS_PORT = env.int('WORKER_METRICS_PORT', default=9808)
+
+# PROFILER (rpg_agg.profiler)
+
+# Интервал снятия стека профилируемого запроса, секунд
+PROFILE_INTERVAL = 0.005
+# Сколько последних профилей хранится и сколько секунд
+PROFILE_KEEP = 100
+PROFILE_TTL = 60 * 60 * 24 * 7
+
+# RATE LIMITS (rpg_agg.ratelimit)
+
+# Лимиты пишущих представлений: {группа: {'user' / 'ip': (запросов, за сколько секунд)}}
+RATE_LIMITS = {
+    'vote': {'user': (30, 60), 'ip': (120, 60)},
+    'comment': {'user': (5, 60), 'ip': (20, 60)},
+    'subscribe': {'user': (20, 60), 'ip': (60, 60)},
+    'add_game': {'user': (10, 60 * 60), 'ip': (30, 60 * 60)},
+    'verification_email': {'user': (3, 60 * 60), 'ip': (10, 60 * 60)},
+}
+# Заголовок с адресом клиента, который выставляет прокси перед приложением (например, nginx: HTTP_X_REAL_IP)
+# Задавать только за прокси, который всегда перезаписывает этот заголовок, иначе клиент подставит любой адрес
+# и обойдёт лимиты по IP, по умолчанию (None) используется REMOTE_ADDR
+RATE_LIMIT_IP_HEADER = env('RATE_LIMIT_IP_HEADER', default=None)
+# Пороги сброса нагрузки: длина очереди celery и время простого запроса к основной базе в секундах
+SHED_QUEUE_DEPTH = 1000
+SHED_DB_LATENCY = 0.5
+
 # CELERY
 
-CELERY_BROKER_URL = f"redis://localhost:6379"
-CELERY_RESULT_BACKEND = f"redis://localhost:6379"
+CELERY_BROKER_URL = REDIS_URL
+CELERY_RESULT_BACKEND = REDIS_URL
 
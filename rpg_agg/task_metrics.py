@@ -0,0 +1,118 @@
+"""
+Метрики задач celery, собираются через сигналы celery для всех задач без изменения их кода:
+время выполнения, ожидание в очереди (от публикации до начала выполнения), повторы и ошибки
+Задачи дополнительно считают свои объекты через task_count (новые посты, байты изображений, отправленные письма),
+эти счётчики попадают в метрику celery_task_items_total и в итоговую строку лога задачи
+По каждой задаче пишется одна строка лога (логгер rpg_agg.tasks) в JSON со всеми её показателями
+
+Метрики воркера отдаются его собственным http сервером на порту settings.WORKER_METRICS_PORT,
+для prefork воркера нужна переменная окружения PROMETHEUS_MULTIPROC_DIR (см. rpg_agg.metrics)
+"""
+import contextvars
+import json
+import logging
+import os
+import time
+
+from celery.signals import (before_task_publish, task_failure, task_postrun,
+                            task_prerun, task_retry, worker_ready)
+from django.conf import settings
+from prometheus_client import (REGISTRY, CollectorRegistry, Counter, Histogram,
+                               multiprocess, start_http_server)
+
+logger = logging.getLogger('rpg_agg.tasks')
+
+TASK_DURATION = Histogram('celery_task_duration_seconds', 'Время выполнения задачи', ['task', 'state'],
+                          buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+TASK_QUEUE_WAIT = Histogram('celery_task_queue_wait_seconds', 'Ожидание задачи в очереди', ['task'],
+                            buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900))
+TASK_RETRIES = Counter('celery_task_retries_total', 'Повторы задач', ['task'])
+TASK_FAILURES = Counter('celery_task_failures_total', 'Ошибки задач', ['task', 'exception'])
+TASK_ITEMS = Counter('celery_task_items_total', 'Объекты, обработанные задачами', ['task', 'item'])
+
+# Заголовок сообщения со временем публикации задачи
+PUBLISHED_HEADER = 'published_at'
+
+# Показатели выполняемой задачи: имя, время начала, ожидание в очереди и счётчики task_count
+_current = contextvars.ContextVar('task_metrics', default=None)
+
+
+def task_count(item, amount=1):
+    """
+    Учесть объекты текущей задачи (например, task_count('image_bytes', len(data)))
+    Вне задачи (команды manage.py, веб запросы) попадает в метрику с пустым именем задачи
+    """
+    current = _current.get()
+    TASK_ITEMS.labels(current['task'] if current else '', item).inc(amount)
+    if current:
+        current['items'][item] = current['items'].get(item, 0) + amount
+
+
+def task_slowest(name, key, seconds):
+    # Самый долгий объект задачи для строки лога, например task_slowest('slowest_game', appid, секунды)
+    current = _current.get()
+    if current and seconds > current['notes'].get(name, (None, -1))[1]:
+        current['notes'][name] = (key, round(seconds, 3))
+
+
+@before_task_publish.connect
+def mark_published(headers=None, **kwargs):
+    if headers is not None:
+        headers[PUBLISHED_HEADER] = time.time()
+
+
+@task_prerun.connect
+def start_task(task_id=None, task=None, **kwargs):
+    published = task.request.get(PUBLISHED_HEADER) or (task.request.headers or {}).get(PUBLISHED_HEADER)
+    queue_wait = max(time.time() - published, 0) if published else None
+    if queue_wait is not None:
+        TASK_QUEUE_WAIT.labels(task.name).observe(queue_wait)
+    _current.set({'task': task.name, 'start': time.perf_counter(), 'queue_wait': queue_wait, 'items': {},
+                  'notes': {}, 'exception': None})
+
+
+@task_retry.connect
+def count_retry(sender=None, **kwargs):
+    TASK_RETRIES.labels(sender.name).inc()
+
+
+@task_failure.connect
+def count_failure(sender=None, exception=None, **kwargs):
+    TASK_FAILURES.labels(sender.name, type(exception).__name__).inc()
+    current = _current.get()
+    if current:
+        current['exception'] = repr(exception)
+
+
+@task_postrun.connect
+def finish_task(task_id=None, task=None, state=None, **kwargs):
+    current = _current.get()
+    if not current:
+        return
+    _current.set(None)
+    duration = time.perf_counter() - current['start']
+    TASK_DURATION.labels(task.name, state or 'UNKNOWN').observe(duration)
+    logger.info(json.dumps({
+        'task': task.name,
+        'id': task_id,
+        'state': state,
+        'duration': round(duration, 3),
+        'queue_wait': round(current['queue_wait'], 3) if current['queue_wait'] is not None else None,
+        'retries': task.request.retries,
+        'error': current['exception'],
+        **{item: round(amount, 3) if isinstance(amount, float) else amount
+           for item, amount in current['items'].items()},
+        **current['notes'],
+    }, ensure_ascii=False, default=str))
+
+
+@worker_ready.connect
+def serve_metrics(**kwargs):
+    if not settings.WORKER_METRICS_PORT:
+        return
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    start_http_server(settings.WORKER_METRICS_PORT, registry=registry)
@@ -0,0 +1,311 @@
+import json
+import time
+from unittest import mock
+
+import redis
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.db import connections
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.views import View
+
+from news.models import GameModel
+from rpg_agg import profiler, ratelimit
+from rpg_agg.db_router import (PIN_COOKIE, ReplicaRoutingMiddleware,
+                               UsePrimaryMixin, replica_lag, use_primary)
+from rpg_agg.ratelimit import RateLimitMixin, rate_limit
+from rpg_agg.task_metrics import PUBLISHED_HEADER
+from users.models import User
+from users.tasks import karma_reconcile
+
+REPLICA = 'replica_test'
+
+
+def read_view(request):
+    GameModel.objects.count()
+    return HttpResponse()
+
+
+def write_view(request):
+    GameModel.objects.update(post_count=0)
+    return HttpResponse()
+
+
+def session_view(request):
+    request.session['seen'] = True
+    return HttpResponse()
+
+
+class ReadView(UsePrimaryMixin, View):
+    def get(self, request):
+        return read_view(request)
+
+
+class LimitedView(RateLimitMixin, View):
+    rate_limit_scope = 'test'
+
+    def get(self, request):
+        return HttpResponse()
+
+
+@override_settings(DATABASE_REPLICAS=[REPLICA])
+@mock.patch.dict('rpg_agg.db_router._replica_lag', clear=True)
+class ReplicaRoutingTests(TestCase):
+    """
+    Маршрутизация чтений: реплика для безопасных запросов, основная база для остальных, после записи (cookie)
+    и для отставшей или недоступной реплики
+    """
+    databases = {'default', REPLICA}
+
+    def request(self, view, method='get', **cookies):
+        # Запрос через middleware, возвращает ответ и алиасы баз, на которых были запросы
+        request = getattr(RequestFactory(), method)('/')
+        request.COOKIES.update(cookies)
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections[REPLICA]) as replica:
+            response = ReplicaRoutingMiddleware(view)(request)
+        return response, {alias for alias, queries in (('default', primary), (REPLICA, replica)) if queries}
+
+    def test_safe_request_reads_replica(self):
+        response, aliases = self.request(read_view)
+        self.assertEqual(aliases, {REPLICA})
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_unsafe_request_reads_primary(self):
+        self.assertEqual(self.request(read_view, method='post')[1], {'default'})
+
+    def test_write_pins_to_primary(self):
+        response, aliases = self.request(write_view, method='post')
+        self.assertEqual(aliases, {'default'})
+        self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], 15)
+        self.assertEqual(self.request(read_view, **{PIN_COOKIE: '1'})[1], {'default'})
+
+    def test_session_save_does_not_pin(self):
+        response, aliases = self.request(SessionMiddleware(session_view))
+        self.assertIn('default', aliases)
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_use_primary(self):
+        self.assertEqual(self.request(use_primary(read_view))[1], {'default'})
+        self.assertEqual(self.request(ReadView.as_view())[1], {'default'})
+
+    def test_outside_request_reads_primary(self):
+        with CaptureQueriesContext(connections[REPLICA]) as replica:
+            GameModel.objects.count()
+        self.assertFalse(replica)
+
+    def test_lagging_replica_skipped(self):
+        self.assertEqual(replica_lag(REPLICA), 0)
+        with mock.patch.dict('rpg_agg.db_router._replica_lag', {REPLICA: (time.monotonic(), 10)}):
+            self.assertEqual(self.request(read_view)[1], {'default'})
+
+    @mock.patch('rpg_agg.db_router.LAG_SQL', 'SELECT 1 / 0')
+    def test_broken_replica_skipped(self):
+        self.assertEqual(replica_lag(REPLICA), float('inf'))
+        self.assertEqual(self.request(read_view)[1], {'default'})
+
+
+@override_settings(RATE_LIMITS={'test': {'user': (2, 60), 'ip': (3, 60)}})
+@mock.patch('rpg_agg.ratelimit.overloaded', mock.Mock(return_value=False))
+class RateLimitTests(TestCase):
+    """
+    Скользящее окно запросов на пользователя и на IP: 429 с Retry-After, запрос учитывается только в окнах,
+    где он уместился
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        # Страница 429 показывает аватарку пользователя
+        cls.users = [User.objects.create_user(f'user{number}', f'user{number}@example.com', 'password',
+                                              avatar='users_images/a.png')
+                     for number in range(3)]
+
+    def setUp(self):
+        # Redis не откатывается вместе с базой, окна с теми же id пользователей могли остаться от других тестов
+        keys = list(ratelimit.client.scan_iter('ratelimit:test:*'))
+        if keys:
+            ratelimit.client.delete(*keys)
+        self.view = rate_limit('test')(lambda request: HttpResponse())
+
+    def get(self, user, view=None):
+        request = RequestFactory().get('/')
+        request.user = user
+        return (view or self.view)(request)
+
+    def test_user_and_ip_limits(self):
+        self.assertEqual([self.get(self.users[0]).status_code for _ in range(3)], [200, 200, 429])
+        response = self.get(self.users[0])
+        self.assertTrue(0 < int(response['Retry-After']) <= 60)
+        # Третий запрос уместился в окне IP и учтён в нём, теперь адрес исчерпал лимит и для других пользователей
+        self.assertEqual(self.get(self.users[1]).status_code, 429)
+        self.assertEqual(self.get(AnonymousUser()).status_code, 429)
+
+    def test_rejected_requests_do_not_extend_window(self):
+        self.get(self.users[0])
+        self.get(self.users[0])
+        self.get(self.users[0])
+        # Окно пользователя заполнено, окно IP - нет: отклонённый запрос пользователя учитывается только по IP
+        self.assertEqual(ratelimit.client.zcard(f'ratelimit:test:user:{self.users[0].id}'), 2)
+        self.assertEqual(ratelimit.client.zcard('ratelimit:test:ip:127.0.0.1'), 3)
+        self.get(self.users[0])
+        self.assertEqual(ratelimit.client.zcard(f'ratelimit:test:user:{self.users[0].id}'), 2)
+        self.assertEqual(ratelimit.client.zcard('ratelimit:test:ip:127.0.0.1'), 3)
+
+    def test_class_view(self):
+        view = LimitedView.as_view()
+        self.assertEqual([self.get(self.users[0], view).status_code for _ in range(3)], [200, 200, 429])
+
+    @mock.patch('rpg_agg.ratelimit.WINDOW_SCRIPT', mock.Mock(side_effect=redis.ConnectionError))
+    def test_redis_down(self):
+        self.assertEqual([self.get(self.users[0]).status_code for _ in range(3)], [200, 200, 200])
+
+
+@mock.patch('rpg_agg.ratelimit._overloaded', (0, False))
+@mock.patch('rpg_agg.ratelimit.retry_after', mock.Mock(return_value=0))
+class LoadSheddingTests(TestCase):
+    """
+    Сброс нагрузки: при длинной очереди celery или медленной базе ограниченные представления сразу отвечают 429
+    """
+
+    def get(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        return rate_limit('test')(lambda request: HttpResponse())(request)
+
+    @mock.patch('rpg_agg.ratelimit.client')
+    def test_long_queue(self, client):
+        client.llen.return_value = 10 ** 6
+        response = self.get()
+        self.assertEqual((response.status_code, response['Retry-After']), (429, str(ratelimit.SHED_CHECK_SECONDS)))
+        # Итог проверки запоминается на SHED_CHECK_SECONDS
+        client.llen.return_value = 0
+        self.assertEqual(self.get().status_code, 429)
+        client.llen.assert_called_once_with(ratelimit.CELERY_QUEUE)
+        with mock.patch('rpg_agg.ratelimit.time.monotonic', return_value=time.monotonic() + 60):
+            self.assertEqual(self.get().status_code, 200)
+
+    @override_settings(SHED_DB_LATENCY=-1)
+    def test_slow_database(self):
+        self.assertEqual(self.get().status_code, 429)
+
+    @mock.patch('rpg_agg.ratelimit.client', mock.Mock(**{'llen.side_effect': redis.ConnectionError}))
+    def test_redis_down(self):
+        self.assertEqual(self.get().status_code, 200)
+
+
+@override_settings(METRICS_ALLOWED_IPS=['10.0.0.1'])
+class MetricsAccessTests(TestCase):
+    """
+    /metrics доступны только адресам сервера prometheus и персоналу сайта
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('user', 'user@example.com', 'password')
+        cls.staff = User.objects.create_user('staff', 'staff@example.com', 'password', is_staff=True)
+
+    def get(self, address='10.0.0.2', **headers):
+        return self.client.get(reverse('metrics'), REMOTE_ADDR=address, **headers)
+
+    def test_prometheus_address(self):
+        self.client.get(reverse('news:library'))
+        response = self.get('10.0.0.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response,
+                            'http_request_duration_seconds_count{method="GET",status="200",view="news:library"}')
+
+    def test_other_address(self):
+        self.assertEqual(self.get().status_code, 403)
+        # Заголовок от самого клиента не помогает
+        self.assertEqual(self.get(HTTP_X_FORWARDED_FOR='10.0.0.1', HTTP_X_REAL_IP='10.0.0.1').status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.get().status_code, 403)
+
+    def test_staff(self):
+        self.client.force_login(self.staff)
+        self.assertEqual(self.get().status_code, 200)
+
+
+class TaskLogTests(TestCase):
+    """
+    Одна строка лога в JSON на каждую задачу: состояние, время, ожидание в очереди, ошибка и счётчики task_count
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('user', 'user@example.com', 'password', karma=5)
+
+    def run_task(self, **options):
+        with self.assertLogs('rpg_agg.tasks') as logs:
+            result = karma_reconcile.apply(**options)
+        self.assertEqual(len(logs.records), 1)
+        return result, json.loads(logs.records[0].getMessage())
+
+    def test_success(self):
+        result, line = self.run_task(headers={PUBLISHED_HEADER: time.time() - 5})
+        self.assertEqual({key: line[key] for key in ('task', 'id', 'state', 'retries', 'error', 'users_fixed')}, {
+            'task': 'users.tasks.karma_reconcile', 'id': result.id, 'state': 'SUCCESS', 'retries': 0, 'error': None,
+            'users_fixed': 1,
+        })
+        self.assertGreaterEqual(line['duration'], 0)
+        self.assertGreaterEqual(line['queue_wait'], 5)
+
+    @mock.patch('users.tasks.task_count', mock.Mock(side_effect=ValueError('boom')))
+    def test_failure(self):
+        result, line = self.run_task()
+        self.assertTrue(result.failed())
+        self.assertEqual((line['state'], line['error'], line['queue_wait']), ('FAILURE', "ValueError('boom')", None))
+        self.assertNotIn('users_fixed', line)
+
+
+class ProfilerTests(TestCase):
+    """
+    Профилирование по заголовку X-Profile или параметру _profile только для персонала, профили смотрятся в админке
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        # Шаблоны показывают аватарку пользователя
+        cls.user = User.objects.create_user('user', 'user@example.com', 'password', avatar='users_images/a.png')
+        cls.staff = User.objects.create_user('staff', 'staff@example.com', 'password', is_staff=True,
+                                             avatar='users_images/a.png')
+
+    def setUp(self):
+        # Redis не откатывается вместе с базой, список мог остаться от других тестов
+        profiler.client.delete(profiler.PROFILES_KEY)
+        self.url = reverse('news:library')
+
+    def test_not_profiled(self):
+        self.assertNotIn(profiler.PROFILE_ID_HEADER, self.client.get(self.url, HTTP_X_PROFILE='1'))
+        self.client.force_login(self.user)
+        self.assertNotIn(profiler.PROFILE_ID_HEADER, self.client.get(self.url, {profiler.PROFILE_PARAM: 1}))
+        self.assertNotIn(profiler.PROFILE_ID_HEADER, self.client.get(self.url, HTTP_X_PROFILE='1'))
+        self.assertEqual(profiler.client.llen(profiler.PROFILES_KEY), 0)
+        # Профили в админке персоналу сайта
+        self.assertEqual(self.client.get(reverse('profiles')).status_code, 302)
+
+    def test_staff(self):
+        self.client.force_login(self.staff)
+        self.assertNotIn(profiler.PROFILE_ID_HEADER, self.client.get(self.url))
+        profile_id = self.client.get(self.url, {profiler.PROFILE_PARAM: 1})[profiler.PROFILE_ID_HEADER]
+        self.assertEqual(self.client.get(self.url, HTTP_X_PROFILE='1').status_code, 200)
+        self.assertEqual(profiler.client.llen(profiler.PROFILES_KEY), 2)
+        profile = json.loads(profiler.client.get(profiler.PROFILE_KEY.format(profile_id)))
+        self.assertEqual((profile['user'], profile['status'], profile['path']),
+                         ('staff', 200, f'{self.url}?{profiler.PROFILE_PARAM}=1'))
+        self.assertTrue(any('news_gamemodel' in query['sql'] for query in profile['query_list']))
+        self.assertContains(self.client.get(reverse('profiles')), profile_id)
+        self.assertContains(self.client.get(reverse('profile', kwargs={'profile_id': profile_id})), 'news_gamemodel')
+        response = self.client.get(reverse('profile', kwargs={'profile_id': profile_id}), {'format': 'folded'})
+        self.assertEqual(response['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertEqual(self.client.get(reverse('profile', kwargs={'profile_id': 'missing'})).status_code, 404)
+
+    @mock.patch('rpg_agg.profiler.client', mock.Mock(**{'pipeline.side_effect': redis.ConnectionError}))
+    def test_redis_down(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(self.url, HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(profiler.PROFILE_ID_HEADER, response)
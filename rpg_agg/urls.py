@@ -4,12 +4,19 @@ from django.contrib import admin
 from django.urls import include, path
 
 from news.views import IndexView
+from rpg_agg.metrics import metrics_view
+from rpg_agg.profiler import profile_view, profiles_view
 
 urlpatterns = [
+    # Страницы профилей запросов - до admin.site.urls, который перехватывает остальные адреса админки
+    path('admin/profiles/', profiles_view, name='profiles'),
+    path('admin/profiles/<str:profile_id>', profile_view, name='profile'),
     path('admin/', admin.site.urls),
     path('', IndexView.as_view(), name='index'),
     path('users/', include('users.urls', namespace='users')),
     path('news/', include('news.urls', namespace='news')),
+    path('api/v1/', include('news.api_urls', namespace='api_v1')),
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 if settings.DEBUG:
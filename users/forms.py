@@ -2,8 +2,10 @@ from django import forms
 from django.contrib.auth.forms import (AuthenticationForm, PasswordChangeForm,
                                        PasswordResetForm, SetPasswordForm,
                                        UserChangeForm, UserCreationForm)
+from django.template import loader
 
-from users.models import User
+from users.models import OutgoingEmail, User
+from users.tasks import enqueue_emails
 
 
 class LoginUserForm(AuthenticationForm):
@@ -106,6 +108,14 @@ class ResetUserPasswordForm(PasswordResetForm):
         model = User
         fields = ('email',)
 
+    # Письмо со ссылкой сброса пароля ставится в очередь, а не отправляется внутри запроса
+    def send_mail(self, subject_template_name, email_template_name, context, from_email, to_email,
+                  html_email_template_name=None):
+        subject = ''.join(loader.render_to_string(subject_template_name, context).splitlines())
+        html_body = loader.render_to_string(html_email_template_name, context) if html_email_template_name else ''
+        enqueue_emails([OutgoingEmail(recipient=to_email, subject=subject, html_body=html_body,
+                                      body=loader.render_to_string(email_template_name, context))])
+
 
 class ResetUserPasswordConfirmForm(SetPasswordForm):
     new_password1 = forms.CharField(widget=forms.PasswordInput({
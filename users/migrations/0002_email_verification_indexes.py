@@ -0,0 +1,45 @@
+# Generated by Django 4.2.2 on 2026-10-19 17:20
+
+from django.db import migrations, models
+
+from rpg_agg.migration_operations import (AddIndexConcurrently,
+                                           drop_invalid_index)
+
+
+class Migration(migrations.Migration):
+    # CONCURRENTLY не может выполняться внутри транзакции
+    atomic = False
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='emailverification',
+            index=models.Index(fields=['finish'], name='users_email_verify_finish_idx'),
+        ),
+        # Уникальное ограничение на code строим через индекс, созданный без блокировки таблицы
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                drop_invalid_index('users_email_verify_code_uniq'),
+                migrations.RunSQL(
+                    sql='CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_email_verify_code_uniq '
+                        'ON users_emailverification (code);',
+                    reverse_sql='DROP INDEX CONCURRENTLY IF EXISTS users_email_verify_code_uniq;',
+                ),
+                migrations.RunSQL(
+                    sql='ALTER TABLE users_emailverification ADD CONSTRAINT users_email_verify_code_uniq '
+                        'UNIQUE USING INDEX users_email_verify_code_uniq;',
+                    reverse_sql='ALTER TABLE users_emailverification '
+                                'DROP CONSTRAINT IF EXISTS users_email_verify_code_uniq;',
+                ),
+            ],
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='emailverification',
+                    constraint=models.UniqueConstraint(fields=('code',), name='users_email_verify_code_uniq'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.2 on 2026-10-19 17:42
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from rpg_agg.migration_operations import AddIndexConcurrently
+
+# Размер пачки при заполнении кармы
+BATCH_SIZE = 5000
+
+
+def fill_karma(apps, schema_editor):
+    # Карма = сумма рейтингов комментариев пользователя, включая архивные, пачками по id
+    User = apps.get_model('users', 'User')
+
+    def rating_sum(model_name):
+        model = apps.get_model('news', model_name)
+        return Coalesce(Subquery(
+            model.objects.filter(user=OuterRef('pk')).values('user').annotate(total=Sum('rating_total')).values('total')
+        ), 0)
+
+    karma = rating_sum('PostUserComment') + rating_sum('ArchivedComment')
+    max_id = User.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    for start in range(0, max_id + 1, BATCH_SIZE):
+        User.objects.filter(id__gte=start, id__lt=start + BATCH_SIZE).update(karma=karma)
+
+
+class Migration(migrations.Migration):
+    # CONCURRENTLY не может выполняться внутри транзакции
+    atomic = False
+
+    dependencies = [
+        ('users', '0002_email_verification_indexes'),
+        ('news', '0008_votes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='karma',
+            field=models.IntegerField(default=0, verbose_name='Карма'),
+        ),
+        migrations.RunPython(fill_karma, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='user',
+            index=models.Index(fields=['-karma', 'id'], name='users_user_karma_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-19 17:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='digest_post_id',
+            field=models.BigIntegerField(default=0, verbose_name='Последний пост в дайджесте'),
+        ),
+    ]
@@ -1,10 +1,14 @@
 import os
+import uuid
+from datetime import timedelta
 
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.core.mail import send_mail
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives
 from django.db import models
-from django.urls import reverse
+from django.db.models import Q
+from django.utils import timezone
 
 
 class User(AbstractUser):
@@ -13,6 +17,17 @@ class User(AbstractUser):
     # Для проверки верификации почты
     check_email = models.BooleanField(default=False)
     email = models.EmailField(unique=True)
+    # Сумма рейтингов всех комментариев пользователя, включая архивные, меняется в той же транзакции,
+    # что и голоса за его комментарии и их удаление, расхождения исправляет задача users.tasks.karma_reconcile
+    karma = models.IntegerField(default=0, verbose_name='Карма')
+    # id последнего поста, учтённого в дайджесте подписок (news.digest), в следующий попадут только более новые
+    digest_post_id = models.BigIntegerField(default=0, verbose_name='Последний пост в дайджесте')
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Таблица лидеров
+            models.Index(fields=('-karma', 'id'), name='users_user_karma_idx'),
+        ]
 
     # Действия при удалении экземпляра модели (задействуется эта функция)
     def delete(self, using=None, keep_parents=False):
@@ -22,21 +37,105 @@ class User(AbstractUser):
         return super(User, self).delete(using=using, keep_parents=keep_parents)
 
 
-# Модель подтверждения почты
+# Коды подтверждения почты, хранятся в redis (кэше) и исчезают сами по истечении TIMEOUT
+# Поиск по коду и счётчик запрошенных пользователем писем - по одному ключу, без запросов к базе
+class EmailVerificationCode:
+    # Время жизни кода, оно же окно счётчика писем пользователя
+    TIMEOUT = 60 * 60 * 24
+    # Больше стольких писем за окно пользователь запросить не может
+    LIMIT = 3
+
+    @staticmethod
+    def cache_key(code):
+        return f'email_verify:{code}'
+
+    @staticmethod
+    def count_key(user_id):
+        return f'email_verify:count:{user_id}'
+
+    # Сколько писем с подтверждением пользователь запросил за текущее окно
+    @classmethod
+    def count(cls, user):
+        return cache.get(cls.count_key(user.id), 0)
+
+    @classmethod
+    def create(cls, user):
+        code = uuid.uuid4()
+        cache.set(cls.cache_key(code), user.id, cls.TIMEOUT)
+        # Окно счётчика начинается с первого письма, INCR атомарен
+        cache.add(cls.count_key(user.id), 0, cls.TIMEOUT)
+        cache.incr(cls.count_key(user.id))
+        return code
+
+    # id пользователя по коду, код одноразовый и после проверки удаляется, неизвестный или просроченный код - None
+    # Из одновременных проверок одного кода успешна только та, что действительно удалила ключ
+    @classmethod
+    def pop_user_id(cls, code):
+        user_id = cache.get(cls.cache_key(code))
+        if user_id is None or not cache.delete(cls.cache_key(code)):
+            return None
+        return user_id
+
+
+# Модель подтверждения почты, новые коды в базе не создаются (см. EmailVerificationCode),
+# остаётся, чтобы работали ссылки из писем, отправленных до переноса кодов в redis
 class EmailVerification(models.Model):
     user = models.ForeignKey(to=User, on_delete=models.CASCADE)
     code = models.UUIDField()
     start = models.DateTimeField(auto_now_add=True)
     finish = models.DateTimeField()
 
-    # Функция для отправки письма с подтверждением почты
-    def send_email_verificate(self):
-        # Создаём ссылку по которой пользователь сможет подтвердить свою почту
-        link = f"{settings.FULL_DOMAIN_NAME}{reverse('users:verification', kwargs={'code': self.code})}"
-        # функция отправки письма из django.core.mail
-        send_mail(
-            subject='Email Verification from rpg_agg',
-            message=f'Dear, {self.user.username}! Please activate your email: {link}',
-            from_email=settings.EMAIL_HOST_USER,
-            recipient_list=[self.user.email],
-        )
+    class Meta:
+        constraints = [
+            # Поиск верификации по коду из ссылки
+            models.UniqueConstraint(fields=('code',), name='users_email_verify_code_uniq'),
+        ]
+        indexes = [
+            # Чистка просроченных верификаций
+            models.Index(fields=('finish',), name='users_email_verify_finish_idx'),
+        ]
+
+
+# Очередь исходящих писем (outbox): запросы и задачи только добавляют строки (users.tasks.enqueue_emails),
+# а воркер отправляет их пачками через одно SMTP соединение (users.tasks.send_outbox), отправленные письма удаляются
+class OutgoingEmail(models.Model):
+    # Паузы перед повторными попытками отправки, в секундах, после последней попытки письмо больше не отправляется
+    RETRY_DELAYS = (60, 5 * 60, 30 * 60, 2 * 60 * 60, 12 * 60 * 60)
+
+    recipient = models.EmailField(verbose_name='Получатель')
+    subject = models.CharField(max_length=256, verbose_name='Тема')
+    body = models.TextField(verbose_name='Текст')
+    html_body = models.TextField(blank=True, verbose_name='HTML версия')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создано')
+    # Когда можно отправлять, None - попытки исчерпаны
+    next_attempt_at = models.DateTimeField(null=True, default=timezone.now, verbose_name='Следующая попытка')
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Неудачных попыток')
+    last_error = models.TextField(blank=True, verbose_name='Последняя ошибка')
+
+    class Meta:
+        verbose_name = 'Исходящее письмо'
+        verbose_name_plural = 'Исходящие письма'
+        indexes = [
+            # Выборка писем, готовых к отправке, письма с исчерпанными попытками в индекс не попадают
+            models.Index(fields=('next_attempt_at',), condition=Q(next_attempt_at__isnull=False),
+                         name='users_outbox_next_attempt_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.recipient}: {self.subject}'
+
+    def message(self, connection):
+        message = EmailMultiAlternatives(subject=self.subject, body=self.body, from_email=settings.EMAIL_HOST_USER,
+                                         to=[self.recipient], connection=connection)
+        if self.html_body:
+            message.attach_alternative(self.html_body, 'text/html')
+        return message
+
+    # Неудачная попытка: следующая через RETRY_DELAYS, объект не сохраняется
+    def fail(self, error):
+        self.attempts += 1
+        self.last_error = str(error)
+        if self.attempts <= len(self.RETRY_DELAYS):
+            self.next_attempt_at = timezone.now() + timedelta(seconds=self.RETRY_DELAYS[self.attempts - 1])
+        else:
+            self.next_attempt_at = None
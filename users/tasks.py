@@ -1,21 +1,34 @@
 import os
-import uuid
-from datetime import datetime, timedelta
+from datetime import timedelta
+from smtplib import SMTPException
 
 from celery import shared_task
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.http import HttpResponseBadRequest
+from django.urls import reverse
+from django.utils import timezone
 
-from users.models import EmailVerification, User
+from news.models import ArchivedComment, PostUserComment
+from rpg_agg.task_metrics import task_count
+from users.models import (EmailVerification, EmailVerificationCode,
+                          OutgoingEmail, User)
 
+# Сколько секунд забранные воркером письма не видны другим воркерам, письма, не отправленные за это время
+# (воркер упал посреди пачки), будут отправлены снова
+OUTBOX_LEASE = 60 * 10
 
-# Запланированная задача для проверки срока жизни EmailVerification
+
+# Запланированная чистка просроченных EmailVerification, оставшихся от кодов в базе
+# Коды в redis истекают сами, здесь же один DELETE по индексу finish, без загрузки строк
 @shared_task
 def check_finish_email_verify():
-    # Цикл по всем "живым" экземплярам EmailVerification
-    for em_verify in EmailVerification.objects.all():
-        # Если срок вышел, удаляем
-        if em_verify.finish < datetime.utcnow():
-            em_verify.delete()
+    deleted = EmailVerification.objects.filter(finish__lt=timezone.now()).delete()[0]
+    task_count('rows_deleted', deleted)
+    return deleted
 
 
 # Запланированная задача, для поиска и удаления неиспользуемых изображений аватарок
@@ -30,6 +43,7 @@ def check_useless_avatar():
     for image in list_of_all_image:
         if image[1:] not in list_of_needed_image:
             os.remove(image)
+            task_count('avatars_removed')
 
 
 # Отложенная задача, для отправки письма верификации
@@ -40,13 +54,92 @@ def send_verification_email(user_id: int):
     # Просто подстраховка, если запрос сделан пользователем, с верификацией
     if user.check_email:
         return HttpResponseBadRequest()
-    # Создаем конечное время жизни
-    finish = datetime.astimezone(datetime.now() + timedelta(hours=24))
-    # Создаем объект, с пользователем, уникальным кодом и временем жизни
-    email = EmailVerification.objects.create(
-        user=user,
-        code=uuid.uuid4(),
-        finish=finish
-    )
-    # Отправляем через метод, написанный в users.models.EmailVerification
-    email.send_email_verificate()
+    # Создаем код с временем жизни в redis и ставим в очередь письмо со ссылкой
+    code = EmailVerificationCode.create(user)
+    link = f"{settings.FULL_DOMAIN_NAME}{reverse('users:verification', kwargs={'code': code})}"
+    enqueue_emails([OutgoingEmail(
+        recipient=user.email,
+        subject='Email Verification from rpg_agg',
+        body=f'Dear, {user.username}! Please activate your email: {link}',
+    )])
+
+
+def enqueue_emails(emails):
+    """
+    Поставить письма (несохранённые OutgoingEmail) в очередь одним INSERT
+    Отправка запускается после коммита текущей транзакции, чтобы воркер увидел новые строки
+    """
+    OutgoingEmail.objects.bulk_create(emails, batch_size=1000)
+    task_count('emails_queued', len(emails))
+    transaction.on_commit(send_outbox.delay)
+
+
+def claim_outbox(batch_size):
+    """
+    Забрать пачку писем, готовых к отправке: строки блокируются с SKIP LOCKED и откладываются на OUTBOX_LEASE
+    в короткой транзакции, поэтому параллельные воркеры не отправят одно письмо дважды, а сама отправка идёт уже
+    без открытой транзакции и блокировок
+    """
+    with transaction.atomic():
+        emails = list(OutgoingEmail.objects.select_for_update(skip_locked=True)
+                      .filter(next_attempt_at__lte=timezone.now())
+                      .order_by('next_attempt_at')[:batch_size])
+        OutgoingEmail.objects.filter(id__in=[email.id for email in emails]).update(
+            next_attempt_at=timezone.now() + timedelta(seconds=OUTBOX_LEASE))
+    return emails
+
+
+# Отправка очереди писем: пачками, через одно SMTP соединение на весь запуск (заново открывается только после ошибки)
+# Запускается после постановки писем в очередь и раз в минуту по расписанию, для повторных попыток
+# Каждое письмо удаляется сразу после отправки, поэтому любая ошибка посреди пачки не отправит его повторно
+@shared_task
+def send_outbox(batch_size=100):
+    connection = get_connection()
+    opened = False
+    sent = 0
+    try:
+        while True:
+            emails = claim_outbox(batch_size)
+            if not emails:
+                return sent
+            failed = 0
+            for email in emails:
+                try:
+                    if not opened:
+                        # Открытое заранее соединение send_messages не закрывает, иначе - новое на каждое письмо
+                        connection.open()
+                        opened = True
+                    connection.send_messages([email.message(connection)])
+                except (SMTPException, OSError) as error:
+                    email.fail(error)
+                    email.save(update_fields=['attempts', 'last_error', 'next_attempt_at'])
+                    failed += 1
+                    # После ошибки соединение могло оборваться, следующее письмо откроет новое
+                    connection.close()
+                    opened = False
+                else:
+                    email.delete()
+                    sent += 1
+            task_count('emails_sent', len(emails) - failed)
+            task_count('emails_failed', failed)
+    finally:
+        connection.close()
+
+
+# Запланированная сверка хранимой кармы с суммой рейтингов комментариев (в том числе архивных)
+# Карма поддерживается при каждом голосовании и удалении комментария, задача исправляет расхождения
+# (например, после каскадного удаления комментариев вместе с игрой), пачками по id, меняя только отличающиеся строки
+@shared_task
+def karma_reconcile(batch_size=5000):
+    def rating_sum(model):
+        return Coalesce(Subquery(
+            model.objects.filter(user=OuterRef('pk')).values('user').annotate(total=Sum('rating_total')).values('total')
+        ), 0)
+
+    actual = rating_sum(PostUserComment) + rating_sum(ArchivedComment)
+    max_id = User.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    fixed = 0
+    for start in range(0, max_id + 1, batch_size):
+        fixed += User.objects.filter(id__gte=start, id__lt=start + batch_size).exclude(karma=actual).update(karma=actual)
+    task_count('users_fixed', fixed)
+    return fixed
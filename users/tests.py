@@ -0,0 +1,180 @@
+import time
+import uuid
+from datetime import timedelta
+from smtplib import SMTPException
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from news.models import (ArchivedComment, ArchivedNewsPost, PostUserComment,
+                         Vote)
+from news.tests import create_game, create_post
+from users.models import (EmailVerification, EmailVerificationCode,
+                          OutgoingEmail, User)
+from users.tasks import karma_reconcile, send_outbox
+
+
+@mock.patch('users.tasks.get_connection')
+class SendOutboxTests(TestCase):
+    """
+    Отправка очереди писем: одно SMTP соединение на запуск, повтор неотправленных, удаление отправленных сразу
+    """
+
+    def setUp(self):
+        self.emails = [OutgoingEmail.objects.create(recipient=f'user{number}@example.com', subject='Subject',
+                                                    body='Body')
+                       for number in range(3)]
+
+    def test_one_connection_per_run(self, get_connection):
+        self.assertEqual(send_outbox(batch_size=2), 3)
+        connection = get_connection.return_value
+        self.assertEqual(connection.open.call_count, 1)
+        self.assertEqual(connection.send_messages.call_count, 3)
+        self.assertEqual([call.args[0][0].to for call in connection.send_messages.call_args_list],
+                         [[email.recipient] for email in self.emails])
+        self.assertFalse(OutgoingEmail.objects.exists())
+
+    def test_failed_email_is_retried_later(self, get_connection):
+        connection = get_connection.return_value
+        connection.send_messages.side_effect = [1, SMTPException('busy'), 1]
+        self.assertEqual(send_outbox(), 2)
+        # После ошибки соединение открывается заново
+        self.assertEqual(connection.open.call_count, 2)
+        failed = OutgoingEmail.objects.get()
+        self.assertEqual((failed.id, failed.attempts, failed.last_error), (self.emails[1].id, 1, 'busy'))
+        self.assertGreater(failed.next_attempt_at, timezone.now())
+
+    def test_unexpected_error_keeps_sent_emails_deleted(self, get_connection):
+        connection = get_connection.return_value
+        connection.send_messages.side_effect = [1, ValueError]
+        with self.assertRaises(ValueError):
+            send_outbox()
+        connection.close.assert_called()
+        # Отправленное письмо удалено, остальные отложены до окончания OUTBOX_LEASE и сразу не отправляются снова
+        self.assertEqual(set(OutgoingEmail.objects.values_list('id', flat=True)),
+                         {self.emails[1].id, self.emails[2].id})
+        connection.send_messages.side_effect = None
+        self.assertEqual(send_outbox(), 0)
+
+
+@mock.patch('rpg_agg.ratelimit.overloaded', mock.Mock(return_value=False))
+@mock.patch('rpg_agg.ratelimit.retry_after', mock.Mock(return_value=0))
+class EmailVerificationTests(TestCase):
+    """
+    Подтверждение почты: одноразовые коды в redis с временем жизни, лимит писем и старые коды в базе
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        # Шаблоны показывают аватарку пользователя
+        cls.user = User.objects.create_user('reader', 'reader@example.com', 'password', avatar='users_images/a.png')
+
+    def setUp(self):
+        # Redis не откатывается вместе с базой, счётчик с тем же id пользователя мог остаться от других тестов
+        cache.delete(EmailVerificationCode.count_key(self.user.id))
+
+    def verify(self, code):
+        self.client.get(reverse('users:verification', kwargs={'code': code}))
+        self.user.refresh_from_db()
+        return self.user.check_email
+
+    def test_code_is_single_use(self):
+        code = EmailVerificationCode.create(self.user)
+        self.assertEqual(EmailVerificationCode.pop_user_id(code), self.user.id)
+        self.assertIsNone(EmailVerificationCode.pop_user_id(code))
+        self.assertTrue(self.verify(EmailVerificationCode.create(self.user)))
+
+    def test_concurrent_pop(self):
+        code = EmailVerificationCode.create(self.user)
+        get = cache.get
+
+        def get_then_lose_race(key, *args, **kwargs):
+            # Параллельный запрос с тем же кодом успевает удалить его между чтением и удалением
+            value = get(key, *args, **kwargs)
+            cache.delete(key)
+            return value
+
+        with mock.patch.object(cache, 'get', get_then_lose_race):
+            self.assertIsNone(EmailVerificationCode.pop_user_id(code))
+
+    @mock.patch.object(EmailVerificationCode, 'TIMEOUT', 1)
+    def test_code_expires(self):
+        code = EmailVerificationCode.create(self.user)
+        time.sleep(1.1)
+        self.assertFalse(self.verify(code))
+
+    def test_unknown_code(self):
+        self.assertFalse(self.verify(uuid.uuid4()))
+
+    @mock.patch('users.views.send_verification_email')
+    def test_email_limit(self, send_verification_email):
+        self.client.force_login(self.user)
+        for _ in range(EmailVerificationCode.LIMIT):
+            EmailVerificationCode.create(self.user)
+        self.client.get(reverse('users:new_verify'))
+        self.assertEqual(send_verification_email.delay.call_count, 1)
+        EmailVerificationCode.create(self.user)
+        response = self.client.get(reverse('users:new_verify'))
+        self.assertContains(response, 'слишком много')
+        self.assertEqual(send_verification_email.delay.call_count, 1)
+
+    def test_legacy_code(self):
+        code = uuid.uuid4()
+        EmailVerification.objects.create(user=self.user, code=code, finish=timezone.now() + timedelta(days=1))
+        self.assertTrue(self.verify(code))
+        self.assertFalse(EmailVerification.objects.exists())
+
+    def test_expired_legacy_code(self):
+        code = uuid.uuid4()
+        EmailVerification.objects.create(user=self.user, code=code, finish=timezone.now() - timedelta(seconds=1))
+        self.assertFalse(self.verify(code))
+
+
+class KarmaTests(TestCase):
+    """
+    Карма - сумма рейтингов комментариев пользователя, меняется голосами, сверяется задачей, таблица лидеров по ней
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        # Шаблоны показывают аватарки пользователей
+        cls.users = [User.objects.create_user(f'user{number}', f'user{number}@example.com', 'password',
+                                              avatar='users_images/a.png')
+                     for number in range(3)]
+        cls.post = create_post(create_game('Game'), '1')
+        cls.comment = PostUserComment.objects.create(user=cls.users[0], post=cls.post, message='Comment')
+
+    def karma(self):
+        return list(User.objects.order_by('id').values_list('karma', flat=True))
+
+    def test_comment_votes(self):
+        Vote.cast(self.users[1], 'comment', self.comment.id, Vote.LIKE)
+        Vote.cast(self.users[2], 'comment', self.comment.id, Vote.LIKE)
+        self.assertEqual(self.karma(), [2, 0, 0])
+        Vote.cast(self.users[2], 'comment', self.comment.id, Vote.DISLIKE)
+        self.assertEqual(self.karma(), [0, 0, 0])
+        # Голоса за посты карму не меняют
+        Vote.cast(self.users[1], 'post', self.post.id, Vote.LIKE)
+        self.assertEqual(self.karma(), [0, 0, 0])
+
+    def test_reconcile(self):
+        PostUserComment.objects.filter(id=self.comment.id).update(rating_total=3)
+        archived_post = ArchivedNewsPost.objects.create(id=10 ** 6, game=self.post.game, gid='old', title='Old',
+                                                        author='Author', date=1, source_url='', content='',
+                                                        created_timestamp=timezone.now())
+        ArchivedComment.objects.create(id=10 ** 6, user=self.users[0], post=archived_post, message='Old',
+                                       created_timestamp=timezone.now(), rating_total=2)
+        User.objects.filter(id=self.users[1].id).update(karma=7)
+        self.assertEqual(karma_reconcile(batch_size=2), 2)
+        self.assertEqual(self.karma(), [5, 0, 0])
+        self.assertEqual(karma_reconcile(), 0)
+
+    def test_leaderboard(self):
+        User.objects.filter(id=self.users[0].id).update(karma=5)
+        User.objects.filter(id=self.users[1].id).update(karma=5)
+        User.objects.filter(id=self.users[2].id).update(karma=-1)
+        response = self.client.get(reverse('users:leaderboard'))
+        self.assertEqual([user.username for user in response.context['object_list']], ['user0', 'user1'])
@@ -1,7 +1,7 @@
 from django.urls import path
 
 from users.views import (ChangePasswordUserDoneView, ChangePasswordUserView,
-                         LoginUserView, ProfileUserView, RegisterCompleteView,
+                         LeaderboardView, LoginUserView, ProfileUserView, RegisterCompleteView,
                          RegisterUserView, ResetPasswordUserCompleteView,
                          ResetPasswordUserConfirmView,
                          ResetPasswordUserDoneView, ResetPasswordUserView,
@@ -17,6 +17,7 @@ urlpatterns = [
     path('change_password_done', ChangePasswordUserDoneView.as_view(), name='change_password_done'),
     path('login', LoginUserView.as_view(), name='login'),
     path('profile/<int:pk>', ProfileUserView.as_view(), name='profile'),
+    path('leaderboard', LeaderboardView.as_view(), name='leaderboard'),
     path('reset_password', ResetPasswordUserView.as_view(), name='reset_password'),
     path('reset_password_done', ResetPasswordUserDoneView.as_view(), name='reset_password_done'),
     path('reset_password_confirm/<uidb64>/<token>', ResetPasswordUserConfirmView.as_view(),
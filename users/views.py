@@ -11,14 +11,18 @@ from django.contrib.auth.views import (LoginView, PasswordChangeDoneView,
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
 from django.urls import reverse, reverse_lazy
+from django.utils import timezone
 from django.views.generic.base import TemplateView
 from django.views.generic.edit import CreateView, UpdateView
+from django.views.generic.list import ListView
 
-from news.models import GameModel, PostUserComment
+from news.models import GameModel
+from rpg_agg.db_router import UsePrimaryMixin
+from rpg_agg.ratelimit import rate_limit
 from users.forms import (ChangeUserPasswordForm, LoginUserForm,
                          ProfileUserForm, RegisterUserForm,
                          ResetUserPasswordConfirmForm, ResetUserPasswordForm)
-from users.models import EmailVerification, User
+from users.models import EmailVerification, EmailVerificationCode, User
 from users.tasks import send_verification_email, check_useless_avatar
 
 
@@ -67,15 +71,15 @@ class LoginUserView(LoginView):
 
 
 # Представление профиля
-class ProfileUserView(LoginRequiredMixin, UpdateView):
+class ProfileUserView(UsePrimaryMixin, LoginRequiredMixin, UpdateView):
     model = User
     template_name = 'users/profile.html'
     form_class = ProfileUserForm
 
     def get_context_data(self, **kwargs):
         context = super(ProfileUserView, self).get_context_data(**kwargs)
-        # формируем рейтинг пользователя на основе рейтинга всех его комментариев
-        context['user_rating'] = PostUserComment.objects.filter(user=self.request.user).make_user_rating()
+        # Рейтинг пользователя - хранимая карма, сумма рейтингов всех его комментариев
+        context['user_rating'] = self.request.user.karma
         return context
 
     # В случае успешного внесения изменений в профиле (изменяется только username и аватар)
@@ -86,6 +90,17 @@ class ProfileUserView(LoginRequiredMixin, UpdateView):
         return reverse_lazy('users:profile', kwargs={'pk': self.request.user.id})
 
 
+# Таблица лидеров по карме, страница читается по индексу (-karma, id), без сортировки всех пользователей
+class LeaderboardView(ListView):
+    template_name = 'users/leaderboard.html'
+    paginate_by = 50
+    # Сколько лучших пользователей показываем
+    size = 100
+
+    def get_queryset(self):
+        return User.objects.filter(karma__gt=0).order_by('-karma', 'id').only('username', 'avatar', 'karma')[:self.size]
+
+
 # Представление для сброса пароля, здесь формируется письмо которое будет отправлено на почту
 class ResetPasswordUserView(PasswordResetView):
     # От кого отправлено
@@ -127,17 +142,18 @@ class ResetPasswordUserCompleteView(PasswordResetCompleteView):
 
 # Представление о верификации почты
 def email_verification(request, code):
-    # Находим объект верификации по коду (uuid)
-    email_verify = EmailVerification.objects.filter(code=code)
-    # Дабы избежать ошибки, пользуемся filter вместо get, хотя можно было бы и через try/except
-    if email_verify.exists():
-        email_verify = email_verify.first()
-        user = email_verify.user
+    # Находим пользователя по коду (uuid) в redis, код одноразовый
+    user_id = EmailVerificationCode.pop_user_id(code)
+    if user_id is None:
+        # Ссылки из писем, отправленных до переноса кодов в redis: поиск по уникальному индексу code
+        email_verify = EmailVerification.objects.filter(code=code, finish__gt=timezone.now()).first()
+        # Так же одноразово: засчитывается только удаление, которое действительно удалило строку
+        if email_verify is not None and email_verify.delete()[0]:
+            user_id = email_verify.user_id
+    if user_id is not None:
         message_head = 'Поздравляем'
         message = 'Верификация вашего адреса электронной почты прошла успешна'
-        user.check_email = True
-        user.save()
-        email_verify.delete()
+        User.objects.filter(id=user_id).update(check_email=True)
     else:
         message_head = 'Упс'
         message = 'К сожалению верификация вашего адреса электронной почты не удалась.' \
@@ -159,6 +175,7 @@ def logout_user_view(request):
 
 # Представление нового запроса верификации, если пользователь утратил/не получил/просрочил первичную после регистрации
 @login_required
+@rate_limit('verification_email')
 def new_verification_email(request):
     template_name = 'users/message_template.html'
     # Заготовка контекста
@@ -168,13 +185,13 @@ def new_verification_email(request):
         'redirect_url': reverse('users:profile', kwargs={'pk': request.user.id}),
         'button_name': 'Вернуться'
     }
-    # Если "живых" верификаций у данного пользователя больше трёх, больше создавать не дадим
-    if len(EmailVerification.objects.filter(user=request.user)) > 3:
+    # Если за последние сутки пользователь запросил больше трёх писем, больше создавать не дадим
+    if EmailVerificationCode.count(request.user) > EmailVerificationCode.LIMIT:
         context['message_head'] = 'Упс'
         context['message'] = 'У вас сформировано слишком много действующих писем с верификацией, попробуйте завтра'
         return render(request, template_name, context)
-    # Если всё в порядке, отправляем письмо
-    send_verification_email(request.user.id)
+    # Если всё в порядке, отправляем письмо в фоне, запрос не ждёт почтовый сервер
+    send_verification_email.delay(request.user.id)
     return render(request, template_name, context)
 
 